@@ -1,8 +1,16 @@
+import hashlib
+import json
 import os
-
-from typing import List, Optional
+import stat
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
 from nest.helpers import validate_xml
+from nest.snapshot import ConfigSnapshot
 from nest_site.settings import map_media_url_to_local
 
 NEST_ROOT = os.path.dirname(os.path.realpath(__file__))
@@ -47,80 +55,299 @@ class DisplayConfig(object):
             plt.show()
 
 
+class ConfigValidationError(AssertionError):
+    """
+    Raised when a config fails validation. The full list of violations is
+    available in report.
+    """
+
+    def __init__(self, report: 'ConfigValidationReport'):
+        super().__init__(str(report))
+        self.report = report
+
+
+class ConfigValidationReport(object):
+    """
+    Collection of all the violations found when validating a config, instead
+    of stopping at the first one. Each violation is a dict of:
+    {'section': <config section>, 'index': <list index in the section, or None>, 'message': <description>}
+    """
+
+    MAX_VIOLATIONS_IN_MESSAGE = 20
+
+    def __init__(self):
+        self.violations: List[dict] = list()
+
+    def add(self, section: str, message: str, index: Optional[int] = None):
+        self.violations.append({'section': section, 'index': index, 'message': message})
+
+    def extend(self, other: 'ConfigValidationReport'):
+        self.violations += other.violations
+
+    @property
+    def ok(self) -> bool:
+        return len(self.violations) == 0
+
+    def to_dict(self) -> dict:
+        return {'ok': self.ok, 'violations': self.violations}
+
+    def __str__(self):
+        if self.ok:
+            return 'config is valid'
+        lines = [f'{len(self.violations)} violation(s) found in config:']
+        for v in self.violations[:self.MAX_VIOLATIONS_IN_MESSAGE]:
+            location = v['section'] if v['index'] is None else f"{v['section']}[{v['index']}]"
+            lines.append(f"{location}: {v['message']}")
+        if len(self.violations) > self.MAX_VIOLATIONS_IN_MESSAGE:
+            lines.append(f'... and {len(self.violations) - self.MAX_VIOLATIONS_IN_MESSAGE} more')
+        return '\n'.join(lines)
+
+    def raise_if_invalid(self):
+        if not self.ok:
+            raise ConfigValidationError(self)
+
+
+class MediaPathVerifier(object):
+    """
+    Verify that local media files exist and are readable. Files are stat-ed
+    concurrently in a bounded thread pool, since on network filesystems the
+    latency of each stat dominates. The readability check is cached by
+    (path, mtime), so that re-verifying an unchanged media tree costs a stat
+    per file only; at most maxsize checks are cached, least recently used
+    evicted. As os.path.exists() did, a directory counts as present.
+    """
+
+    DEFAULT_MAX_WORKERS = 16
+    DEFAULT_MAXSIZE = 65536
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS, maxsize: int = DEFAULT_MAXSIZE):
+        assert isinstance(max_workers, int) and max_workers > 0
+        assert isinstance(maxsize, int) and maxsize > 0
+        self.max_workers = max_workers
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._readable: 'OrderedDict[Tuple[str, int], bool]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _check(self, local_path: str) -> dict:
+        try:
+            st = os.stat(local_path)
+        except OSError:
+            return {'local_path': local_path, 'status': 'missing', 'size': None}
+        if stat.S_ISDIR(st.st_mode):
+            return {'local_path': local_path, 'status': 'ok', 'size': st.st_size}
+        key = (local_path, st.st_mtime_ns)
+        with self._lock:
+            readable = self._readable.get(key)
+            if readable is not None:
+                self._readable.move_to_end(key)
+                self.hits += 1
+        if readable is None:
+            try:
+                with open(local_path, 'rb'):
+                    readable = True
+            except OSError:
+                readable = False
+            with self._lock:
+                self.misses += 1
+                self._readable[key] = readable
+                self._readable.move_to_end(key)
+                while len(self._readable) > self.maxsize:
+                    self._readable.popitem(last=False)
+                    self.evictions += 1
+        return {'local_path': local_path,
+                'status': 'ok' if readable else 'unreadable',
+                'size': st.st_size}
+
+    def check_all(self, local_paths: Iterable[str]) -> List[dict]:
+        """
+        Check each of local_paths, returning one dict per path, in order, of:
+        {'local_path': <path>, 'status': 'ok' | 'missing' | 'unreadable', 'size': <bytes, or None if missing>}
+        """
+        local_paths = list(local_paths)
+        if len(local_paths) <= 1:
+            return [self._check(path) for path in local_paths]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(local_paths))) as executor:
+            return list(executor.map(self._check, local_paths))
+
+    def verify(self, url_paths: Iterable[str]) -> List[dict]:
+        """
+        Verify the media files referred to by url_paths, skipping publicly
+        hosted urls. Return the full list of missing or unreadable files, each
+        a dict as returned by check_all() with the 'url_path' added.
+        """
+        url_paths = [p for p in url_paths
+                     if not (p.startswith('http://') or p.startswith('https://'))]
+        results = self.check_all(map_media_url_to_local(p) for p in url_paths)
+        failures = list()
+        for url_path, result in zip(url_paths, results):
+            if result['status'] != 'ok':
+                result['url_path'] = url_path
+                failures.append(result)
+        return failures
+
+    def clear(self):
+        with self._lock:
+            self._readable.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._readable),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'max_workers': self.max_workers,
+            }
+
+
 class StimulusConfig(object):
 
+    ID_KEYS = {
+        'contents': 'content_id',
+        'stimuli': 'stimulus_id',
+        'stimulusvotegroups': 'stimulusvotegroup_id',
+        'stimulusgroups': 'stimulusgroup_id',
+    }
+
     def __init__(self, config: dict, **more):
         self.config: dict = config
         assert isinstance(self.config, dict)
-        self._assert(**more)
+        self._ids: Dict[str, Optional[Sequence[int]]] = dict()
+        self._content_dict: Optional[Dict[int, dict]] = None
+        self._stimulus_dict: Optional[Dict[int, dict]] = None
+        self._stimulusvotegroup_dict: Optional[Dict[int, dict]] = None
+        self._stimulusgroup_dict: Optional[Dict[int, dict]] = None
+        if 'trusted' in more and more['trusted'] is True:
+            # config vouched for by a ValidationCertificate
+            pass
+        else:
+            self._assert(**more)
 
     def _assert(self, **more):
-        assert 'contents' in self.config
-        assert 'stimuli' in self.config
-        assert 'stimulusvotegroups' in self.config
-        assert 'stimulusgroups' in self.config
-
-        assert isinstance(self.contents, list)
-        for c in self.contents:
-            assert isinstance(c, dict)
-            assert 'content_id' in c
-            assert 'name' in c
-        cids = self.content_ids
-        assert len(set(cids)) == len(cids), \
-            f'content_ids must be unique, but got: {cids}'
-
-        assert isinstance(self.stimuli, list)
-        for s in self.stimuli:
-            assert isinstance(s, dict)
-            assert 'stimulus_id' in s
-            assert 'path' in s
-            assert 'type' in s
-            assert 'content_id' in s
-            assert s['content_id'] in self.content_ids
-        sids = self.stimulus_ids
-        assert len(set(sids)) == len(sids), \
-            f'stimulus_ids must be unique, but got: {sids}'
+        self.validate(**more).raise_if_invalid()
+
+    def validate(self, **more) -> ConfigValidationReport:  # noqa C901
+        """
+        Validate the stimulus config in a single pass over each section,
+        collecting every violation found into a ConfigValidationReport.
+        """
+        report = ConfigValidationReport()
+
+        for section in ['contents', 'stimuli', 'stimulusvotegroups', 'stimulusgroups']:
+            if section not in self.config:
+                report.add(section, f"missing section '{section}'")
+            elif not isinstance(self.config[section], list):
+                report.add(section, f"section '{section}' must be a list")
+        if not report.ok:
+            # the sections below depend on the presence of all sections
+            return report
+
+        content_ids = set()
+        for idx, c in enumerate(self.contents):
+            if not isinstance(c, dict):
+                report.add('contents', 'content must be a dict', idx)
+                continue
+            for key in ['content_id', 'name']:
+                if key not in c:
+                    report.add('contents', f"missing '{key}'", idx)
+            if 'content_id' in c:
+                if c['content_id'] in content_ids:
+                    report.add('contents', f"content_ids must be unique, but {c['content_id']} is duplicated", idx)
+                content_ids.add(c['content_id'])
+
+        stimulus_ids = set()
+        for idx, s in enumerate(self.stimuli):
+            if not isinstance(s, dict):
+                report.add('stimuli', 'stimulus must be a dict', idx)
+                continue
+            for key in ['stimulus_id', 'path', 'type', 'content_id']:
+                if key not in s:
+                    report.add('stimuli', f"missing '{key}'", idx)
+            if 'content_id' in s and s['content_id'] not in content_ids:
+                report.add('stimuli', f"content_id {s['content_id']} not found in contents", idx)
+            if 'stimulus_id' in s:
+                if s['stimulus_id'] in stimulus_ids:
+                    report.add('stimuli', f"stimulus_ids must be unique, but {s['stimulus_id']} is duplicated", idx)
+                stimulus_ids.add(s['stimulus_id'])
 
         if 'skip_path_check' in more and more['skip_path_check'] is True:
             pass
         else:
-            for s in self.stimuli:
-                url_path: str = s['path']
-                if url_path.startswith('http://') or url_path.startswith('https://'):
-                    # don't check publically hosted urls
-                    continue
-                local_path = map_media_url_to_local(url_path)
-                assert os.path.exists(local_path), \
-                    f"url path {url_path} should map to local path {local_path}, which does not exist"
-
-        assert isinstance(self.stimulusvotegroups, list)
-        for svg in self.stimulusvotegroups:
-            assert isinstance(svg, dict)
-            assert 'stimulusvotegroup_id' in svg
-            assert 'stimulus_ids' in svg
-            assert isinstance(svg['stimulus_ids'], list)
-            for sid in svg['stimulus_ids']:
-                assert sid in self.stimulus_ids
-            assert len(svg['stimulus_ids']) in [1, 2], \
-                "for now, only support stimulus_ids list length 1 " \
-                "(single-stimulus test) or 2 (double-stimulus test)"
-        svgids = self.stimulusvotegroup_ids
-        assert len(set(svgids)) == len(svgids), \
-            f'stimulusvotegroup_ids must be unique, but got: {svgids}'
-
-        assert isinstance(self.stimulusgroups, list)
-        for sg in self.stimulusgroups:
-            assert isinstance(sg, dict)
-            assert 'stimulusgroup_id' in sg
-            assert 'stimulusvotegroup_ids' in sg
-            assert isinstance(sg['stimulusvotegroup_ids'], list)
-            for svgid in sg['stimulusvotegroup_ids']:
-                assert svgid in self.stimulusvotegroup_ids
-            if 'video_display_percentage' in sg:
-                assert 0 < sg['video_display_percentage'] <= 100
-        sgids = self.stimulusgroup_ids
-        assert len(set(sgids)) == len(sgids), \
-            f'stimulusgroup_ids must be unique, but got: {sgids}'
+            url_path_indices = dict()
+            for idx, s in enumerate(self.stimuli):
+                if isinstance(s, dict) and 'path' in s:
+                    url_path_indices.setdefault(s['path'], idx)
+            for failure in media_path_verifier.verify(url_path_indices.keys()):
+                report.add('stimuli', self.get_path_failure_message(failure), url_path_indices[failure['url_path']])
+
+        stimulusvotegroup_ids = set()
+        for idx, svg in enumerate(self.stimulusvotegroups):
+            if not isinstance(svg, dict):
+                report.add('stimulusvotegroups', 'stimulusvotegroup must be a dict', idx)
+                continue
+            for key in ['stimulusvotegroup_id', 'stimulus_ids']:
+                if key not in svg:
+                    report.add('stimulusvotegroups', f"missing '{key}'", idx)
+            if 'stimulus_ids' in svg:
+                if not isinstance(svg['stimulus_ids'], list):
+                    report.add('stimulusvotegroups', 'stimulus_ids must be a list', idx)
+                else:
+                    for sid in svg['stimulus_ids']:
+                        if sid not in stimulus_ids:
+                            report.add('stimulusvotegroups', f"stimulus_id {sid} not found in stimuli", idx)
+                    if len(svg['stimulus_ids']) not in [1, 2]:
+                        report.add('stimulusvotegroups',
+                                   "for now, only support stimulus_ids list length 1 "
+                                   "(single-stimulus test) or 2 (double-stimulus test)", idx)
+            if 'stimulusvotegroup_id' in svg:
+                if svg['stimulusvotegroup_id'] in stimulusvotegroup_ids:
+                    report.add('stimulusvotegroups', f"stimulusvotegroup_ids must be unique, "
+                                                     f"but {svg['stimulusvotegroup_id']} is duplicated", idx)
+                stimulusvotegroup_ids.add(svg['stimulusvotegroup_id'])
+
+        stimulusgroup_ids = set()
+        for idx, sg in enumerate(self.stimulusgroups):
+            if not isinstance(sg, dict):
+                report.add('stimulusgroups', 'stimulusgroup must be a dict', idx)
+                continue
+            for key in ['stimulusgroup_id', 'stimulusvotegroup_ids']:
+                if key not in sg:
+                    report.add('stimulusgroups', f"missing '{key}'", idx)
+            if 'stimulusvotegroup_ids' in sg:
+                if not isinstance(sg['stimulusvotegroup_ids'], list):
+                    report.add('stimulusgroups', 'stimulusvotegroup_ids must be a list', idx)
+                else:
+                    for svgid in sg['stimulusvotegroup_ids']:
+                        if svgid not in stimulusvotegroup_ids:
+                            report.add('stimulusgroups', f"stimulusvotegroup_id {svgid} not found in stimulusvotegroups", idx)
+            if 'video_display_percentage' in sg and not 0 < sg['video_display_percentage'] <= 100:
+                report.add('stimulusgroups', f"video_display_percentage must be in (0, 100], "
+                                             f"but is {sg['video_display_percentage']}", idx)
+            if 'stimulusgroup_id' in sg:
+                if sg['stimulusgroup_id'] in stimulusgroup_ids:
+                    report.add('stimulusgroups', f"stimulusgroup_ids must be unique, "
+                                                 f"but {sg['stimulusgroup_id']} is duplicated", idx)
+                stimulusgroup_ids.add(sg['stimulusgroup_id'])
+
+        return report
+
+    @staticmethod
+    def get_path_failure_message(failure: dict) -> str:
+        """
+        Describe a failure returned by MediaPathVerifier.verify().
+        """
+        if failure['status'] == 'missing':
+            return f"url path {failure['url_path']} should map to local path " \
+                   f"{failure['local_path']}, which does not exist"
+        return f"url path {failure['url_path']} maps to local path " \
+               f"{failure['local_path']} ({failure['size']} bytes), which is not readable"
 
     @property
     def contents(self) -> List[dict]:
@@ -138,87 +365,133 @@ class StimulusConfig(object):
     def stimulusgroups(self) -> List[dict]:
         return self.config['stimulusgroups']
 
+    @staticmethod
+    def _get_values(section, key: str) -> list:
+        # a section backed by a ConfigSnapshot reads its columns directly
+        if hasattr(section, 'values'):
+            return section.values(key)
+        return [d[key] if key in d else None for d in section]
+
+    @staticmethod
+    def _get_index(section, key: str) -> Dict[int, dict]:
+        if hasattr(section, 'index_by'):
+            return section.index_by(key)
+        return {d[key]: d for d in section}
+
+    @staticmethod
+    def _get_compact_values(section, key: str) -> Sequence[int]:
+        # a section backed by a ConfigSnapshot already holds its int columns
+        # packed, so they are used in place
+        if hasattr(section, 'column'):
+            column = section.column(key)
+            if column is not None:
+                return column
+        values = StimulusConfig._get_values(section, key)
+        try:
+            return array('q', values)
+        except (TypeError, OverflowError):
+            # missing or non-int ids, only seen in configs that fail validation
+            return tuple(values)
+
+    def get_ids(self, section: str) -> Sequence[int]:
+        """
+        Return the ids of section, in config order, as a read-only packed
+        sequence built on first access. Only section is read, so e.g. the
+        stimuli of a config loaded from a ConfigSnapshot are never decoded by
+        callers that only need the stimulusgroups.
+        """
+        ids = self._ids.get(section)
+        if ids is None:
+            ids = self._get_compact_values(self.config[section], self.ID_KEYS[section])
+            self._ids[section] = ids
+        return ids
+
     @property
     def content_ids(self) -> List[int]:
-        return [c['content_id'] for c in self.contents]
+        return list(self.get_ids('contents'))
 
     @property
     def stimulus_ids(self) -> List[int]:
-        return [s['stimulus_id'] for s in self.stimuli]
+        return list(self.get_ids('stimuli'))
 
     @property
     def stimulusvotegroup_ids(self) -> List[int]:
-        return [svg['stimulusvotegroup_id'] for svg in self.stimulusvotegroups]
+        return list(self.get_ids('stimulusvotegroups'))
 
     @property
     def stimulusgroup_ids(self) -> List[int]:
-        return [sg['stimulusgroup_id'] for sg in self.stimulusgroups]
+        return list(self.get_ids('stimulusgroups'))
+
+    @property
+    def content_dict(self) -> Dict[int, dict]:
+        """dict: content_id -> content, built on first access."""
+        if self._content_dict is None:
+            self._content_dict = self._get_index(self.contents, 'content_id')
+        return self._content_dict
+
+    @property
+    def stimulus_dict(self) -> Dict[int, dict]:
+        """dict: stimulus_id -> stimulus, built on first access."""
+        if self._stimulus_dict is None:
+            self._stimulus_dict = self._get_index(self.stimuli, 'stimulus_id')
+        return self._stimulus_dict
+
+    @property
+    def stimulusvotegroup_dict(self) -> Dict[int, dict]:
+        """dict: stimulusvotegroup_id -> stimulusvotegroup, built on first access."""
+        if self._stimulusvotegroup_dict is None:
+            self._stimulusvotegroup_dict = self._get_index(self.stimulusvotegroups, 'stimulusvotegroup_id')
+        return self._stimulusvotegroup_dict
+
+    @property
+    def stimulusgroup_dict(self) -> Dict[int, dict]:
+        """dict: stimulusgroup_id -> stimulusgroup, built on first access."""
+        if self._stimulusgroup_dict is None:
+            self._stimulusgroup_dict = self._get_index(self.stimulusgroups, 'stimulusgroup_id')
+        return self._stimulusgroup_dict
 
     def get_video_display_percentage(self, stimulusgroup_id: int) -> Optional[int]:
-        sg: dict
-        for sg in self.stimulusgroups:
-            if sg['stimulusgroup_id'] == stimulusgroup_id:
-                if 'video_display_percentage' in sg:
-                    return sg['video_display_percentage']
-                else:
-                    return 100  # 100%, or full browser canvas
-        else:
+        sg: Optional[dict] = self.stimulusgroup_dict.get(stimulusgroup_id)
+        if sg is None:
             return None
+        return sg.get('video_display_percentage', 100)  # 100%, or full browser canvas
 
-    def get_pre_message(self, stimulusgroup_id: int) -> Optional[str]:
-        sg: dict
-        for sg in self.stimulusgroups:
-            if sg['stimulusgroup_id'] == stimulusgroup_id:
-                if 'pre_message' in sg:
-                    return sg['pre_message']
-                else:
-                    return None
-        else:
+    def _get_stimulusgroup_field(self, stimulusgroup_id: int, field: str):
+        sg: Optional[dict] = self.stimulusgroup_dict.get(stimulusgroup_id)
+        if sg is None:
             return None
+        return sg.get(field)
+
+    def get_pre_message(self, stimulusgroup_id: int) -> Optional[str]:
+        return self._get_stimulusgroup_field(stimulusgroup_id, 'pre_message')
 
     def get_start_end_seconds(self, stimulusgroup_id: int) -> Optional[tuple[int, int]]:
-        sg: dict
-        for sg in self.stimulusgroups:
-            if sg['stimulusgroup_id'] == stimulusgroup_id:
-                if 'start_end_seconds' in sg:
-                    return sg['start_end_seconds']
-                else:
-                    return None
-        else:
-            return None
+        return self._get_stimulusgroup_field(stimulusgroup_id, 'start_end_seconds')
 
     def get_text_color(self, stimulusgroup_id: int) -> Optional[str]:
-        sg: dict
-        for sg in self.stimulusgroups:
-            if sg['stimulusgroup_id'] == stimulusgroup_id:
-                if 'text_color' in sg:
-                    return sg['text_color']
-                else:
-                    return None
-        else:
-            return None
+        return self._get_stimulusgroup_field(stimulusgroup_id, 'text_color')
 
     def get_overlay_on_video_js(self, stimulusgroup_id: int) -> Optional[str]:
-        sg: dict
-        for sg in self.stimulusgroups:
-            if sg['stimulusgroup_id'] == stimulusgroup_id:
-                if 'overlay_on_video_js' in sg:
-                    return sg['overlay_on_video_js']
-                else:
-                    return None
-        else:
-            return None
+        return self._get_stimulusgroup_field(stimulusgroup_id, 'overlay_on_video_js')
 
     def get_super_stimulusgroup_id(self, stimulusgroup_id: int) -> Optional[int]:
-        sg: dict
-        for sg in self.stimulusgroups:
-            if sg['stimulusgroup_id'] == stimulusgroup_id:
-                if 'super_stimulusgroup_id' in sg:
-                    return sg['super_stimulusgroup_id']
-                else:
-                    return None
-        else:
-            return None
+        return self._get_stimulusgroup_field(stimulusgroup_id, 'super_stimulusgroup_id')
+
+    def get_super_stimulusgroup_ids(self) -> Optional[Sequence[int]]:
+        """
+        Return super_stimulusgroup_ids as a read-only packed sequence, or None
+        if absent, checked and built on first access.
+        """
+        if 'super_stimulusgroups' not in self._ids:
+            # check super_stimulusgroup_id is all-present or all-absent
+            super_sg_ids = self._get_values(self.stimulusgroups, 'super_stimulusgroup_id')
+            assert all([ssid is None for ssid in super_sg_ids]) or all([ssid is not None for ssid in super_sg_ids]), \
+                f"super_stimulusgroup_id must be all-present or all-absent, but is {super_sg_ids}."
+            if all([ssid is not None for ssid in super_sg_ids]):
+                self._ids['super_stimulusgroups'] = self._get_compact_values(self.stimulusgroups, 'super_stimulusgroup_id')
+            else:
+                self._ids['super_stimulusgroups'] = None
+        return self._ids['super_stimulusgroups']
 
     @property
     def super_stimulusgroup_ids(self) -> Optional[List[int]]:
@@ -228,95 +501,99 @@ class StimulusConfig(object):
         will then be hierarchical instead of flat: first randomize between
         super_stimulusgroups, then randomize within each super_stimulusgroup.
         """
-        # check super_stimulusgroup_id is all-present or all-absent
-        super_sg_ids = [sg['super_stimulusgroup_id'] if 'super_stimulusgroup_id' in sg else None for sg in self.stimulusgroups]
-        assert all([ssid is None for ssid in super_sg_ids]) or all([ssid is not None for ssid in super_sg_ids]), \
-            f"super_stimulusgroup_id must be all-present or all-absent, but is {super_sg_ids}."
-        if all([ssid is not None for ssid in super_sg_ids]):
-            return super_sg_ids
-        else:
-            return None
+        super_sg_ids = self.get_super_stimulusgroup_ids()
+        return None if super_sg_ids is None else list(super_sg_ids)
 
 
 class ExperimentConfig(object):
 
     def __init__(self,
                  stimulus_config: StimulusConfig,
-                 config: dict):
+                 config: dict,
+                 trusted: bool = False):
         self.stimulus_config: StimulusConfig = stimulus_config
         self.config: dict = config
         assert isinstance(self.config, dict)
-        self._assert()
+        if not trusted:
+            self._assert()
+
+    SUPPORTED_VOTE_SCALES = {
+        'acr': ['THREE_POINT', 'FIVE_POINT', 'SEVEN_POINT', 'ELEVEN_POINT'],
+        'dcr': ['THREE_POINT', 'FIVE_POINT', 'SEVEN_POINT', 'ELEVEN_POINT'],
+        'tafc': ['2AFC'],
+        'ccr': ['CCR_THREE_POINT', 'CCR_FIVE_POINT'],
+        'acr5c': ['0_TO_100'],
+        'samviq': ['0_TO_100'],
+        'samviq5d': ['FIVE_POINT'],
+    }
 
     def _assert(self):
-        assert isinstance(self.title, str)
+        self.validate().raise_if_invalid()
 
-        if self.description is not None:
-            assert isinstance(self.description, str)
+    def validate(self) -> ConfigValidationReport:  # noqa C901
+        """
+        Validate the experiment config against the stimulus config, collecting
+        every violation found into a ConfigValidationReport.
+        """
+        report = ConfigValidationReport()
 
-        assert isinstance(self.rounds_per_session, int)
-        assert self.rounds_per_session >= 1
+        if 'title' not in self.config or not isinstance(self.config['title'], str):
+            report.add('experiment_config', "'title' must be present and be a str")
 
-        assert self.random_seed is None or isinstance(self.random_seed, int)
+        if self.description is not None and not isinstance(self.description, str):
+            report.add('experiment_config', "'description' must be a str")
 
-        from .models import Vote
-        Vote.find_subclass(self.vote_scale)
-
-        assert self.methodology in ['acr', 'acr5c', 'dcr', 'tafc', 'ccr', 'samviq', 'samviq5d']
-        if self.methodology in ['acr', 'acr5c']:
-            for svg in self.stimulus_config.stimulusvotegroups:
-                assert len(svg['stimulus_ids']) == 1
-        elif self.methodology in ['dcr', 'tafc', 'ccr']:
-            for svg in self.stimulus_config.stimulusvotegroups:
-                assert len(svg['stimulus_ids']) == 2
-        elif self.methodology in ['samviq', 'samviq5d']:
-            for svg in self.stimulus_config.stimulusvotegroups:
-                assert len(svg['stimulus_ids']) == 2
-            # must make sure that for each sg, all svgs share the same reference
-            svgs = self.stimulus_config.stimulusvotegroups
-            svg_dict = dict(zip(  # dict: svg_id -> svg
-                [svg['stimulusvotegroup_id'] for svg in svgs], svgs))
-            for sg in self.stimulus_config.stimulusgroups:
-                second_sids = [svg_dict[svg_id]['stimulus_ids'][1]
-                               for svg_id in sg['stimulusvotegroup_ids']]
-                assert len(set(second_sids)) == 1, \
-                    f"all svgs belong to one sg must share the same second " \
-                    f"element in svg['stimulus_ids'], which is the reference:" \
-                    f" {second_sids}"
+        if 'rounds_per_session' not in self.config or not isinstance(self.config['rounds_per_session'], int) \
+                or self.config['rounds_per_session'] < 1:
+            report.add('experiment_config', "'rounds_per_session' must be present and be an int >= 1")
+            rounds_per_session = None
         else:
-            assert False
+            rounds_per_session = self.rounds_per_session
+
+        if not (self.random_seed is None or isinstance(self.random_seed, int)):
+            report.add('experiment_config', "'random_seed' must be None or an int")
 
+        vote_scale = self.config.get('vote_scale')
+        methodology = self.config.get('methodology')
+        from .models import Vote
         try:
-            if self.methodology in ['acr', 'dcr']:
-                assert self.vote_scale in [
-                    'THREE_POINT',
-                    'FIVE_POINT',
-                    'SEVEN_POINT',
-                    'ELEVEN_POINT',
-                ]
-            elif self.methodology == 'tafc':
-                assert self.vote_scale in ['2AFC']
-            elif self.methodology == 'ccr':
-                assert self.vote_scale in ['CCR_THREE_POINT', 'CCR_FIVE_POINT']
-            elif self.methodology == 'acr':
-                assert self.vote_scale in ['FIVE_POINT']
-            elif self.methodology == 'acr5c':
-                assert self.vote_scale in ['0_TO_100']
-            elif self.methodology == 'samviq':
-                assert self.vote_scale in ['0_TO_100']
-            elif self.methodology == 'samviq5d':
-                assert self.vote_scale in ['FIVE_POINT']
-            else:
-                assert False
-        except AssertionError:
-            raise AssertionError(f'Unsupported (methodology, vote_scale): ({self.methodology}, {self.vote_scale})')
+            Vote.find_subclass(vote_scale)
+        except AssertionError as e:
+            report.add('experiment_config', f"invalid 'vote_scale' {vote_scale}: {e}")
 
-        self._assert_blocklist_stimulusgroup_ids()
-        self._assert_training_round_ids()
-        self._assert_prioritized()
-        self._assert_additions()
-        self._assert_round_context()
-        self._assert_done_context()
+        if methodology not in self.SUPPORTED_VOTE_SCALES:
+            report.add('experiment_config', f"unsupported 'methodology': {methodology}")
+        else:
+            if vote_scale not in self.SUPPORTED_VOTE_SCALES[methodology]:
+                report.add('experiment_config', f'Unsupported (methodology, vote_scale): ({methodology}, {vote_scale})')
+            self._validate_methodology_stimulusvotegroups(methodology, report)
+
+        self._validate_blocklist_stimulusgroup_ids(report)
+        self._validate_training_round_ids(rounds_per_session, report)
+        self._validate_prioritized(rounds_per_session, report)
+        self._validate_additions(rounds_per_session, report)
+        self._validate_round_context(report)
+        self._validate_done_context(report)
+
+        return report
+
+    def _validate_methodology_stimulusvotegroups(self, methodology: str, report: ConfigValidationReport):
+        num_stimuli = 1 if methodology in ['acr', 'acr5c'] else 2
+        for idx, svg in enumerate(self.stimulus_config.stimulusvotegroups):
+            if len(svg['stimulus_ids']) != num_stimuli:
+                report.add('stimulusvotegroups', f"methodology {methodology} expects {num_stimuli} "
+                                                 f"stimulus_ids per stimulusvotegroup, but got {svg['stimulus_ids']}", idx)
+        if methodology in ['samviq', 'samviq5d']:
+            # must make sure that for each sg, all svgs share the same reference
+            svg_dict = self.stimulus_config.stimulusvotegroup_dict
+            for idx, sg in enumerate(self.stimulus_config.stimulusgroups):
+                second_sids = [svg_dict[svg_id]['stimulus_ids'][-1]
+                               for svg_id in sg['stimulusvotegroup_ids']]
+                if len(set(second_sids)) != 1:
+                    report.add('stimulusgroups',
+                               f"all svgs belong to one sg must share the same second "
+                               f"element in svg['stimulus_ids'], which is the reference:"
+                               f" {second_sids}", idx)
 
     @property
     def title(self):
@@ -400,37 +677,49 @@ class ExperimentConfig(object):
         return self.config['training_round_ids'] \
             if 'training_round_ids' in self.config else list()
 
-    def _assert_training_round_ids(self):
-        assert isinstance(self.training_round_ids, list)
-        rounds_per_session = self.rounds_per_session
-        for rid in self.training_round_ids:
-            assert 0 <= rid < rounds_per_session
-
-    def _assert_blocklist_stimulusgroup_ids(self):
-        assert isinstance(self.blocklist_stimulusgroup_ids, list)
-        stimulusgroup_ids = self.stimulus_config.stimulusgroup_ids
-        for bsgid in self.blocklist_stimulusgroup_ids:
-            assert isinstance(bsgid, int) and \
-                bsgid in stimulusgroup_ids
-
-    def _assert_prioritized(self):
-        assert isinstance(self.prioritized, list)
-        stimulusgroup_ids = self.stimulus_config.stimulusgroup_ids
-        for d in self.prioritized:
-            assert isinstance(d, dict)
-            assert 'session_idx' in d
-            assert 'round_id' in d
-            assert 'stimulusgroup_id' in d
+    def _validate_training_round_ids(self, rounds_per_session: Optional[int], report: ConfigValidationReport):
+        if not isinstance(self.training_round_ids, list):
+            report.add('training_round_ids', 'must be a list')
+            return
+        if rounds_per_session is None:
+            return
+        for idx, rid in enumerate(self.training_round_ids):
+            if not (isinstance(rid, int) and 0 <= rid < rounds_per_session):
+                report.add('training_round_ids', f'round_id {rid} must be in [0, {rounds_per_session})', idx)
+
+    def _validate_blocklist_stimulusgroup_ids(self, report: ConfigValidationReport):
+        if not isinstance(self.blocklist_stimulusgroup_ids, list):
+            report.add('blocklist_stimulusgroup_ids', 'must be a list')
+            return
+        stimulusgroup_dict = self.stimulus_config.stimulusgroup_dict
+        for idx, bsgid in enumerate(self.blocklist_stimulusgroup_ids):
+            if not (isinstance(bsgid, int) and bsgid in stimulusgroup_dict):
+                report.add('blocklist_stimulusgroup_ids', f'stimulusgroup_id {bsgid} not found in stimulusgroups', idx)
+
+    def _validate_prioritized(self, rounds_per_session: Optional[int], report: ConfigValidationReport):
+        if not isinstance(self.prioritized, list):
+            report.add('prioritized', 'must be a list')
+            return
+        stimulusgroup_dict = self.stimulus_config.stimulusgroup_dict
+        for idx, d in enumerate(self.prioritized):
+            if not isinstance(d, dict):
+                report.add('prioritized', 'must be a dict', idx)
+                continue
+            missing_keys = [key for key in ['session_idx', 'round_id', 'stimulusgroup_id'] if key not in d]
+            if len(missing_keys) > 0:
+                report.add('prioritized', f'missing {missing_keys}', idx)
+                continue
             session_idx = d['session_idx']
             round_id = d['round_id']
             stimulusgroup_id = d['stimulusgroup_id']
-            assert session_idx is None or \
-                   (isinstance(session_idx, int) and session_idx >= 0)
-            assert round_id is None or \
-                   (isinstance(round_id, int) and
-                    0 <= round_id < self.rounds_per_session)
-            assert isinstance(stimulusgroup_id, int) and \
-                   stimulusgroup_id in stimulusgroup_ids
+            if not (session_idx is None or (isinstance(session_idx, int) and session_idx >= 0)):
+                report.add('prioritized', f'session_idx must be None or a non-negative int, but is {session_idx}', idx)
+            if not (round_id is None or
+                    (isinstance(round_id, int) and
+                     (rounds_per_session is None or 0 <= round_id < rounds_per_session))):
+                report.add('prioritized', f'round_id must be None or in [0, {rounds_per_session}), but is {round_id}', idx)
+            if not (isinstance(stimulusgroup_id, int) and stimulusgroup_id in stimulusgroup_dict):
+                report.add('prioritized', f'stimulusgroup_id {stimulusgroup_id} not found in stimulusgroups', idx)
 
     @property
     def additions(self):
@@ -459,48 +748,286 @@ class ExperimentConfig(object):
         return self.config['done_context'] \
             if 'done_context' in self.config else dict()
 
-    def _assert_additions(self):
-        assert isinstance(self.additions, list), f'expect self.additions to be a list, but is: {self.additions}'
-        for addition in self.additions:
-            assert 'position' in addition
-            assert 'round_id' in addition['position']
-            assert isinstance(addition['position']['round_id'], int)
-            assert 0 <= addition['position']['round_id'] < self.rounds_per_session
-            assert 'before_or_after' in addition['position']
-            assert addition['position']['before_or_after'] in ['before', 'after']
-            assert 'context' in addition or 'super_stimulusgroup_context_list' in addition
+    def _validate_additions(self, rounds_per_session: Optional[int], report: ConfigValidationReport):  # noqa C901
+        if not isinstance(self.additions, list):
+            report.add('additions', f'expect self.additions to be a list, but is: {self.additions}')
+            return
+        for idx, addition in enumerate(self.additions):
+            if not isinstance(addition, dict):
+                report.add('additions', 'must be a dict', idx)
+                continue
+            position = addition.get('position')
+            if not isinstance(position, dict):
+                report.add('additions', "missing 'position'", idx)
+            else:
+                round_id = position.get('round_id')
+                if not (isinstance(round_id, int) and
+                        (rounds_per_session is None or 0 <= round_id < rounds_per_session)):
+                    report.add('additions', f'position round_id must be in [0, {rounds_per_session}), but is {round_id}', idx)
+                if position.get('before_or_after') not in ['before', 'after']:
+                    report.add('additions', "position before_or_after must be 'before' or 'after'", idx)
             if 'context' in addition:
-                assert 'title' in addition['context']
-                assert 'text_html' in addition['context']
-                assert 'actions_html' in addition['context']
-                assert '{action_url}' in addition['context']['actions_html'], \
-                    "expect '{action_url}' in actions_html as template to be" \
-                    "filled during page rendering"
+                self._validate_addition_context(addition['context'], idx, report)
             elif 'super_stimulusgroup_context_list' in addition:
-                assert isinstance(addition['super_stimulusgroup_context_list'], list)
+                if not isinstance(addition['super_stimulusgroup_context_list'], list):
+                    report.add('additions', 'super_stimulusgroup_context_list must be a list', idx)
+                    continue
                 for context in addition['super_stimulusgroup_context_list']:
-                    assert 'title' in context
-                    assert 'text_html' in context
-                    assert 'actions_html' in context
-                    assert '{action_url}' in context['actions_html'], \
-                        "expect '{action_url}' in actions_html as template to be" \
-                        "filled during page rendering"
+                    self._validate_addition_context(context, idx, report)
                 # also need to assess that stimulusgroups each has super_stimulusgroup_id
                 # and that the indices matches super_stimulusgroup_context_list
+                super_stimulusgroup_ids = set()
                 for stimulusgroup in self.stimulus_config.stimulusgroups:
-                    assert 'super_stimulusgroup_id' in stimulusgroup
-                    assert isinstance(stimulusgroup['super_stimulusgroup_id'], int)
-                super_stimulusgroup_ids = sorted(list(set([stimulusgroup['super_stimulusgroup_id'] for stimulusgroup in self.stimulus_config.stimulusgroups])))  # noqa E501
-                assert len(super_stimulusgroup_ids) == len(addition['super_stimulusgroup_context_list']), \
-                    f"expect the number of super_stimulusgroup_ids to match the number of super_stimulusgroup_context_list, but got: {super_stimulusgroup_ids} vs {addition['super_stimulusgroup_context_list']}"  # noqa E501
-                assert super_stimulusgroup_ids == list(range(len(super_stimulusgroup_ids))), f"expect super_stimulusgroup_ids is in the form of {list(range(len(super_stimulusgroup_ids)))}, but got: {super_stimulusgroup_ids}"  # noqa E501
-
-    def _assert_round_context(self):
-        assert isinstance(self.round_context, dict)
+                    if not isinstance(stimulusgroup.get('super_stimulusgroup_id'), int):
+                        report.add('additions', f"expect every stimulusgroup to have an int super_stimulusgroup_id, "
+                                                f"but stimulusgroup {stimulusgroup['stimulusgroup_id']} does not", idx)
+                        break
+                    super_stimulusgroup_ids.add(stimulusgroup['super_stimulusgroup_id'])
+                else:
+                    super_stimulusgroup_ids = sorted(super_stimulusgroup_ids)
+                    if len(super_stimulusgroup_ids) != len(addition['super_stimulusgroup_context_list']):
+                        report.add('additions', f"expect the number of super_stimulusgroup_ids to match the number of super_stimulusgroup_context_list, but got: {super_stimulusgroup_ids} vs {addition['super_stimulusgroup_context_list']}", idx)  # noqa E501
+                    if super_stimulusgroup_ids != list(range(len(super_stimulusgroup_ids))):
+                        report.add('additions', f"expect super_stimulusgroup_ids is in the form of {list(range(len(super_stimulusgroup_ids)))}, but got: {super_stimulusgroup_ids}", idx)  # noqa E501
+            else:
+                report.add('additions', "missing 'context' or 'super_stimulusgroup_context_list'", idx)
+
+    @staticmethod
+    def _validate_addition_context(context: dict, idx: int, report: ConfigValidationReport):
+        for key in ['title', 'text_html', 'actions_html']:
+            if key not in context:
+                report.add('additions', f"missing '{key}' in context", idx)
+        if 'actions_html' in context and '{action_url}' not in context['actions_html']:
+            report.add('additions', "expect '{action_url}' in actions_html as template to be "
+                                    "filled during page rendering", idx)
+
+    def _validate_round_context(self, report: ConfigValidationReport):
+        if not isinstance(self.round_context, dict):
+            report.add('round_context', 'must be a dict')
         # leave other assertions to the Page initialization stage
 
-    def _assert_done_context(self):
-        assert isinstance(self.done_context, dict)
-        if 'text_html' in self.done_context:
-            assert validate_xml(self.done_context['text_html']), \
-                f"invalid html: {self.done_context['text_html']}"
+    def _validate_done_context(self, report: ConfigValidationReport):
+        if not isinstance(self.done_context, dict):
+            report.add('done_context', 'must be a dict')
+            return
+        if 'text_html' in self.done_context and not validate_xml(self.done_context['text_html']):
+            report.add('done_context', f"invalid html: {self.done_context['text_html']}")
+
+
+class ValidationCertificate(object):
+    """
+    Record, stored next to a config file, that the config has passed full
+    validation. A loader can skip re-validating the config as long as its
+    content hash matches the certificate.
+    """
+
+    # bump whenever the validation rules change, to invalidate the
+    # certificates issued by older validators
+    VALIDATOR_VERSION = 1
+
+    SUFFIX = '.cert'
+
+    def __init__(self,
+                 content_hash: str,
+                 validator_version: int,
+                 path_check_timestamp: Optional[float]):
+        self.content_hash = content_hash
+        self.validator_version = validator_version
+        self.path_check_timestamp = path_check_timestamp
+
+    @classmethod
+    def get_filepath(cls, config_filepath: str) -> str:
+        return config_filepath + cls.SUFFIX
+
+    @staticmethod
+    def hash_content(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def to_dict(self) -> dict:
+        return {
+            'content_hash': self.content_hash,
+            'validator_version': self.validator_version,
+            'path_check_timestamp': self.path_check_timestamp,
+        }
+
+    @classmethod
+    def issue(cls, config_filepath: str, data: bytes, path_checked: bool) -> 'ValidationCertificate':
+        """
+        Write the certificate of config_filepath, whose validated content is
+        data. path_checked tells if the media paths were verified.
+        """
+        cert = cls(content_hash=cls.hash_content(data),
+                   validator_version=cls.VALIDATOR_VERSION,
+                   path_check_timestamp=time.time() if path_checked else None)
+        cert_filepath = cls.get_filepath(config_filepath)
+        tmp_filepath = f'{cert_filepath}.{os.getpid()}.tmp'
+        with open(tmp_filepath, 'wt') as fp:
+            json.dump(cert.to_dict(), fp, indent=4)
+        os.replace(tmp_filepath, cert_filepath)
+        return cert
+
+    @classmethod
+    def load(cls, config_filepath: str) -> Optional['ValidationCertificate']:
+        """
+        Return the certificate of config_filepath, or None if there is none
+        or it cannot be read.
+        """
+        try:
+            with open(cls.get_filepath(config_filepath), 'rt') as fp:
+                d = json.load(fp)
+            return cls(content_hash=d['content_hash'],
+                       validator_version=d['validator_version'],
+                       path_check_timestamp=d['path_check_timestamp'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    @classmethod
+    def remove(cls, config_filepath: str):
+        cert_filepath = cls.get_filepath(config_filepath)
+        if os.path.exists(cert_filepath):
+            os.remove(cert_filepath)
+
+    def vouches_for(self, content_hash: str, skip_path_check: bool = False) -> bool:
+        if self.validator_version != self.VALIDATOR_VERSION:
+            return False
+        if not skip_path_check and self.path_check_timestamp is None:
+            return False
+        return self.content_hash == content_hash
+
+
+class ExperimentConfigCache(object):
+    """
+    Process-wide LRU cache of compiled (i.e. parsed and validated)
+    ExperimentConfig objects, keyed by experiment title.
+
+    An entry is considered fresh as long as the config file's (mtime, size)
+    signature is unchanged, in which case the file is not opened at all. If the
+    signature changes, the file is re-read and its content hash compared: an
+    unchanged hash (e.g. the file was touched or rewritten with the same
+    content) refreshes the signature without re-validating; a changed hash
+    recompiles the entry.
+
+    The memory budget is approximated by the size of the JSON files of the
+    cached entries. Least recently used entries are evicted once the budget
+    is exceeded.
+    """
+
+    DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+    class _Entry(object):
+        def __init__(self, filepath, signature, digest, nbytes, experiment_config):
+            self.filepath: str = filepath
+            self.signature: tuple = signature
+            self.digest: str = digest
+            self.nbytes: int = nbytes
+            self.experiment_config: ExperimentConfig = experiment_config
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def get_signature(filepath: str) -> tuple:
+        st = os.stat(filepath)
+        return st.st_mtime_ns, st.st_size
+
+    @staticmethod
+    def compile(config: dict, **more) -> ExperimentConfig:
+        assert isinstance(config, dict)
+        assert 'stimulus_config' in config
+        assert 'experiment_config' in config
+        scfg = StimulusConfig(config['stimulus_config'], **more)
+        return ExperimentConfig(stimulus_config=scfg,
+                                config=config['experiment_config'],
+                                trusted='trusted' in more and more['trusted'] is True)
+
+    def get(self, experiment_title: str, config_filepath: str, **more) -> ExperimentConfig:
+        """
+        Return the compiled ExperimentConfig of experiment_title stored at
+        config_filepath. Keyword arguments in more (e.g. skip_path_check) are
+        passed on to StimulusConfig, and are part of the cache key. If the
+        ConfigSnapshot next to the file was compiled from its content, the
+        snapshot is mapped instead; else if the ValidationCertificate next to the file
+        vouches for its content, the config is compiled without re-validation.
+        Whether the config is trusted is up to the snapshot and certificate, so
+        a trusted in more is ignored.
+        """
+        more = {k: v for k, v in more.items() if k != 'trusted'}
+        key = (experiment_title, tuple(sorted(more.items())))
+        signature = self.get_signature(config_filepath)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.filepath == config_filepath and entry.signature == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.experiment_config
+
+        with open(config_filepath, 'rb') as fp:
+            data = fp.read()
+        digest = ValidationCertificate.hash_content(data)
+        nbytes = len(data)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.filepath == config_filepath and entry.digest == digest:
+                entry.signature = signature
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.experiment_config
+            self.misses += 1
+
+        skip_path_check = 'skip_path_check' in more and more['skip_path_check'] is True
+        snapshot = ConfigSnapshot.load(config_filepath)
+        if snapshot is not None and snapshot.vouches_for(
+                signature, digest, ValidationCertificate.VALIDATOR_VERSION, skip_path_check=skip_path_check):
+            # fast path: map the compiled snapshot instead of parsing the json
+            ecfg = self.compile(snapshot.config, trusted=True, **more)
+        else:
+            cert = ValidationCertificate.load(config_filepath)
+            trusted = cert is not None and cert.vouches_for(digest, skip_path_check=skip_path_check)
+            ecfg = self.compile(json.loads(data), trusted=trusted, **more)
+
+        with self._lock:
+            self._remove(key)
+            if nbytes <= self.max_bytes:
+                self._entries[key] = self._Entry(config_filepath, signature, digest, nbytes, ecfg)
+                self.current_bytes += nbytes
+                while self.current_bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.current_bytes -= evicted.nbytes
+                    self.evictions += 1
+        return ecfg
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry.nbytes
+
+    def invalidate(self, experiment_title: Optional[str] = None):
+        """
+        Drop the entries of experiment_title, or all entries if None.
+        """
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if experiment_title is None or key[0] == experiment_title:
+                    self._remove(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+media_path_verifier = MediaPathVerifier()
+experiment_config_cache = ExperimentConfigCache()
@@ -0,0 +1,229 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+
+from .config import experiment_config_cache, ExperimentConfig, ExperimentConfigCache, NestConfig, ValidationCertificate
+from .snapshot import ConfigSnapshot
+
+
+class ExperimentConfigStorage(object):
+    """
+    Abstract storage of the config of each Experiment. The config is saved
+    once validated, at experiment creation; loading returns the compiled
+    ExperimentConfig, cached per process.
+    """
+
+    def exists(self, experiment_title: str, is_test: bool = False) -> bool:
+        raise NotImplementedError
+
+    def load(self, experiment_title: str, is_test: bool = False, **more) -> ExperimentConfig:
+        """
+        Return the compiled ExperimentConfig of experiment_title. Keyword
+        arguments in more (e.g. skip_path_check) are passed on to
+        StimulusConfig.
+        """
+        raise NotImplementedError
+
+    def load_dict(self, experiment_title: str, is_test: bool = False) -> dict:
+        """
+        Return the config of experiment_title as a plain dict.
+        """
+        raise NotImplementedError
+
+    def save(self, experiment, config: dict, path_checked: bool, is_test: bool = False):
+        """
+        Store the already-validated config of experiment, an Experiment.
+        path_checked tells if the media paths were verified during validation.
+        """
+        raise NotImplementedError
+
+    def delete(self, experiment_title: str, is_test: bool = False):
+        raise NotImplementedError
+
+    @staticmethod
+    def dumps(config: dict) -> bytes:
+        return json.dumps(config, indent=4).encode('utf-8')
+
+
+class FileExperimentConfigStorage(ExperimentConfigStorage):
+    """
+    Store each config as media/experiment_config/<title>.json, next to its
+    ValidationCertificate and ConfigSnapshot. Every web node needs to see the
+    same media directory.
+    """
+
+    @staticmethod
+    def get_filepath(experiment_title: str, is_test: bool = False) -> str:
+        if is_test:
+            return NestConfig.tests_workdir_path(
+                'media', 'experiment_config', f"{experiment_title}.json")
+        else:
+            return NestConfig.media_path(
+                'experiment_config', f"{experiment_title}.json")
+
+    def exists(self, experiment_title: str, is_test: bool = False) -> bool:
+        return os.path.exists(self.get_filepath(experiment_title, is_test))
+
+    def load(self, experiment_title: str, is_test: bool = False, **more) -> ExperimentConfig:
+        return experiment_config_cache.get(experiment_title, self.get_filepath(experiment_title, is_test), **more)
+
+    def load_dict(self, experiment_title: str, is_test: bool = False) -> dict:
+        with open(self.get_filepath(experiment_title, is_test), 'rt') as fp:
+            return json.load(fp)
+
+    def save(self, experiment, config: dict, path_checked: bool, is_test: bool = False):
+        config_filepath = self.get_filepath(experiment.title, is_test)
+        os.makedirs(os.path.dirname(config_filepath), exist_ok=True)
+        data = self.dumps(config)
+        with open(config_filepath, 'wb') as fp:
+            fp.write(data)
+        cert = ValidationCertificate.issue(config_filepath, data, path_checked=path_checked)
+        ConfigSnapshot.write(config_filepath, config,
+                             source_signature=ExperimentConfigCache.get_signature(config_filepath),
+                             content_hash=cert.content_hash,
+                             validator_version=cert.validator_version,
+                             path_check_timestamp=cert.path_check_timestamp)
+
+    def delete(self, experiment_title: str, is_test: bool = False):
+        config_filepath = self.get_filepath(experiment_title, is_test)
+        os.remove(config_filepath)
+        ValidationCertificate.remove(config_filepath)
+        ConfigSnapshot.remove(config_filepath)
+        experiment_config_cache.invalidate(experiment_title)
+
+
+class DatabaseExperimentConfigStorage(ExperimentConfigStorage):
+    """
+    Store each config as an ExperimentConfigVersion row, so that web nodes
+    need no shared disk. Saving adds a new version; loading reads the latest
+    version number with one indexed query, and only fetches and compiles the
+    config if that version is not yet in the per-process cache. is_test is
+    ignored, since the test DB is already separate.
+
+    The models are imported locally, since this module is loaded by
+    NestSite before the app registry is ready.
+    """
+
+    DEFAULT_MAX_ENTRIES = 32
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _get_latest(experiment_title: str) -> Optional[tuple]:
+        from .models import ExperimentConfigVersion
+        return ExperimentConfigVersion.objects \
+            .filter(experiment__title=experiment_title) \
+            .order_by('-version') \
+            .values_list('id', 'version', 'content_hash', 'validator_version', 'path_check_date') \
+            .first()
+
+    def exists(self, experiment_title: str, is_test: bool = False) -> bool:
+        from .models import ExperimentConfigVersion
+        return ExperimentConfigVersion.objects.filter(experiment__title=experiment_title).exists()
+
+    def load(self, experiment_title: str, is_test: bool = False, **more) -> ExperimentConfig:
+        from .models import ExperimentConfigVersion
+        latest = self._get_latest(experiment_title)
+        if latest is None:
+            raise ExperimentConfigVersion.DoesNotExist(f"no config stored for experiment {experiment_title}")
+        pk, version, content_hash, validator_version, path_check_date = latest
+        key = (experiment_title, version, content_hash, tuple(sorted(more.items())))
+        with self._lock:
+            ecfg = self._entries.get(key)
+            if ecfg is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return ecfg
+            self.misses += 1
+
+        content = ExperimentConfigVersion.objects.values_list('content', flat=True).get(id=pk)
+        skip_path_check = 'skip_path_check' in more and more['skip_path_check'] is True
+        trusted = validator_version == ValidationCertificate.VALIDATOR_VERSION and \
+            (skip_path_check or path_check_date is not None)
+        ecfg = ExperimentConfigCache.compile(json.loads(content), trusted=trusted, **more)
+
+        with self._lock:
+            # older versions of the same experiment are never read again
+            for k in [k for k in self._entries if k[0] == experiment_title and k[1] < version]:
+                del self._entries[k]
+            self._entries[key] = ecfg
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return ecfg
+
+    def load_dict(self, experiment_title: str, is_test: bool = False) -> dict:
+        from .models import ExperimentConfigVersion
+        content = ExperimentConfigVersion.objects \
+            .filter(experiment__title=experiment_title) \
+            .order_by('-version') \
+            .values_list('content', flat=True) \
+            .first()
+        if content is None:
+            raise ExperimentConfigVersion.DoesNotExist(f"no config stored for experiment {experiment_title}")
+        return json.loads(content)
+
+    def save(self, experiment, config: dict, path_checked: bool, is_test: bool = False):
+        from .models import ExperimentConfigVersion
+        data = self.dumps(config)
+        latest_version = ExperimentConfigVersion.objects \
+            .filter(experiment=experiment) \
+            .aggregate(Max('version'))['version__max']
+        ExperimentConfigVersion.objects.create(
+            experiment=experiment,
+            version=1 if latest_version is None else latest_version + 1,
+            content=data.decode('utf-8'),
+            content_hash=ValidationCertificate.hash_content(data),
+            validator_version=ValidationCertificate.VALIDATOR_VERSION,
+            path_check_date=timezone.now() if path_checked else None)
+
+    def delete(self, experiment_title: str, is_test: bool = False):
+        from .models import ExperimentConfigVersion
+        ExperimentConfigVersion.objects.filter(experiment__title=experiment_title).delete()
+        self.invalidate(experiment_title)
+
+    def invalidate(self, experiment_title: Optional[str] = None):
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if experiment_title is None or key[0] == experiment_title:
+                    del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+EXPERIMENT_CONFIG_STORAGES = {
+    'file': FileExperimentConfigStorage,
+    'database': DatabaseExperimentConfigStorage,
+}
+
+_experiment_config_storages = dict()
+
+
+def get_experiment_config_storage() -> ExperimentConfigStorage:
+    """
+    Return the process-wide storage selected by the EXPERIMENT_CONFIG_STORAGE
+    setting, 'file' by default.
+    """
+    name = getattr(settings, 'EXPERIMENT_CONFIG_STORAGE', 'file')
+    assert name in EXPERIMENT_CONFIG_STORAGES, \
+        f"EXPERIMENT_CONFIG_STORAGE must be one of {list(EXPERIMENT_CONFIG_STORAGES.keys())}, but is {name}"
+    if name not in _experiment_config_storages:
+        _experiment_config_storages[name] = EXPERIMENT_CONFIG_STORAGES[name]()
+    return _experiment_config_storages[name]
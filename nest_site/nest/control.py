@@ -1,13 +1,29 @@
+import csv
+import hashlib
+import json
+import logging
+import os
 import random
+import sqlite3
+import time
 from enum import Enum
-from typing import List, Optional
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, TextIO, Tuple
 
 import pandas
-from django.db import transaction
-from nest.config import ExperimentConfig
-from nest.helpers import memoized, my_argmin
-from nest.models import Content, Experiment, Round, Session, Stimulus, \
-    StimulusGroup, StimulusVoteGroup, Subject, Vote
+from django.db import IntegrityError, OperationalError, transaction
+from django.db.models import Count, F, Q, QuerySet, Sum
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from nest.config import ExperimentConfig, StimulusConfig
+from nest.helpers import instance_memoized, LeastWeightCandidates
+from nest.models import Content, Experiment, Round, Session, Stimulus, StimulusGroup, StimulusGroupExposure, \
+    StimulusVoteGroup, Subject, SubjectStimulusGroupExposure, Vote, VoteRegister
+
+logging.basicConfig()
+logger = logging.getLogger(os.path.splitext(os.path.basename(__file__))[0])
+logger.setLevel('INFO')
 
 
 class SessionStatus(Enum):
@@ -35,6 +51,205 @@ class SessionStatus(Enum):
     FINISHED = 5
 
 
+class StimulusConfigDiff(object):
+    """
+    Difference between a StimulusConfig and the Content, Stimulus,
+    StimulusVoteGroup and StimulusGroup objects of an Experiment in the DB.
+    For each of the four sections, lists the ids to insert, to update
+    (including reactivating a deactivated object) and to deactivate. Objects
+    are deactivated instead of deleted, so that the history is kept.
+
+    A change is a conflict if it would orphan existing votes or rounds:
+    deactivating or changing the stimuli of a StimulusVoteGroup with votes,
+    moving it to another StimulusGroup, changing the Content of a Stimulus
+    in such a StimulusVoteGroup, or deactivating a StimulusGroup that rounds
+    of existing sessions refer to. A diff with conflicts cannot be applied.
+    """
+
+    SECTIONS = ['contents', 'stimuli', 'stimulusvotegroups', 'stimulusgroups']
+
+    def __init__(self, experiment: Experiment, stimulus_config: StimulusConfig):
+        self.experiment = experiment
+        self.stimulus_config = stimulus_config
+        self.inserts = {section: list() for section in self.SECTIONS}
+        self.updates = {section: list() for section in self.SECTIONS}
+        self.deactivations = {section: list() for section in self.SECTIONS}
+        self.conflicts: List[str] = list()
+        self._load()
+        self._compute()
+
+    def _load(self):
+        experiment = self.experiment
+        self.db_contents = {c.content_id: c for c in Content.objects.filter(experiment=experiment)}
+        self.db_stimuli = {s.stimulus_id: s for s in Stimulus.objects.filter(experiment=experiment)}
+        self.db_stimulusvotegroups = {svg.stimulusvotegroup_id: svg for svg in StimulusVoteGroup.objects.filter(experiment=experiment)}
+        self.db_stimulusgroups = {sg.stimulusgroup_id: sg for sg in StimulusGroup.objects.filter(experiment=experiment)}
+
+        content_pk_to_id = {c.pk: c.content_id for c in self.db_contents.values()}
+        self.db_stimulus_content_ids = {s.stimulus_id: content_pk_to_id.get(s.content_id) for s in self.db_stimuli.values()}
+        stimulus_pk_to_id = {s.pk: s.stimulus_id for s in self.db_stimuli.values()}
+        stimulusgroup_pk_to_id = {sg.pk: sg.stimulusgroup_id for sg in self.db_stimulusgroups.values()}
+        svg_pk_to_id = {svg.pk: svg.stimulusvotegroup_id for svg in self.db_stimulusvotegroups.values()}
+        self.db_svg_stimulusgroup_ids = {svg.stimulusvotegroup_id: stimulusgroup_pk_to_id.get(svg.stimulusgroup_id)
+                                         for svg in self.db_stimulusvotegroups.values()}
+        self.db_svg_stimulus_ids = {svgid: list() for svgid in self.db_stimulusvotegroups}
+        for svg_pk, stimulus_pk in VoteRegister.objects \
+                .filter(stimulusvotegroup__experiment=experiment) \
+                .order_by('stimulus_order') \
+                .values_list('stimulusvotegroup_id', 'stimulus_id'):
+            self.db_svg_stimulus_ids[svg_pk_to_id[svg_pk]].append(stimulus_pk_to_id[stimulus_pk])
+
+        self.voted_svgids = {svg_pk_to_id[pk] for pk in Vote.objects
+                             .filter(stimulusvotegroup__experiment=experiment)
+                             .values_list('stimulusvotegroup_id', flat=True).distinct()}
+        self.round_sgids = {stimulusgroup_pk_to_id[pk] for pk in Round.objects
+                            .filter(stimulusgroup__experiment=experiment)
+                            .values_list('stimulusgroup_id', flat=True).distinct()}
+
+    def _diff_section(self, section: str, new_ids, db_objects: dict, is_changed):
+        new_ids = set(new_ids)
+        for i in sorted(new_ids):
+            if i not in db_objects:
+                self.inserts[section].append(i)
+            elif not db_objects[i].is_active or is_changed(i):
+                self.updates[section].append(i)
+        for i, obj in sorted(db_objects.items(), key=lambda kv: kv[0]):
+            if i not in new_ids and obj.is_active:
+                self.deactivations[section].append(i)
+
+    def _compute(self):
+        scfg = self.stimulus_config
+        new_stimulus_content_ids = {s['stimulus_id']: s['content_id'] for s in scfg.stimuli}
+        new_svg_stimulus_ids = {svg['stimulusvotegroup_id']: list(svg['stimulus_ids']) for svg in scfg.stimulusvotegroups}
+        self.new_svg_stimulusgroup_ids = dict()
+        for sg in scfg.stimulusgroups:
+            for svgid in sg['stimulusvotegroup_ids']:
+                self.new_svg_stimulusgroup_ids[svgid] = sg['stimulusgroup_id']
+        self.new_stimulus_content_ids = new_stimulus_content_ids
+        self.new_svg_stimulus_ids = new_svg_stimulus_ids
+
+        self._diff_section('contents', scfg.get_ids('contents'), self.db_contents, lambda i: False)
+        self._diff_section('stimuli', scfg.get_ids('stimuli'), self.db_stimuli,
+                           lambda i: self.db_stimulus_content_ids[i] != new_stimulus_content_ids[i])
+        self._diff_section('stimulusvotegroups', scfg.get_ids('stimulusvotegroups'), self.db_stimulusvotegroups,
+                           lambda i: self.db_svg_stimulus_ids[i] != new_svg_stimulus_ids[i] or
+                           self.db_svg_stimulusgroup_ids[i] != self.new_svg_stimulusgroup_ids.get(i))
+        self._diff_section('stimulusgroups', scfg.get_ids('stimulusgroups'), self.db_stimulusgroups, lambda i: False)
+
+        voted_stimulus_ids = set()
+        for svgid in self.voted_svgids:
+            voted_stimulus_ids.update(self.db_svg_stimulus_ids[svgid])
+        for sid in self.updates['stimuli'] + self.deactivations['stimuli']:
+            if sid in voted_stimulus_ids and new_stimulus_content_ids.get(sid) != self.db_stimulus_content_ids[sid]:
+                self.conflicts.append(f"stimulus {sid} is in a stimulusvotegroup with votes, "
+                                      f"and cannot change content or be removed")
+        for svgid in self.deactivations['stimulusvotegroups']:
+            if svgid in self.voted_svgids:
+                self.conflicts.append(f"stimulusvotegroup {svgid} has votes, and cannot be removed")
+        for svgid in self.updates['stimulusvotegroups']:
+            if svgid in self.voted_svgids:
+                if self.db_svg_stimulus_ids[svgid] != new_svg_stimulus_ids[svgid]:
+                    self.conflicts.append(f"stimulusvotegroup {svgid} has votes, and cannot change its stimulus_ids")
+                if self.db_svg_stimulusgroup_ids[svgid] != self.new_svg_stimulusgroup_ids.get(svgid):
+                    self.conflicts.append(f"stimulusvotegroup {svgid} has votes, and cannot change its stimulusgroup")
+        for sgid in self.deactivations['stimulusgroups']:
+            if sgid in self.round_sgids:
+                self.conflicts.append(f"stimulusgroup {sgid} is used by rounds of existing sessions, and cannot be removed")
+
+    @property
+    def is_empty(self) -> bool:
+        return all(len(self.inserts[section]) == 0 and len(self.updates[section]) == 0 and
+                   len(self.deactivations[section]) == 0 for section in self.SECTIONS)
+
+    def to_dict(self) -> dict:
+        d = {
+            section: {
+                'inserts': self.inserts[section],
+                'updates': self.updates[section],
+                'deactivations': self.deactivations[section],
+            } for section in self.SECTIONS
+        }
+        d['conflicts'] = self.conflicts
+        return d
+
+    def __str__(self):
+        lines = [f"{section}: {len(self.inserts[section])} insert(s), {len(self.updates[section])} update(s), "
+                 f"{len(self.deactivations[section])} deactivation(s)" for section in self.SECTIONS]
+        lines += [f"conflict: {c}" for c in self.conflicts]
+        return '\n'.join(lines)
+
+    def apply(self):
+        """
+        Apply the diff to the DB in bulk. Must be called within a transaction.
+        """
+        assert len(self.conflicts) == 0, \
+            'refuse to apply a config change that would orphan existing votes or rounds:\n' + \
+            '\n'.join(self.conflicts)
+        experiment = self.experiment
+        now = timezone.now()
+
+        # contents
+        Content.objects.bulk_create([
+            Content(experiment=experiment, content_id=cid) for cid in self.inserts['contents']])
+        self._reactivate(Content, self.db_contents, self.updates['contents'], [])
+        self._deactivate(self.db_contents, self.deactivations['contents'], now)
+        contents = {c.content_id: c for c in Content.objects.filter(experiment=experiment)}
+
+        # stimuli
+        Stimulus.objects.bulk_create([
+            Stimulus(experiment=experiment, stimulus_id=sid, content=contents[self.new_stimulus_content_ids[sid]])
+            for sid in self.inserts['stimuli']])
+        for sid in self.updates['stimuli']:
+            self.db_stimuli[sid].content = contents[self.new_stimulus_content_ids[sid]]
+        self._reactivate(Stimulus, self.db_stimuli, self.updates['stimuli'], ['content'])
+        self._deactivate(self.db_stimuli, self.deactivations['stimuli'], now)
+        stimuli = {s.stimulus_id: s for s in Stimulus.objects.filter(experiment=experiment)}
+
+        # stimulusgroups
+        StimulusGroup.objects.bulk_create([
+            StimulusGroup(experiment=experiment, stimulusgroup_id=sgid) for sgid in self.inserts['stimulusgroups']])
+        self._reactivate(StimulusGroup, self.db_stimulusgroups, self.updates['stimulusgroups'], [])
+        self._deactivate(self.db_stimulusgroups, self.deactivations['stimulusgroups'], now)
+        stimulusgroups = {sg.stimulusgroup_id: sg for sg in StimulusGroup.objects.filter(experiment=experiment)}
+
+        # stimulusvotegroups, detaching the deactivated ones from their
+        # stimulusgroup so that they no longer count in session status
+        StimulusVoteGroup.objects.bulk_create([
+            StimulusVoteGroup(experiment=experiment, stimulusvotegroup_id=svgid,
+                              stimulusgroup=stimulusgroups.get(self.new_svg_stimulusgroup_ids.get(svgid)))
+            for svgid in self.inserts['stimulusvotegroups']])
+        for svgid in self.updates['stimulusvotegroups']:
+            self.db_stimulusvotegroups[svgid].stimulusgroup = stimulusgroups.get(self.new_svg_stimulusgroup_ids.get(svgid))
+        self._reactivate(StimulusVoteGroup, self.db_stimulusvotegroups, self.updates['stimulusvotegroups'], ['stimulusgroup'])
+        StimulusVoteGroup.objects \
+            .filter(pk__in=[self.db_stimulusvotegroups[svgid].pk for svgid in self.deactivations['stimulusvotegroups']]) \
+            .update(deactivate_date=now, stimulusgroup=None)
+        stimulusvotegroups = {svg.stimulusvotegroup_id: svg for svg in StimulusVoteGroup.objects.filter(experiment=experiment)}
+
+        # stimulus orders of the new stimulusvotegroups, and of those whose
+        # stimulus_ids changed
+        changed_svgids = [svgid for svgid in self.updates['stimulusvotegroups']
+                          if self.db_svg_stimulus_ids[svgid] != self.new_svg_stimulus_ids[svgid]]
+        VoteRegister.objects \
+            .filter(stimulusvotegroup__in=[stimulusvotegroups[svgid] for svgid in changed_svgids]) \
+            .delete()
+        VoteRegister.objects.bulk_create([
+            VoteRegister(stimulusvotegroup=stimulusvotegroups[svgid], stimulus=stimuli[sid], stimulus_order=order)
+            for svgid in self.inserts['stimulusvotegroups'] + changed_svgids
+            for order, sid in enumerate(self.new_svg_stimulus_ids[svgid], start=1)])
+
+    @staticmethod
+    def _reactivate(model, db_objects: dict, ids: list, fields: List[str]):
+        for i in ids:
+            db_objects[i].deactivate_date = None
+        model.objects.bulk_update([db_objects[i] for i in ids], fields + ['deactivate_date'])
+
+    @staticmethod
+    def _deactivate(db_objects: dict, ids: list, now):
+        if len(ids) > 0:
+            type(db_objects[ids[0]]).objects.filter(pk__in=[db_objects[i].pk for i in ids]).update(deactivate_date=now)
+
+
 class ExperimentController(object):
     """Controller of the business logic of an Experiment."""
 
@@ -72,121 +287,215 @@ class ExperimentController(object):
                 stimulusgroups.append(sg)
         return stimulusgroups
 
+    @transaction.atomic
     def populate_stimuli(self):
         """
         populate Content, Stimulus, StimulusVoteGroup and StimulusGroup based on config.
+        Objects already in the DB are kept as they are; the missing ones are
+        created in bulk, in dependency order, resolving the ids of the config
+        to primary keys in memory, so the number of queries does not depend
+        on the size of the config.
         """
+        scfg = self.experiment_config.stimulus_config
+        experiment = self.experiment
 
-        cd: dict
-        for cd in self.experiment_config.stimulus_config.contents:
-            try:
-                Content.objects.get(
-                    experiment=self.experiment,
-                    content_id=cd['content_id'])
-            except Content.DoesNotExist:
-                Content.objects.create(
-                    experiment=self.experiment,
-                    content_id=cd['content_id'])
+        def get_pks(model, id_field: str) -> dict:
+            return dict(model.objects.filter(experiment=experiment).values_list(id_field, 'id'))
 
-        sd: dict
-        for sd in self.experiment_config.stimulus_config.stimuli:
-            try:
-                Stimulus.objects.get(
-                    experiment=self.experiment,
-                    stimulus_id=sd['stimulus_id'])
-            except Stimulus.DoesNotExist:
-                c: Content = Content.objects.get(
-                    experiment=self.experiment,
-                    content_id=sd['content_id'])
-                Stimulus.objects.create(
-                    experiment=self.experiment,
-                    stimulus_id=sd['stimulus_id'],
-                    content=c,
-                )  # TODO: add condition in future
+        def get_missing(ids, pks: dict) -> list:
+            return list(dict.fromkeys(i for i in ids if i not in pks))
 
-        svgd: dict
-        for svgd in self.experiment_config.stimulus_config.stimulusvotegroups:
-            assert len(svgd['stimulus_ids']) in [1, 2], \
-                'for now, can only deal with stimulus_ids of length 1 or 2, ' \
-                'but got: {}'.format(len(svgd['stimulus_ids']))
-            try:
-                StimulusVoteGroup.objects.get(
-                    experiment=self.experiment,
-                    stimulusvotegroup_id=svgd['stimulusvotegroup_id'])
-            except StimulusVoteGroup.DoesNotExist:
-                if len(svgd['stimulus_ids']) == 1:
-                    s: Stimulus = Stimulus.objects.get(
-                        experiment=self.experiment,
-                        stimulus_id=svgd['stimulus_ids'][0])
-                    StimulusVoteGroup.create_stimulusvotegroup_from_stimulus(
-                        s,
-                        stimulusvotegroup_id=svgd['stimulusvotegroup_id'],
-                        experiment=self.experiment)
-                elif len(svgd['stimulus_ids']) == 2:
-                    s1: Stimulus = Stimulus.objects.get(
-                        experiment=self.experiment,
-                        stimulus_id=svgd['stimulus_ids'][0])
-                    s2: Stimulus = Stimulus.objects.get(
-                        experiment=self.experiment,
-                        stimulus_id=svgd['stimulus_ids'][1])
-                    StimulusVoteGroup.create_stimulusvotegroup_from_stimuli_pair(
-                        s1, s2,
-                        stimulusvotegroup_id=svgd['stimulusvotegroup_id'],
-                        experiment=self.experiment)
-                else:
-                    assert False
+        content_pks = get_pks(Content, 'content_id')
+        Content.objects.bulk_create([
+            Content(experiment=experiment, content_id=cid)
+            for cid in get_missing(scfg.get_ids('contents'), content_pks)])
+        content_pks = get_pks(Content, 'content_id')
 
+        stimulus_pks = get_pks(Stimulus, 'stimulus_id')
+        new_sds = dict()
+        sd: dict
+        for sd in scfg.stimuli:
+            if sd['stimulus_id'] not in stimulus_pks:
+                new_sds.setdefault(sd['stimulus_id'], sd)
+        Stimulus.objects.bulk_create([
+            Stimulus(experiment=experiment, stimulus_id=sid, content_id=content_pks[sd['content_id']])
+            for sid, sd in new_sds.items()
+        ])  # TODO: add condition in future
+        stimulus_pks = get_pks(Stimulus, 'stimulus_id')
+
+        # the stimulusgroups go before the stimulusvotegroups, so that a new
+        # svg is created already linked to its new sg
+        stimulusgroup_pks = get_pks(StimulusGroup, 'stimulusgroup_id')
+        new_sgids = get_missing(scfg.get_ids('stimulusgroups'), stimulusgroup_pks)
+        StimulusGroup.objects.bulk_create([
+            StimulusGroup(experiment=experiment, stimulusgroup_id=sgid) for sgid in new_sgids])
+        stimulusgroup_pks = get_pks(StimulusGroup, 'stimulusgroup_id')
+        new_sgids = set(new_sgids)
+        d_svgid_to_new_sgid = dict()
         sgd: dict
-        for sgd in self.experiment_config.stimulus_config.stimulusgroups:
+        for sgd in scfg.stimulusgroups:
             assert len(sgd['stimulusvotegroup_ids']) > 0
-            try:
-                StimulusGroup.objects.get(
-                    experiment=self.experiment,
-                    stimulusgroup_id=sgd['stimulusgroup_id'])
-            except StimulusGroup.DoesNotExist:
-                sg = StimulusGroup.objects.create(
-                    experiment=self.experiment,
-                    stimulusgroup_id=sgd['stimulusgroup_id'])
+            if sgd['stimulusgroup_id'] in new_sgids:
                 for svgid in sgd['stimulusvotegroup_ids']:
-                    svg = StimulusVoteGroup.objects.get(
-                        experiment=self.experiment,
-                        stimulusvotegroup_id=svgid)
-                    assert svg.stimulusgroup is None, \
+                    assert svgid not in d_svgid_to_new_sgid, \
                         'svg.stimulusgroup should not be overwritten'
-                    svg.stimulusgroup = sg
-                    svg.save()
+                    d_svgid_to_new_sgid[svgid] = sgd['stimulusgroup_id']
+
+        db_svgs = {svg.stimulusvotegroup_id: svg for svg in StimulusVoteGroup.objects.filter(experiment=experiment)}
+        new_svgds = dict()
+        svgd: dict
+        for svgd in scfg.stimulusvotegroups:
+            assert len(svgd['stimulus_ids']) in [1, 2], \
+                'for now, can only deal with stimulus_ids of length 1 or 2, ' \
+                'but got: {}'.format(len(svgd['stimulus_ids']))
+            if svgd['stimulusvotegroup_id'] not in db_svgs:
+                new_svgds.setdefault(svgd['stimulusvotegroup_id'], svgd)
+        StimulusVoteGroup.objects.bulk_create([
+            StimulusVoteGroup(experiment=experiment, stimulusvotegroup_id=svgid,
+                              stimulusgroup_id=stimulusgroup_pks.get(d_svgid_to_new_sgid.get(svgid)))
+            for svgid in new_svgds])
+        svg_pks = get_pks(StimulusVoteGroup, 'stimulusvotegroup_id')
+        VoteRegister.objects.bulk_create([
+            VoteRegister(stimulusvotegroup_id=svg_pks[svgid], stimulus_id=stimulus_pks[sid], stimulus_order=order)
+            for svgid, svgd in new_svgds.items()
+            for order, sid in enumerate(svgd['stimulus_ids'], start=1)])
+
+        # svgs that existed before a new sg that lists them
+        svgs = list()
+        for svgid, sgid in d_svgid_to_new_sgid.items():
+            if svgid in db_svgs:
+                svg = db_svgs[svgid]
+                assert svg.stimulusgroup_id is None, \
+                    'svg.stimulusgroup should not be overwritten'
+                svg.stimulusgroup_id = stimulusgroup_pks[sgid]
+                svgs.append(svg)
+        StimulusVoteGroup.objects.bulk_update(svgs, ['stimulusgroup'])
+
+    def diff_stimulus_config(self, stimulus_config: StimulusConfig) -> StimulusConfigDiff:
+        """
+        Compare stimulus_config against the stimuli of the experiment in the
+        DB, without changing anything.
+        """
+        return StimulusConfigDiff(self.experiment, stimulus_config)
 
     @transaction.atomic
+    def apply_stimulus_config(self, stimulus_config: StimulusConfig) -> StimulusConfigDiff:
+        """
+        Bring the stimuli of the experiment in the DB in line with
+        stimulus_config, applying only the differences, in bulk. Raise
+        AssertionError, changing nothing, if the change would orphan existing
+        votes or rounds.
+        """
+        diff = self.diff_stimulus_config(stimulus_config)
+        diff.apply()
+        return diff
+
     def add_session(self, subject: Subject):
         """
         add a new Session to Experiment, and assign to subject. A new Session
         is created, so are the corresponding Rounds.
         """
-        ordering_so_far = self._get_ordering_so_far()
-        stimulusgroup_ids: List[int] = self.experiment_config.stimulus_config.stimulusgroup_ids
-        super_sg_ids = self.experiment_config.stimulus_config.super_stimulusgroup_ids
-
-        d_rid_to_sgid = self._order(
-            rounds_per_session=self.experiment_config.rounds_per_session,
-            stimulusgroup_ids=stimulusgroup_ids,
-            subject_id=subject.id,
-            ordering_so_far=ordering_so_far,
-            prioritized=self.experiment_config.prioritized,
-            random_seed=self.randgen.randint(0, 2**16),
-            blocklist_stimulusgroup_ids=self.experiment_config.blocklist_stimulusgroup_ids,
-            super_stimulusgroup_ids=super_sg_ids,
-        )
-
-        sess = Session(experiment=self.experiment, subject=subject)
-        sess.save()
-        for rid, sgid in d_rid_to_sgid.items():
-            sg: StimulusGroup = StimulusGroup.objects.get(
-                stimulusgroup_id=sgid, experiment=sess.experiment)
-            r = Round(session=sess,
-                      round_id=rid,
-                      stimulusgroup=sg)
-            r.save()
-        return sess
+        return self.add_sessions([subject])[0]
+
+    def add_sessions(self, subjects: List[Subject], timeout: float = 30.0) -> List[Session]:
+        """
+        add a new Session to Experiment for each of subjects, in order, with
+        the same assignments as calling add_session for each in turn. The
+        orderings are generated in memory, feeding the exposures of each
+        Session forward to the next, and the Sessions and Rounds are inserted
+        in bulk, so the number of queries does not depend on the number of
+        subjects.
+
+        Concurrent calls stay balanced by locking the Experiment row only:
+        the first statement of the transaction bumps
+        Experiment.assignment_version, which holds the row lock until commit,
+        so the exposure counts are read and written by one assignment to the
+        experiment at a time, while other experiments are assigned in
+        parallel. If the DB reports a lock conflict instead of waiting (e.g.
+        SQLite, which locks the whole database), the transaction is rolled
+        back and retried with a randomized backoff, for up to timeout
+        seconds. In an enclosing transaction, lock conflicts are not
+        retried, as the locks of the enclosing transaction are kept.
+        """
+        subjects = list(subjects)
+        if len(subjects) == 0:
+            return list()
+        in_atomic_block = transaction.get_connection().in_atomic_block
+        deadline = time.time() + timeout
+        attempt = 0
+        while True:
+            try:
+                with transaction.atomic():
+                    return self._add_sessions(subjects)
+            except OperationalError as e:
+                if in_atomic_block or not self._is_lock_conflict(e) or time.time() > deadline:
+                    raise
+            # not from self.randgen, which is seeded for reproducible assignments
+            time.sleep(random.uniform(0, min(0.001 * 2 ** attempt, 0.05)))
+            attempt += 1
+
+    @staticmethod
+    def _is_lock_conflict(e: OperationalError) -> bool:
+        """
+        Tell if e is the DB reporting a lock held by another transaction
+        instead of waiting for it, i.e. SQLITE_BUSY or SQLITE_LOCKED on
+        SQLite. The other backends wait for the row lock.
+        """
+        if transaction.get_connection().vendor != 'sqlite':
+            return False
+        # the sqlite3 error, as wrapped by django
+        errorcode = getattr(e.__cause__, 'sqlite_errorcode', None)
+        if errorcode is not None:
+            # the primary result code is in the low byte of an extended one
+            return errorcode & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+        # no error codes before python 3.11
+        return str(e) in ('database is locked', 'database table is locked')
+
+    def _add_sessions(self, subjects: List[Subject]) -> List[Session]:
+        Experiment.objects \
+            .filter(pk=self.experiment.pk) \
+            .update(assignment_version=F('assignment_version') + 1)
+        stimulusgroup_ids: Sequence[int] = self.experiment_config.stimulus_config.get_ids('stimulusgroups')
+        super_sg_ids = self.experiment_config.stimulus_config.get_super_stimulusgroup_ids()
+        counts, subject_counts = self._get_exposures([subject.id for subject in subjects])
+        num_sessions_so_far = self.experiment.session_set.count()
+
+        orderings = list()
+        for subject in subjects:
+            d_rid_to_sgid = self._order(
+                rounds_per_session=self.experiment_config.rounds_per_session,
+                stimulusgroup_ids=stimulusgroup_ids,
+                subject_id=subject.id,
+                ordering_so_far=None,
+                prioritized=self.experiment_config.prioritized,
+                random_seed=self.randgen.randint(0, 2**16),
+                blocklist_stimulusgroup_ids=self.experiment_config.blocklist_stimulusgroup_ids,
+                super_stimulusgroup_ids=super_sg_ids,
+                exposures={sgid: (count, subject_counts.get((subject.id, sgid), 0)) for sgid, count in counts.items()},
+                num_sessions_so_far=num_sessions_so_far,
+            )
+            orderings.append(d_rid_to_sgid)
+            for sgid in d_rid_to_sgid.values():
+                counts[sgid] = counts.get(sgid, 0) + 1
+                subject_counts[(subject.id, sgid)] = subject_counts.get((subject.id, sgid), 0) + 1
+            num_sessions_so_far += 1
+
+        sg_pks = dict(StimulusGroup.objects
+                      .filter(experiment=self.experiment, stimulusgroup_id__in=set(counts.keys()))
+                      .values_list('stimulusgroup_id', 'id'))
+        sessions = Session.objects.bulk_create([
+            Session(experiment=self.experiment, subject=subject, step_plan=self._compile_step_plan(d_rid_to_sgid))
+            for subject, d_rid_to_sgid in zip(subjects, orderings)])
+        assert all(sess.pk is not None for sess in sessions), \
+            'the DB backend must return the primary keys of bulk-created objects'
+        rounds = list()
+        for sess, d_rid_to_sgid in zip(sessions, orderings):
+            for rid, sgid in d_rid_to_sgid.items():
+                rounds.append(Round(session=sess, round_id=rid, stimulusgroup_id=sg_pks[sgid]))
+        Round.objects.bulk_create(rounds)
+        # bulk_create does not send the signals that keep the counts
+        StimulusGroupExposure.add([(r.stimulusgroup_id, r.session.subject_id) for r in rounds])
+        return sessions
 
     @transaction.atomic
     def delete_session(self, session_id):
@@ -196,23 +505,151 @@ class ExperimentController(object):
         sess: Session = Session.objects.get(id=session_id)
         sess.delete()
 
-    def _get_ordering_so_far(self):
+    # (methodology, vote_scale) combinations whose votes can be recorded
+    VOTABLE_METHODOLOGY_VOTE_SCALES = [
+        ('acr5c', '0_TO_100'),
+        ('acr', 'THREE_POINT'), ('acr', 'FIVE_POINT'), ('acr', 'SEVEN_POINT'), ('acr', 'ELEVEN_POINT'),
+        ('dcr', 'THREE_POINT'), ('dcr', 'FIVE_POINT'), ('dcr', 'SEVEN_POINT'), ('dcr', 'ELEVEN_POINT'),
+        ('tafc', '2AFC'),
+        ('ccr', 'CCR_THREE_POINT'), ('ccr', 'CCR_FIVE_POINT'),
+        ('samviq', '0_TO_100'),
+        ('samviq5d', 'FIVE_POINT'),
+    ]
+
+    def record_session_votes(self, session: Session, steps: List[dict]) -> List[Vote]:
         """
-        retrieve ordering so far from db, in the following format:
-        [
-            {'subject': subject_id, 'stimulusgroups': dict_of_round_id_to_stimulusgroup_id}
-            ...
-        ]
+        Record the votes and response times of the round steps performed in
+        session, each in the format of:
+        {'position': {'round_id': ...},
+         'context': {'stimulusgroup_id': ..., 'score': {stimulusvotegroup_id: score},
+                     'response_sec': ...}}
+
+        The Rounds, StimulusVoteGroups and existing Votes are read in bulk,
+        the new Votes are created in bulk and the response_sec of the Rounds
+        updated in bulk, in one transaction, so the number of queries does
+        not depend on the number of steps. A vote that already exists with
+        the same score, e.g. from a double submission, is skipped; with a
+        different score, AssertionError is raised and nothing is recorded.
+        The unique constraint on the round and stimulusvotegroup of Vote
+        catches a concurrent submission, whose votes are then checked again.
+        Return the Votes created.
         """
-        ordering = []
-        s: Session
-        for s in self.experiment.session_set.all():
-            sess_id = s.id
-            od = self._get_ordering_for_session(sess_id)
-            ordering.append(od)
-        return ordering
-
-    @memoized
+        methodology = self.experiment_config.methodology
+        vote_scale = self.experiment_config.vote_scale
+        assert (methodology, vote_scale) in self.VOTABLE_METHODOLOGY_VOTE_SCALES, \
+            'The combination of {m} methodology with {s} vote_scale is undefined'.format(m=methodology, s=vote_scale)
+        try:
+            with transaction.atomic():
+                return self._record_session_votes(session, steps)
+        except IntegrityError:
+            logger.warning(f'votes of session {session.id} were recorded concurrently, '
+                           f'possibly a double POST submission; checking them again.')
+            with transaction.atomic():
+                return self._record_session_votes(session, steps)
+
+    def _record_session_votes(self, session: Session, steps: List[dict]) -> List[Vote]:
+        VoteClass = Vote.find_subclass(self.experiment_config.vote_scale)
+        rounds = {rnd.round_id: rnd for rnd in Round.objects.filter(session=session)}
+        svg_pks = {(sgid, svgid): pk for sgid, svgid, pk in StimulusVoteGroup.objects
+                   .filter(stimulusgroup__experiment=self.experiment,
+                           stimulusgroup__stimulusgroup_id__in={step['context']['stimulusgroup_id'] for step in steps})
+                   .values_list('stimulusgroup__stimulusgroup_id', 'stimulusvotegroup_id', 'id')}
+        scores = {(round_pk, svg_pk): score for round_pk, svg_pk, score in Vote.objects
+                  .non_polymorphic()
+                  .filter(round__session=session)
+                  .values_list('round_id', 'stimulusvotegroup_id', 'score')}
+
+        votes = list()
+        updated_rounds = dict()
+        for step in steps:
+            assert 'context' in step
+            assert 'score' in step['context']
+            assert 'response_sec' in step['context']
+            rnd = rounds[step['position']['round_id']]
+            sgid = step['context']['stimulusgroup_id']
+            score_dict = step['context']['score']
+            assert isinstance(score_dict, dict)
+            for svgid, score in score_dict.items():
+                assert isinstance(score, int)
+                key = (sgid, int(svgid))
+                if key not in svg_pks:
+                    raise StimulusVoteGroup.DoesNotExist(
+                        f'StimulusVoteGroup {svgid} of StimulusGroup {sgid} does not exist.')
+                svg_pk = svg_pks[key]
+
+                # in each round, for a single svg, there can only be one
+                # vote; if more than one, it could be a duplicated submission
+                if (rnd.id, svg_pk) in scores:
+                    score2 = scores[(rnd.id, svg_pk)]
+                    if score2 == score:
+                        logger.warning(f'skip saving vote {score} as vote with score {score2} and svg {svg_pk} '
+                                       f'already exists in round {rnd}, possibly a double POST submission.')
+                        continue
+                    msg = f'error saving vote {score} as vote with score {score2} and svg {svg_pk} ' \
+                          f'already exists in round {rnd}.'
+                    logger.error(msg)
+                    raise AssertionError(msg)
+                scores[(rnd.id, svg_pk)] = score
+                votes.append(VoteClass(score=score, round=rnd, stimulusvotegroup_id=svg_pk))
+
+            response_sec = step['context']['response_sec']
+            assert response_sec != 'none'
+            rnd.response_sec = response_sec
+            updated_rounds[rnd.id] = rnd
+
+        Vote.bulk_create_votes(votes)
+        # no signals needed, as only the response_sec of the rounds changes
+        Round.objects.bulk_update(updated_rounds.values(), ['response_sec'])
+        return votes
+
+    def _get_exposures(self, subject_ids: List[int]) -> Tuple[Dict[int, int], Dict[Tuple[int, int], int]]:
+        """
+        Read the weight histogram of the experiment, with one query per
+        exposure table, in the format of:
+        (dict: stimulusgroup_id -> number of rounds so far,
+         dict: (subject_id, stimulusgroup_id) -> number of rounds so far of subject_id)
+
+        The counts of an experiment that has rounds but no counts, i.e. created
+        before they were kept, are rebuilt first. Counts that are off otherwise
+        are left to check_exposures(), so that an assignment does not read all
+        the rounds of the experiment.
+        """
+        qs = StimulusGroupExposure.objects \
+            .filter(experiment=self.experiment) \
+            .values_list('stimulusgroup__stimulusgroup_id', 'count')
+        counts = dict(qs)
+        if sum(counts.values()) == 0 and Round.objects.filter(session__experiment=self.experiment).exists():
+            StimulusGroupExposure.rebuild(self.experiment)
+            counts = dict(qs.all())
+        subject_counts = SubjectStimulusGroupExposure.objects \
+            .filter(subject_id__in=subject_ids, stimulusgroup__experiment=self.experiment) \
+            .values_list('subject_id', 'stimulusgroup__stimulusgroup_id', 'count')
+        return counts, {(subject_id, sgid): count for subject_id, sgid, count in subject_counts}
+
+    def check_exposures(self, rebuild: bool = True) -> bool:
+        """
+        Tell if the exposure counts of the experiment add up to its number of
+        rounds, e.g. not if rounds were written by code that bypassed the
+        signals. If not, and rebuild, rebuild them from the rounds. Meant for
+        maintenance, since it reads all the rounds of the experiment.
+        """
+        num_counted = StimulusGroupExposure.objects \
+            .filter(experiment=self.experiment) \
+            .aggregate(n=Sum('count'))['n'] or 0
+        num_rounds = Round.objects \
+            .filter(session__experiment=self.experiment, stimulusgroup__experiment=self.experiment) \
+            .count()
+        if num_counted == num_rounds:
+            return True
+        logger.warning(f'the exposure counts of experiment {self.experiment.title} add up to '
+                       f'{num_counted} rounds, but there are {num_rounds}' + (': rebuild them' if rebuild else ''))
+        if rebuild:
+            StimulusGroupExposure.rebuild(self.experiment)
+        return False
+
+    # cached per controller, and dropped when the rounds or the subject of
+    # the session change, see the signal receivers below
+    @instance_memoized(maxsize=1024)
     def _get_ordering_for_session(self, sess_id):
         s = Session.objects.get(id=sess_id)
         subject_id = s.subject.id
@@ -235,13 +672,15 @@ class ExperimentController(object):
     @staticmethod
     def _order(  # noqa C901
             rounds_per_session: int,
-            stimulusgroup_ids: List[int],
+            stimulusgroup_ids: Sequence[int],
             subject_id: int,
-            ordering_so_far: List[dict],
+            ordering_so_far: Optional[List[dict]],
             prioritized: List[dict],
             random_seed: Optional[int],
             blocklist_stimulusgroup_ids: List[int],
-            super_stimulusgroup_ids: Optional[List[int]] = None,
+            super_stimulusgroup_ids: Optional[Sequence[int]] = None,
+            exposures: Optional[Dict[int, Tuple[int, int]]] = None,
+            num_sessions_so_far: Optional[int] = None,
     ):
         """
         return new stimulusgroup assignment in the format of:
@@ -251,6 +690,10 @@ class ExperimentController(object):
         of stimulusgroups. The randomization of stimulusgroups within a session
         will then be hierarchical instead of flat: first randomize between
         super_stimulusgroups, then randomize within each super_stimulusgroup.
+
+        exposures and num_sessions_so_far, if present, replace ordering_so_far,
+        with exposures in the format of:
+        dict: stimulusgroup_id -> (number of rounds so far, number of rounds so far of subject_id)
         """
 
         if super_stimulusgroup_ids is not None:
@@ -261,7 +704,7 @@ class ExperimentController(object):
 
         SUBJECT_WEIGHT = 5
 
-        num_sessions_sofar = len(ordering_so_far)
+        num_sessions_sofar = len(ordering_so_far) if num_sessions_so_far is None else num_sessions_so_far
         new_session_id = num_sessions_sofar
 
         # Note that stimulusgroup_idx is different from stimulusgroup_id. The
@@ -274,11 +717,16 @@ class ExperimentController(object):
         # use the heuristic rule to prioritize sg to test based on 5 * x + y,
         # where x is the current subject's count, and y is the overall count
         wt_hist = [0 for _ in stimulusgroup_ids]
-        for pd in ordering_so_far:
-            for sgid in pd['stimulusgroups'].values():
-                wt_hist[d_sgid_to_sgidx[sgid]] += 1
-                if subject_id == pd['subject']:
-                    wt_hist[d_sgid_to_sgidx[sgid]] += SUBJECT_WEIGHT
+        if exposures is None:
+            for pd in ordering_so_far:
+                for sgid in pd['stimulusgroups'].values():
+                    wt_hist[d_sgid_to_sgidx[sgid]] += 1
+                    if subject_id == pd['subject']:
+                        wt_hist[d_sgid_to_sgidx[sgid]] += SUBJECT_WEIGHT
+        else:
+            for sgid, (count, subject_count) in exposures.items():
+                if sgid in d_sgid_to_sgidx:
+                    wt_hist[d_sgid_to_sgidx[sgid]] += count + SUBJECT_WEIGHT * subject_count
 
         # output:
         d_rid_to_sgid = dict()  # output: round determined
@@ -305,29 +753,30 @@ class ExperimentController(object):
 
         remaining_rounds_to_fulfill = rounds_per_session - len(d_rid_to_sgid) - len(l_sgid)
 
-        sgidx_candidates = list()
+        blocked_sgidxs = set()
+        if blocklist_stimulusgroup_ids is not None:
+            blocked_sgidxs = {d_sgid_to_sgidx[bsgid] for bsgid in blocklist_stimulusgroup_ids}
+        # the weight of a candidate only changes once it is taken, so the
+        # candidates are grouped by weight once per replenishment
+        sgidx_candidates = LeastWeightCandidates(wt_hist, [])
         for _ in range(remaining_rounds_to_fulfill):
 
             # replenish if current sg candidates are empty
             if len(sgidx_candidates) == 0:
-                new_sgidxs = list(range(len(stimulusgroup_ids)))
-                if blocklist_stimulusgroup_ids is not None:
-                    for bsgid in blocklist_stimulusgroup_ids:
-                        new_sgidxs.remove(d_sgid_to_sgidx[bsgid])
-                sgidx_candidates += new_sgidxs
+                sgidx_candidates = LeastWeightCandidates(
+                    wt_hist, [sgidx for sgidx in range(len(stimulusgroup_ids)) if sgidx not in blocked_sgidxs])
 
             # find from sg candidates that has least weight
-            sgidxs = my_argmin(wt_hist, sgidx_candidates)
+            sgidxs = sgidx_candidates.least_candidates()
             assert len(sgidxs) > 0
             if len(sgidxs) == 1:
-                sgidx = sgidxs[0]
+                sgidx = sgidx_candidates.take(0)
             else:
-                sgidx = sgidxs[random.randint(0, len(sgidxs) - 1)]
+                sgidx = sgidx_candidates.take(random.randint(0, len(sgidxs) - 1))
             l_sgid.append(d_sgidx_to_sgid[sgidx])
             # since it is the same subject, the weight increment is the
             # 5 * x + y, where x = 1 and y = 1
             wt_hist[sgidx] += SUBJECT_WEIGHT + 1
-            sgidx_candidates.remove(sgidx)
 
         # lastly, randomly assign sgidx in l to different rid
         if super_stimulusgroup_ids is None:
@@ -337,12 +786,12 @@ class ExperimentController(object):
             l_sgid_new = list()
             unique_super_sgids = list(set(super_stimulusgroup_ids))
             random.shuffle(unique_super_sgids)
+            l_sgid_by_super = dict()
+            for sgid in l_sgid:
+                l_sgid_by_super.setdefault(sgid_to_super[sgid], list()).append(sgid)
             for super_sgid in unique_super_sgids:
                 # second, randomize within each super_sgid
-                cur_l = list()
-                for sgid in l_sgid:
-                    if sgid_to_super[sgid] == super_sgid:
-                        cur_l.append(sgid)
+                cur_l = l_sgid_by_super.get(super_sgid, list())
                 random.shuffle(cur_l)
                 l_sgid_new += cur_l
             l_sgid = l_sgid_new
@@ -357,50 +806,65 @@ class ExperimentController(object):
         return d_rid_to_sgid
 
     def get_session_status(self, session: Session) -> SessionStatus:
+        return self.get_session_statuses([session])[0]
+
+    def get_session_statuses(self, sessions: Iterable[Session]) -> List[SessionStatus]:
+        """
+        Return the SessionStatus of each of sessions, of this Experiment, in
+        order. A single aggregate query, over the Rounds of all sessions,
+        counts for each Round the StimulusVoteGroups of its StimulusGroup and
+        the ones of them that have a Vote.
+        """
+        sessions = list(sessions)
+        for s in sessions:
+            if s.pk is None:
+                # as raised by session.round_set
+                raise ValueError(f"{s!r} needs to have a primary key value before its rounds can be used.")
         rounds_per_session = self.experiment_config.rounds_per_session
-        rounds_existed = [False for _ in range(rounds_per_session)]
-        r: Round
-        rounds: List[Round] = list(session.round_set.all())
-        for r in rounds:
-            assert 0 <= r.round_id < rounds_per_session
-            rounds_existed[r.round_id] = True
-        if all(rounds_existed):
-            pass
-        elif all([not e for e in rounds_existed]):
-            return SessionStatus.UNINITIALIZED
-        else:
-            return SessionStatus.PARTIALLY_INITIALIZED
-
-        # iterate through all StimulusVoteGroups. If all assgined Votes, return
-        # 'FINISHED'; if none, return 'INITIALIZED'; otherwise, return
-        # 'PARTIALLY_FINISHED'.
-        all_true = None
-        all_false = None
-        for r in rounds:
-            svg: StimulusVoteGroup
-            for svg in r.stimulusgroup.stimulusvotegroup_set.all():
-                votes = Vote.objects.filter(round=r, stimulusvotegroup=svg)
-                if votes.count() == 0:
-                    all_true = False
-                elif votes.count() == 1:
-                    all_false = False
-                else:
-                    assert False, \
-                        "must have at most one Vote per StimulusVoteGroup" \
-                        "but got {}: {}, {}".format(len(votes.count()),
-                                                    svg, votes.all())
-                if all_true is False and all_false is False:
-                    return SessionStatus.PARTIALLY_FINISHED
-
-        if all_true is False and all_false is None:
-            return SessionStatus.INITIALIZED
-        elif all_true is None and all_false is False:
-            return SessionStatus.FINISHED
-        elif all_true is None and all_false is None:
-            # this happens when none of svg has been iterated
-            return SessionStatus.INITIALIZED
-        else:
-            assert False
+        voted = Q(vote__stimulusvotegroup__stimulusgroup=F('stimulusgroup'))
+        rows = Round.objects \
+            .filter(session__in=sessions) \
+            .values('session_id', 'round_id') \
+            .annotate(num_svgs=Count('stimulusgroup__stimulusvotegroup', distinct=True),
+                      num_voted_svgs=Count('vote__stimulusvotegroup', filter=voted, distinct=True),
+                      num_votes=Count('vote', filter=voted, distinct=True)) \
+            .order_by()
+        rounds_by_session = {s.id: list() for s in sessions}
+        for row in rows:
+            rounds_by_session[row['session_id']].append(row)
+
+        statuses = list()
+        for s in sessions:
+            rounds = rounds_by_session[s.id]
+            rounds_existed = [False for _ in range(rounds_per_session)]
+            for r in rounds:
+                assert 0 <= r['round_id'] < rounds_per_session
+                rounds_existed[r['round_id']] = True
+            if all(rounds_existed):
+                pass
+            elif all([not e for e in rounds_existed]):
+                statuses.append(SessionStatus.UNINITIALIZED)
+                continue
+            else:
+                statuses.append(SessionStatus.PARTIALLY_INITIALIZED)
+                continue
+
+            # If all StimulusVoteGroups are assigned Votes, 'FINISHED'; if
+            # none (or there is no StimulusVoteGroup), 'INITIALIZED';
+            # otherwise, 'PARTIALLY_FINISHED'.
+            for r in rounds:
+                assert r['num_votes'] == r['num_voted_svgs'], \
+                    f"must have at most one Vote per StimulusVoteGroup, but round {r['round_id']} " \
+                    f"of session {s.id} has {r['num_votes']} Votes for {r['num_voted_svgs']} StimulusVoteGroups"
+            num_svgs = sum(r['num_svgs'] for r in rounds)
+            num_voted_svgs = sum(r['num_voted_svgs'] for r in rounds)
+            if num_voted_svgs == 0:
+                statuses.append(SessionStatus.INITIALIZED)
+            elif num_voted_svgs == num_svgs:
+                statuses.append(SessionStatus.FINISHED)
+            else:
+                statuses.append(SessionStatus.PARTIALLY_FINISHED)
+        return statuses
 
     @staticmethod
     def reset_session(session: Session):
@@ -416,32 +880,110 @@ class ExperimentController(object):
         """
         return a list of steps for the session, including both regular rounds
         and additions (instruction steps and pre-/post-test surveys).
+
+        The steps are expanded from the step plan of the session, compiled
+        when the session is created, so neither the rounds are read nor the
+        additions re-inserted. A session without a plan, or with a plan
+        compiled for other additions, is compiled here and the plan saved.
+        """
+        plan = session.step_plan
+        if plan is None or not plan.startswith(self._get_step_plan_key() + ':'):
+            plan = self.compile_session_step_plan(session)
+        return self._expand_step_plan(plan)
+
+    def _get_step_plan_key(self) -> str:
+        # the plan depends on the positions of the additions only; their
+        # contexts are looked up from the config when expanded
+        positions = [addition['position'] for addition in self.experiment_config.additions]
+        return hashlib.sha1(json.dumps(positions, sort_keys=True).encode()).hexdigest()[:8]
+
+    def _compile_step_plan(self, d_rid_to_sgid: Dict[int, int]) -> str:
+        """
+        Compile the steps of a session with round ids to stimulusgroup_ids
+        d_rid_to_sgid into a step plan string '<key>:<tokens>', where each
+        comma-separated token is the stimulusgroup_id of the next round, or
+        'a<i>' for the i-th addition of the config.
         """
-        od = self._get_ordering_for_session(session.id)
-        assert 'stimulusgroups' in od
-        assert isinstance(od['stimulusgroups'], dict)
         steps = list()
-        for rid in sorted(od['stimulusgroups'].keys()):
-            sgid = od['stimulusgroups'][rid]
+        for rid in sorted(d_rid_to_sgid.keys()):
             steps.append({
                 'position': {
                     'round_id': rid,
                 },
                 'context': {
-                    'stimulusgroup_id': sgid,
+                    'stimulusgroup_id': d_rid_to_sgid[rid],
                 }
             })
-        additions = self.experiment_config.additions
 
         for i in range(len(steps) - 1):
             assert steps[i]['position']['round_id'] == \
                    steps[i + 1]['position']['round_id'] - 1
 
-        for addition in additions:
-            self._insert_addition_into_steps(addition, steps)
+        for idx, addition in enumerate(self.experiment_config.additions):
+            self._insert_addition_into_steps({'position': addition['position'], 'addition': idx}, steps)
+
+        tokens = [f"a{step['addition']}" if 'addition' in step else str(step['context']['stimulusgroup_id'])
+                  for step in steps]
+        return self._get_step_plan_key() + ':' + ','.join(tokens)
 
+    def _expand_step_plan(self, plan: str) -> list:
+        additions = self.experiment_config.additions
+        round_id = 0
+        body = plan.split(':', 1)[1]
+        steps = list()
+        for token in body.split(',') if body else []:
+            if token[0] == 'a':
+                # shallow copy, since the experiment_config may be shared across
+                # requests, and the caller is free to modify the steps returned
+                steps.append(dict(additions[int(token[1:])]))
+            else:
+                steps.append({
+                    'position': {
+                        'round_id': round_id,
+                    },
+                    'context': {
+                        'stimulusgroup_id': int(token),
+                    }
+                })
+                round_id += 1
         return steps
 
+    def compile_session_step_plan(self, session: Session) -> str:
+        """
+        (Re)compile the step plan of session from its rounds and the
+        additions of the config, and save it.
+        """
+        od = self._get_ordering_for_session(session.id)
+        assert 'stimulusgroups' in od
+        assert isinstance(od['stimulusgroups'], dict)
+        session.step_plan = self._compile_step_plan(od['stimulusgroups'])
+        Session.objects.filter(pk=session.pk).update(step_plan=session.step_plan)
+        return session.step_plan
+
+    @transaction.atomic
+    def compile_session_step_plans(self) -> int:
+        """
+        Recompile the step plans of all the sessions of the experiment, e.g.
+        after the additions of the config changed, with one query to read the
+        rounds and a bulk update. A session whose rounds are not 0, ...,
+        rounds_per_session - 1 is left without a plan, and fails on
+        get_session_steps as before. Return the number of plans compiled.
+        """
+        d_sess_to_ordering: Dict[int, Dict[int, int]] = {
+            pk: dict() for pk in self.experiment.session_set.values_list('id', flat=True)}
+        for sess_pk, rid, sgid in Round.objects \
+                .filter(session__experiment=self.experiment) \
+                .values_list('session_id', 'round_id', 'stimulusgroup__stimulusgroup_id'):
+            d_sess_to_ordering[sess_pk][rid] = sgid
+        sessions = list()
+        for sess_pk, d_rid_to_sgid in d_sess_to_ordering.items():
+            plan = None
+            if set(range(self.experiment_config.rounds_per_session)).issubset(d_rid_to_sgid.keys()):
+                plan = self._compile_step_plan(d_rid_to_sgid)
+            sessions.append(Session(id=sess_pk, step_plan=plan))
+        Session.objects.bulk_update(sessions, ['step_plan'])
+        return sum(sess.step_plan is not None for sess in sessions)
+
     @staticmethod
     def _insert_addition_into_steps(addition, steps):
         round_id = addition['position']['round_id']
@@ -534,43 +1076,75 @@ class ExperimentController(object):
         else:
             assert False
 
-    @staticmethod
-    def get_session_info(s: Session) -> dict:
-
-        info = dict()
-
-        info['session_id'] = s.id
-        info['subject'] = s.subject.get_subject_name()
+    @classmethod
+    def get_session_info(cls, s: Session) -> dict:
+        return cls.get_session_infos([s])[0]
 
-        rounds = info.setdefault('rounds', [])
-        r: Round
-        for r in s.round_set.all():
-            rd = dict()
-            rd['round_id'] = r.round_id
-            rd['stimulusgroup_id'] = r.stimulusgroup.stimulusgroup_id
-
-            svgs = rd.setdefault('stimulusvotegroups', [])
-            svg: StimulusVoteGroup
-            for svg in r.stimulusgroup.stimulusvotegroup_set.all():
+    @staticmethod
+    def get_session_infos(sessions: Sequence[Session]) -> List[dict]:
+        """
+        Get the info of sessions: the rounds, their stimulusvotegroups and
+        votes. The sessions, rounds, stimulusvotegroups and votes are each
+        fetched in one query and joined in memory, so the number of queries
+        does not depend on the number of sessions, rounds or votes.
+        """
+        sessions = list(sessions)
+        for s in sessions:
+            if s.pk is None:
+                raise ValueError(f'{s} needs to be saved before its info can be read')
+        session_pks = [s.pk for s in sessions]
+        subjects = {s.pk: s.subject for s in Session.objects
+                    .filter(pk__in=session_pks).select_related('subject__user')}
+
+        rounds = Round.objects \
+            .filter(session_id__in=session_pks) \
+            .order_by('id') \
+            .values_list('id', 'session_id', 'round_id', 'stimulusgroup_id', 'stimulusgroup__stimulusgroup_id')
+        d_sg_pk_to_svgs: Dict[int, List[Tuple[int, int]]] = dict()
+        for svg_pk, sg_pk, svgid in StimulusVoteGroup.objects \
+                .filter(stimulusgroup_id__in=Round.objects.filter(session_id__in=session_pks).values('stimulusgroup_id')) \
+                .order_by('id') \
+                .values_list('id', 'stimulusgroup_id', 'stimulusvotegroup_id'):
+            d_sg_pk_to_svgs.setdefault(sg_pk, list()).append((svg_pk, svgid))
+        votes: Dict[Tuple[int, int], float] = dict()
+        for round_pk, svg_pk, score in Vote.objects \
+                .non_polymorphic() \
+                .filter(round__session_id__in=session_pks) \
+                .values_list('round_id', 'stimulusvotegroup_id', 'score'):
+            if (round_pk, svg_pk) in votes:
+                raise Vote.MultipleObjectsReturned(f'more than one vote of round {round_pk} for svg {svg_pk}')
+            votes[(round_pk, svg_pk)] = score
+
+        infos = dict()
+        for s in sessions:
+            infos[s.pk] = {
+                'session_id': s.id,
+                'subject': subjects[s.pk].get_subject_name(),
+                'rounds': [],
+            }
+        for round_pk, sess_pk, round_id, sg_pk, sgid in rounds:
+            svgs = list()
+            for svg_pk, svgid in d_sg_pk_to_svgs.get(sg_pk, []):
                 svgd = dict()
-                svgd['stimulusvotegroup_id'] = svg.stimulusvotegroup_id
-                try:
-                    vote = Vote.objects.get(round=r, stimulusvotegroup=svg)
-                    svgd['vote'] = vote.score
-                except Vote.DoesNotExist:
-                    pass
+                svgd['stimulusvotegroup_id'] = svgid
+                if (round_pk, svg_pk) in votes:
+                    svgd['vote'] = votes[(round_pk, svg_pk)]
                 svgs.append(svgd)
-
-            rounds.append(rd)
-
-        return info
+            infos[sess_pk]['rounds'].append({
+                'round_id': round_id,
+                'stimulusgroup_id': sgid,
+                'stimulusvotegroups': svgs,
+            })
+        return [infos[s.pk] for s in sessions]
 
     def get_stimuli_info(self):
+        # plain lists, as the sections of a config loaded from a
+        # ConfigSnapshot are not json serializable
         return {
-            'contents': self.experiment_config.stimulus_config.contents,
-            'stimuli': self.experiment_config.stimulus_config.stimuli,
-            'stimulusvotegroups': self.experiment_config.stimulus_config.stimulusvotegroups,
-            'stimulusgroups': self.experiment_config.stimulus_config.stimulusgroups,
+            'contents': list(self.experiment_config.stimulus_config.contents),
+            'stimuli': list(self.experiment_config.stimulus_config.stimuli),
+            'stimulusvotegroups': list(self.experiment_config.stimulus_config.stimulusvotegroups),
+            'stimulusgroups': list(self.experiment_config.stimulus_config.stimulusgroups),
         }
 
     def get_experiment_info(self) -> dict:
@@ -585,18 +1159,14 @@ class ExperimentController(object):
 
         # TODO: add experimenter
 
-        sessions = info.setdefault('sessions', [])
-        s: Session
-        for s in self.experiment.session_set.all():
-            sinfo = self.get_session_info(s)
-            sessions.append(sinfo)
+        info['sessions'] = self.get_session_infos(self.experiment.session_set.order_by('id'))
 
         info['stimuli_info'] = self.get_stimuli_info()
 
         return info
 
-    @staticmethod
-    def denormalize_experiment_info(experiment_info: dict) -> pandas.DataFrame:
+    @classmethod
+    def denormalize_experiment_info(cls, experiment_info: dict) -> pandas.DataFrame:
         """
         flattern the experiment_info created from get_experiment_info() to make
         human readable pandas DataFrame style.
@@ -625,34 +1195,146 @@ class ExperimentController(object):
                 svgd: dict
                 for svgd in svgds:
                     assert 'stimulusvotegroup_id' in svgd
-                    d_svg: dict = dd_svg[svgd['stimulusvotegroup_id']]
-                    assert 'stimulus_ids' in d_svg
-                    sids = d_svg['stimulus_ids']
-                    assert len(sids) in [1, 2], f'for now, only export case of one or two stimuli per stimulusvotegroup, but {sids}'
-                    if len(sids) == 1:
-                        sid = sids[0]
-                        path = dd_s[sid]['path']
-                        sid2 = None
-                        path2 = None
-                    elif len(sids) == 2:
-                        sid = sids[0]
-                        sid2 = sids[1]
-                        path = dd_s[sid]['path']
-                        path2 = dd_s[sid2]['path']
-                    else:
-                        assert False
-                    row = {
-                        'subject': sess_info['subject'],
-                        'session_id': sess_info['session_id'],
-                        'round_id': rd['round_id'],
-                        'sg_id': rd['stimulusgroup_id'],
-                        'svg_id': svgd['stimulusvotegroup_id'],
-                        'vote': svgd['vote'] if 'vote' in svgd else None,
-                        'sid': sid,
-                        'path': path,
-                    }
-                    if sid2 is not None:
-                        row['sid2'] = sid2
-                        row['path2'] = path2
-                    rows.append(row)
+                    rows.append(cls._denormalize_vote(
+                        dd_s, dd_svg, sess_info['subject'], sess_info['session_id'], rd['round_id'],
+                        rd['stimulusgroup_id'], svgd['stimulusvotegroup_id'], svgd['vote'] if 'vote' in svgd else None))
         return pandas.DataFrame(rows)
+
+    @staticmethod
+    def _denormalize_vote(dd_s: dict, dd_svg: dict, subject: str, session_id: int, round_id: int,
+                          sgid: int, svgid: int, vote: Optional[float]) -> dict:
+        d_svg: dict = dd_svg[svgid]
+        assert 'stimulus_ids' in d_svg
+        sids = d_svg['stimulus_ids']
+        assert len(sids) in [1, 2], f'for now, only export case of one or two stimuli per stimulusvotegroup, but {sids}'
+        row = {
+            'subject': subject,
+            'session_id': session_id,
+            'round_id': round_id,
+            'sg_id': sgid,
+            'svg_id': svgid,
+            'vote': vote,
+            'sid': sids[0],
+            'path': dd_s[sids[0]]['path'],
+        }
+        if len(sids) == 2:
+            row['sid2'] = sids[1]
+            row['path2'] = dd_s[sids[1]]['path']
+        return row
+
+    def iter_denormalized_rows(self, chunk_size: int = 2000) -> Iterator[dict]:
+        """
+        Yield the rows of denormalize_experiment_info(get_experiment_info()),
+        in the same order, straight from the DB: the rounds are read from a
+        cursor chunk_size at a time, with the votes of each chunk, so the
+        memory used does not grow with the number of rounds or votes.
+        """
+        scfg = self.experiment_config.stimulus_config
+        dd_s = dict(zip(scfg.get_ids('stimuli'), scfg.stimuli))
+        dd_svg = dict(zip(scfg.get_ids('stimulusvotegroups'), scfg.stimulusvotegroups))
+
+        subjects = {sess.pk: sess.subject.get_subject_name()
+                    for sess in self.experiment.session_set.select_related('subject__user')}
+        d_sg_pk_to_svgs: Dict[int, List[Tuple[int, int]]] = dict()
+        for svg_pk, sg_pk, svgid in StimulusVoteGroup.objects \
+                .filter(stimulusgroup__experiment=self.experiment) \
+                .order_by('id') \
+                .values_list('id', 'stimulusgroup_id', 'stimulusvotegroup_id'):
+            d_sg_pk_to_svgs.setdefault(sg_pk, list()).append((svg_pk, svgid))
+
+        rounds = Round.objects \
+            .filter(session__experiment=self.experiment) \
+            .order_by('session_id', 'id') \
+            .values_list('id', 'session_id', 'round_id', 'stimulusgroup_id', 'stimulusgroup__stimulusgroup_id') \
+            .iterator(chunk_size=chunk_size)
+        while True:
+            chunk = list(islice(rounds, chunk_size))
+            if len(chunk) == 0:
+                break
+            votes = {(round_pk, svg_pk): score for round_pk, svg_pk, score in Vote.objects
+                     .non_polymorphic()
+                     .filter(round_id__in=[r[0] for r in chunk])
+                     .values_list('round_id', 'stimulusvotegroup_id', 'score')}
+            for round_pk, sess_pk, round_id, sg_pk, sgid in chunk:
+                for svg_pk, svgid in d_sg_pk_to_svgs.get(sg_pk, []):
+                    yield self._denormalize_vote(dd_s, dd_svg, subjects[sess_pk], sess_pk, round_id,
+                                                 sgid, svgid, votes.get((round_pk, svg_pk)))
+
+    def get_denormalized_fieldnames(self) -> List[str]:
+        """
+        The columns of the rows of iter_denormalized_rows, with sid2 and path2
+        if any stimulusvotegroup of the config has a pair of stimuli.
+        """
+        fieldnames = ['subject', 'session_id', 'round_id', 'sg_id', 'svg_id', 'vote', 'sid', 'path']
+        if any(len(svgd['stimulus_ids']) == 2 for svgd in self.experiment_config.stimulus_config.stimulusvotegroups):
+            fieldnames += ['sid2', 'path2']
+        return fieldnames
+
+    def iter_denormalized_csv(self, chunk_size: int = 2000) -> Iterator[str]:
+        """
+        Yield the lines of the CSV of iter_denormalized_rows, header first,
+        e.g. for a StreamingHttpResponse. A missing vote, or sid2 and path2 of
+        a single-stimulus stimulusvotegroup, is an empty field.
+        """
+        class Echo(object):
+            def write(self, value):
+                return value
+
+        writer = csv.DictWriter(Echo(), fieldnames=self.get_denormalized_fieldnames())
+        yield writer.writeheader()
+        for row in self.iter_denormalized_rows(chunk_size):
+            yield writer.writerow(row)
+
+    def write_denormalized_csv(self, fp: TextIO, chunk_size: int = 2000) -> None:
+        """
+        Write the CSV of iter_denormalized_rows to fp, a text file opened with
+        newline='', in bounded memory.
+        """
+        for line in self.iter_denormalized_csv(chunk_size):
+            fp.write(line)
+
+
+def _invalidate_sessions(session_ids: Iterable[int], step_plans: bool = True):
+    """
+    Drop the cached orderings and, if step_plans, the step plans of
+    session_ids, whose rounds changed, so that they are read from the
+    rounds again.
+    """
+    session_ids = {sess_id for sess_id in session_ids if sess_id is not None}
+    for sess_id in session_ids:
+        ExperimentController._get_ordering_for_session.invalidate(sess_id)
+    if step_plans and len(session_ids) > 0:
+        Session.objects.filter(id__in=session_ids).exclude(step_plan=None).update(step_plan=None)
+
+
+@receiver(post_save, sender=Round)
+@receiver(post_delete, sender=Round)
+def _invalidate_round_ordering(sender, instance: Round, update_fields=None, origin=None, **kwargs):
+    if update_fields is not None and not {'session', 'round_id', 'stimulusgroup'} & set(update_fields):
+        return
+    # a Round is only deleted along with something else when its Session is,
+    # so that there is no plan left to drop
+    deleted_with_session = origin is not None and \
+        not issubclass(origin.model if isinstance(origin, QuerySet) else type(origin), Round)
+    loaded = getattr(instance, '_loaded_assignment', None)
+    _invalidate_sessions([instance.session_id] + ([loaded[0]] if loaded is not None else []),
+                         step_plans=not deleted_with_session)
+
+
+@receiver(pre_delete, sender=StimulusGroup)
+def _find_stimulusgroup_sessions(sender, instance: StimulusGroup, **kwargs):
+    # the rounds of the stimulusgroup are SET_NULL by an update, with no
+    # signals sent, so that their sessions are found before
+    instance._round_session_ids = list(Round.objects.filter(stimulusgroup=instance)
+                                       .values_list('session_id', flat=True).distinct())
+
+
+@receiver(post_delete, sender=StimulusGroup)
+def _invalidate_stimulusgroup_ordering(sender, instance: StimulusGroup, **kwargs):
+    _invalidate_sessions(getattr(instance, '_round_session_ids', []))
+
+
+@receiver(post_save, sender=Session)
+@receiver(post_delete, sender=Session)
+def _invalidate_session_ordering(sender, instance: Session, **kwargs):
+    ExperimentController._get_ordering_for_session.invalidate(instance.id)
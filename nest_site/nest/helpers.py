@@ -1,11 +1,15 @@
+import heapq
 import os
 import re
+import threading
+import time
+import weakref
 
 from abc import ABCMeta, abstractmethod
-from collections.abc import Hashable
-from functools import partial
+from collections import namedtuple, OrderedDict
+from functools import partial, update_wrapper
 from io import StringIO
-from typing import List, Optional
+from typing import Dict, Iterable, List, Optional
 
 import matplotlib.pyplot as plt
 from lxml import etree
@@ -167,6 +171,61 @@ def my_argmin(a: List[int], shortlist: Optional[List[int]] = None):
     return argmin
 
 
+class LeastWeightCandidates(object):
+    """
+    Candidate indices of a, grouped by their value in a, to repeatedly take
+    one of the candidates of least value. Taking the candidate at position
+    of least_candidates() is equivalent to
+    candidates.remove(my_argmin(a, candidates)[position]), provided a does not
+    change for the remaining candidates, but costs O(log N) plus the number
+    of ties, instead of O(N^2). The groups are kept in a heap by value.
+
+    >>> c = LeastWeightCandidates([1, 1, 2, 4], [0, 1, 3])
+    >>> c.least_candidates()
+    [0, 1]
+    >>> c.take(1)
+    1
+    >>> c.take(0)
+    0
+    >>> c.least_candidates()
+    [3]
+    >>> len(c)
+    1
+    >>> c.take(0)
+    3
+    >>> c.least_candidates()
+    []
+    """
+
+    def __init__(self, a: List[int], shortlist: Iterable[int]):
+        self._groups: Dict[int, List[int]] = dict()
+        for i in sorted(shortlist):
+            self._groups.setdefault(a[i], list()).append(i)
+        self._heap = list(self._groups.keys())
+        heapq.heapify(self._heap)
+        self._len = sum(len(group) for group in self._groups.values())
+
+    def __len__(self):
+        return self._len
+
+    def least_candidates(self) -> List[int]:
+        """Candidates of least value, in increasing order. Do not modify."""
+        if len(self._heap) == 0:
+            return list()
+        return self._groups[self._heap[0]]
+
+    def take(self, position: int) -> int:
+        """Remove and return the candidate at position of least_candidates()."""
+        value = self._heap[0]
+        group = self._groups[value]
+        i = group.pop(position)
+        if len(group) == 0:
+            del self._groups[value]
+            heapq.heappop(self._heap)
+        self._len -= 1
+        return i
+
+
 def indices(a, func):
     """
     Get indices of elements in an array which satisfies func
@@ -184,39 +243,108 @@ def indices(a, func):
     return [i for (i, val) in enumerate(a) if func(val)]
 
 
-class memoized(object):
-    """ Decorator. Caches a function's return value each time it is called.
-    If called later with the same arguments, the cached value is returned
-    (not reevaluated).
-
-    memoized is similar to persist, but if applied to
-    class methods, persist will cache on a per-class basis, while memoized
-    will cache on a per-object basis.
-
-    Taken from: https://wiki.python.org/moin/PythonDecoratorLibrary#Memoize
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'invalidations', 'currsize'])
+
+
+class instance_memoized(object):
+    """ Decorator of instance methods. Caches the return value per instance
+    and arguments, within bounds:
+
+    - each instance has its own cache, in a WeakKeyDictionary, so that the
+      cache goes away with the instance and does not keep it alive;
+    - each cache holds at most maxsize values, evicting the least recently
+      used, and, if ttl is not None, a value expires ttl seconds after it
+      was computed;
+    - invalidate(*args) drops the values of args from the caches of all the
+      instances, e.g. from a signal receiver when the underlying data change;
+    - cache_info() reports the hits, misses, evictions and invalidations so
+      far, and the number of values cached.
+
+    >>> class A(object):
+    ...     @instance_memoized(maxsize=2)
+    ...     def f(self, x):
+    ...         return x * 2
+    >>> a = A()
+    >>> a.f(1), a.f(1), a.f(2), a.f(3), a.f(1)
+    (2, 2, 4, 6, 2)
+    >>> A.f.cache_info()
+    CacheInfo(hits=1, misses=4, evictions=2, invalidations=0, currsize=2)
+    >>> A.f.invalidate(3)
+    >>> A.f.cache_info().currsize
+    1
+    >>> del a
+    >>> A.f.cache_info().currsize
+    0
     """
 
-    def __init__(self, func):
+    def __init__(self, maxsize: int = 128, ttl: Optional[float] = None):
+        assert isinstance(maxsize, int) and maxsize > 0
+        assert ttl is None or ttl > 0
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.func = None
+        self._caches: 'weakref.WeakKeyDictionary[object, OrderedDict]' = weakref.WeakKeyDictionary()
+        self._lock = threading.RLock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def __call__(self, func):
         self.func = func
-        self.cache = {}
-
-    def __call__(self, *args):
-        if not isinstance(args, Hashable):
-            return self.func(*args)
-        if args in self.cache:
-            return self.cache[args]
-        else:
-            value = self.func(*args)
-            self.cache[args] = value
-            return value
-
-    def __repr__(self):
-        """ Return the function's docstring. """
-        return self.func.__doc__
+        update_wrapper(self, func)
+        return self
 
     def __get__(self, obj, objtype):
-        """ Support instance methods. """
-        return partial(self.__call__, obj)
+        """ Support instance methods; on the class, return the decorator. """
+        if obj is None:
+            return self
+        return partial(self._call, obj)
+
+    def _call(self, obj, *args):
+        try:
+            hash(args)
+        except TypeError:
+            return self.func(obj, *args)
+        with self._lock:
+            cache = self._caches.get(obj)
+            if cache is not None and args in cache:
+                value, expiry = cache[args]
+                if expiry is None or time.monotonic() < expiry:
+                    cache.move_to_end(args)
+                    self._hits += 1
+                    return value
+                del cache[args]
+            self._misses += 1
+        # computed outside of the lock, so that other instances, or other
+        # arguments, are not held up
+        value = self.func(obj, *args)
+        with self._lock:
+            cache = self._caches.setdefault(obj, OrderedDict())
+            cache[args] = (value, None if self.ttl is None else time.monotonic() + self.ttl)
+            cache.move_to_end(args)
+            while len(cache) > self.maxsize:
+                cache.popitem(last=False)
+                self._evictions += 1
+        return value
+
+    def invalidate(self, *args):
+        """ Drop the values cached for args, in all the instances. """
+        with self._lock:
+            for cache in list(self._caches.values()):
+                if cache.pop(args, None) is not None:
+                    self._invalidations += 1
+
+    def cache_clear(self):
+        """ Drop all the values cached, and reset the statistics. """
+        with self._lock:
+            self._caches.clear()
+            self._hits = self._misses = self._evictions = self._invalidations = 0
+
+    def cache_info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._evictions, self._invalidations,
+                             sum(len(cache) for cache in self._caches.values()))
 
 
 def map_path_to_noise_rmse(path: str) -> Optional[int]:
@@ -3,17 +3,22 @@ import logging
 import os
 import random
 import string
+import time
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Optional
 
+import django
 import numpy as np
 import pandas as pd
 from django.contrib.auth.models import User
 from django.db import transaction
 from django.db.utils import IntegrityError
-from nest.config import ExperimentConfig, NestConfig, StimulusConfig
-from nest.control import ExperimentController, SessionStatus
+from nest.config import ConfigValidationError, ExperimentConfig, ExperimentConfigCache, media_path_verifier, NestConfig, \
+    StimulusConfig, ValidationCertificate
+from nest.config_storage import get_experiment_config_storage
+from nest.control import ExperimentController, SessionStatus, StimulusConfigDiff
 from nest.helpers import empty_object, map_path_to_noise_rmse, override
-from nest.models import Content, DiscreteVote, Experiment, Experimenter, ExperimentRegister, Round, \
+from nest.models import Content, DiscreteVote, Experiment, ExperimentConfigVersion, Experimenter, ExperimentRegister, Round, \
     Session, Stimulus, StimulusGroup, StimulusVoteGroup, Subject, Vote, VoteRegister
 from nest.pages import CcrPage, map_methodology_to_page_class
 from nest.sites import NestSite
@@ -533,7 +538,7 @@ def export_sureal_dataset(experiment_title, ignore_against: bool = False):  # no
     try:
         config = NestSite._load_experiment_config2(experiment_title, is_test=False)
         ec = NestSite._get_experiment_controller2(experiment, config)
-    except FileNotFoundError:
+    except (FileNotFoundError, ExperimentConfigVersion.DoesNotExist):
         ec = None
 
     sessions = Session.objects.filter(experiment=experiment).all()
@@ -687,19 +692,11 @@ class ExperimentUtils(object):
     def get_experiment_controller(experiment_title: str,
                                   config: dict = None,
                                   skip_path_check: bool = False) -> ExperimentController:
-        if config is None:
-            with open(NestConfig.media_path('experiment_config',
-                                            f"{experiment_title}.json"),
-                      "rt") as fp:
-                config = json.load(fp)
         exp = Experiment.objects.get(title=experiment_title)
-        assert isinstance(config, dict)
-        assert 'stimulus_config' in config
-        assert 'experiment_config' in config
-        scfg = StimulusConfig(config['stimulus_config'],
-                              skip_path_check=skip_path_check)
-        ecfg = ExperimentConfig(stimulus_config=scfg,
-                                config=config['experiment_config'])
+        if config is None:
+            ecfg = get_experiment_config_storage().load(experiment_title, skip_path_check=skip_path_check)
+        else:
+            ecfg = ExperimentConfigCache.compile(config, skip_path_check=skip_path_check)
         ec = ExperimentController(experiment=exp, experiment_config=ecfg)
         return ec
 
@@ -727,21 +724,16 @@ class ExperimentUtils(object):
         target_config_filepath = NestSite.get_experiment_config_filepath(
             experiment_title, is_test=is_test)
         assert target_config_filepath != source_config_filepath
-        os.makedirs(os.path.dirname(target_config_filepath), exist_ok=True)
         with open(source_config_filepath, 'rt') as fp_source:
-            with open(target_config_filepath, 'wt') as fp_target:
-                config = json.load(fp_source)
-                if is_test:
-                    config['experiment_config']['random_seed'] = random_seed
-                    config['experiment_config']['title'] = experiment_title
-                else:
-                    if random_seed is not None:
-                        config['experiment_config']['random_seed'] = random_seed
-                    if experiment_title is not None:
-                        config['experiment_config']['title'] = experiment_title
-                json.dump(config, fp_target, indent=4)
-        with open(target_config_filepath, 'rt') as fp:
-            config = json.load(fp)
+            config = json.load(fp_source)
+        if is_test:
+            config['experiment_config']['random_seed'] = random_seed
+            config['experiment_config']['title'] = experiment_title
+        else:
+            if random_seed is not None:
+                config['experiment_config']['random_seed'] = random_seed
+            if experiment_title is not None:
+                config['experiment_config']['title'] = experiment_title
         if is_test:
             scfg = StimulusConfig(config['stimulus_config'], skip_path_check=True)
         else:
@@ -751,15 +743,42 @@ class ExperimentUtils(object):
         e = Experiment(title=config['experiment_config']['title'],
                        description=config['experiment_config']['description'])
         e.save()
+        get_experiment_config_storage().save(e, config, path_checked=not is_test, is_test=is_test)
         ec = ExperimentController(experiment=e, experiment_config=ecfg)
         ec.populate_stimuli()
         return ec
 
     @classmethod
     def validate_config(cls,
-                        experiment_config_filepath: str):
+                        experiment_config_filepath: str,
+                        write_certificate: bool = False):
         """
-        Validate if the experiment config file is a good one.
+        Validate if the experiment config file is a good one. If so and
+        write_certificate is True, write a ValidationCertificate next to it;
+        otherwise the certificate is issued when the config is saved by the
+        experiment config storage, at experiment creation.
+        """
+        with open(experiment_config_filepath, 'rb') as fp_source:
+            data = fp_source.read()
+        config = json.loads(data)
+        experiment_title = config['experiment_config']['title']
+        try:
+            Experiment.objects.get(title=experiment_title)
+            raise AssertionError(
+                f"Experiment with title {experiment_title} already exists.")
+        except Experiment.DoesNotExist:
+            pass
+        cls._validate_config_dict(config)
+
+        if write_certificate:
+            ValidationCertificate.issue(experiment_config_filepath, data, path_checked=True)
+
+    @staticmethod
+    def _validate_config_dict(config: dict, **more):
+        """
+        Validate the content of a config, without any DB access. Keyword
+        arguments in more (e.g. skip_path_check) are passed on to
+        StimulusConfig.
         """
 
         # do not check validity of these fields
@@ -773,16 +792,7 @@ class ExperimentUtils(object):
             'stimulusvotegroup_id': 0,
         }
 
-        with open(experiment_config_filepath, 'rt') as fp_source:
-            config = json.load(fp_source)
-        experiment_title = config['experiment_config']['title']
-        try:
-            Experiment.objects.get(title=experiment_title)
-            raise AssertionError(
-                f"Experiment with title {experiment_title} already exists.")
-        except Experiment.DoesNotExist:
-            pass
-        scfg = StimulusConfig(config['stimulus_config'])
+        scfg = StimulusConfig(config['stimulus_config'], **more)
         ecfg = ExperimentConfig(
             stimulus_config=scfg,
             config=config['experiment_config'])
@@ -815,6 +825,103 @@ class ExperimentUtils(object):
 
         _ = scfg.super_stimulusgroup_ids
 
+    @classmethod
+    def validate_configs(cls,
+                         experiment_config_filepaths: List[str],
+                         max_workers: Optional[int] = None,
+                         write_certificate: bool = False) -> List[dict]:
+        """
+        Validate many config files, reporting on every file instead of
+        stopping at the first invalid one. Files are validated in parallel in
+        a pool of max_workers processes (by default, one per CPU), without
+        their media path check; the media paths of all files are then
+        verified together, once per distinct path, by the shared
+        media_path_verifier. A ValidationCertificate is written next to each
+        valid file if write_certificate is True.
+
+        Return one dict per file, in order, of:
+        {'config_filepath': <path>, 'title': <title, or None if unreadable>,
+         'ok': <bool>, 'violations': <list of violations>, 'seconds': <time spent on the file>}
+        """
+        experiment_config_filepaths = list(experiment_config_filepaths)
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        assert isinstance(max_workers, int) and max_workers > 0
+        if max_workers == 1 or len(experiment_config_filepaths) <= 1:
+            results = [cls._validate_config_file(path) for path in experiment_config_filepaths]
+        else:
+            with ProcessPoolExecutor(max_workers=min(max_workers, len(experiment_config_filepaths)),
+                                     initializer=django.setup) as executor:
+                results = list(executor.map(cls._validate_config_file, experiment_config_filepaths))
+
+        start_time = time.time()
+        url_paths = set()
+        for result in results:
+            url_paths.update(result['url_path_indices'].keys())
+        failures = {f['url_path']: f for f in media_path_verifier.verify(sorted(url_paths))}
+        path_check_seconds = time.time() - start_time
+
+        titles = [result['title'] for result in results if result['title'] is not None]
+        existing_titles = set(Experiment.objects.filter(title__in=titles).values_list('title', flat=True))
+
+        for result in results:
+            url_path_indices = result.pop('url_path_indices')
+            content_hash = result.pop('content_hash')
+            for url_path, idx in url_path_indices.items():
+                if url_path in failures:
+                    result['violations'].append({'section': 'stimuli', 'index': idx,
+                                                 'message': StimulusConfig.get_path_failure_message(failures[url_path])})
+            if result['title'] in existing_titles:
+                result['violations'].append({'section': 'experiment_config', 'index': None,
+                                             'message': f"Experiment with title {result['title']} already exists."})
+            # the shared path check is accounted to each file pro rata
+            result['seconds'] += path_check_seconds * len(url_path_indices) / max(len(url_paths), 1)
+            result['ok'] = len(result['violations']) == 0
+            if result['ok'] and write_certificate:
+                with open(result['config_filepath'], 'rb') as fp:
+                    data = fp.read()
+                # skip files changed since they were validated
+                if ValidationCertificate.hash_content(data) == content_hash:
+                    ValidationCertificate.issue(result['config_filepath'], data, path_checked=True)
+        return results
+
+    @classmethod
+    def _validate_config_file(cls, experiment_config_filepath: str) -> dict:
+        """
+        Validate one config file for validate_configs(), in a worker process.
+        """
+        start_time = time.time()
+        result = {
+            'config_filepath': experiment_config_filepath,
+            'title': None,
+            'violations': list(),
+            'content_hash': None,
+            'url_path_indices': dict(),
+        }
+        try:
+            with open(experiment_config_filepath, 'rb') as fp:
+                data = fp.read()
+            result['content_hash'] = ValidationCertificate.hash_content(data)
+            config = json.loads(data)
+            result['title'] = config['experiment_config']['title']
+        except Exception as e:
+            result['violations'].append({'section': None, 'index': None, 'message': f'{type(e).__name__}: {e}'})
+        else:
+            stimulus_config = config.get('stimulus_config')
+            stimuli = stimulus_config.get('stimuli') if isinstance(stimulus_config, dict) else None
+            if isinstance(stimuli, list):
+                for idx, s in enumerate(stimuli):
+                    if isinstance(s, dict) and isinstance(s.get('path'), str):
+                        result['url_path_indices'].setdefault(s['path'], idx)
+            try:
+                cls._validate_config_dict(config, skip_path_check=True)
+            except ConfigValidationError as e:
+                result['violations'] += e.report.violations
+            except Exception as e:
+                result['violations'].append({'section': None, 'index': None, 'message': f'{type(e).__name__}: {e}'})
+        result['seconds'] = time.time() - start_time
+        return result
+
     @classmethod
     def create_experiment(cls,
                           experiment_config_filepath: str,
@@ -842,6 +949,48 @@ class ExperimentUtils(object):
 
         return ec
 
+    @classmethod
+    def update_experiment_config(cls,
+                                 experiment_config_filepath: str,
+                                 experiment_title: str = None,
+                                 is_test: bool = False,
+                                 dry_run: bool = False) -> StimulusConfigDiff:
+        """
+        Hot-reload the config of an existing experiment from the config file
+        specified by experiment_config_filepath. The stimuli in the DB are
+        brought in line with the new config by applying only the differences,
+        the stored config is replaced, and the step plans of the sessions are
+        recompiled. experiment_title, if not None, overrides the title in the
+        config file. With dry_run, only return the
+        differences. Raise AssertionError, changing nothing, if the new config
+        would orphan existing votes.
+        """
+        with open(experiment_config_filepath, 'rt') as fp:
+            config = json.load(fp)
+        if experiment_title is None:
+            experiment_title = config['experiment_config']['title']
+        else:
+            assert isinstance(experiment_title, str)
+            config['experiment_config']['title'] = experiment_title
+        if is_test:
+            scfg = StimulusConfig(config['stimulus_config'], skip_path_check=True)
+        else:
+            scfg = StimulusConfig(config['stimulus_config'])
+        ecfg = ExperimentConfig(stimulus_config=scfg,
+                                config=config['experiment_config'])
+        exp: Experiment = Experiment.objects.get(title=experiment_title)
+        ec = ExperimentController(experiment=exp, experiment_config=ecfg)
+        if dry_run:
+            return ec.diff_stimulus_config(scfg)
+        with transaction.atomic():
+            diff = ec.apply_stimulus_config(scfg)
+            if exp.description != ecfg.description:
+                exp.description = ecfg.description
+                exp.save()
+            get_experiment_config_storage().save(exp, config, path_checked=not is_test, is_test=is_test)
+            ec.compile_session_step_plans()
+        return diff
+
     @classmethod
     def delete_experiment_by_title(cls,
                                    experiment_title: str = None,
@@ -849,14 +998,14 @@ class ExperimentUtils(object):
                                    ):
         """
         Delete an experiment by experiment_title, through cleaning up the
-        relevant objects in the DB and removing the config file.
+        relevant objects in the DB and removing the stored config.
         """
-        target_config_filepath = NestSite.get_experiment_config_filepath(
-            experiment_title, is_test=is_test)
-        assert os.path.exists(target_config_filepath), f"target config file {target_config_filepath} does not exist."
+        storage = get_experiment_config_storage()
+        assert storage.exists(experiment_title, is_test=is_test), \
+            f"config of experiment {experiment_title} does not exist."
         exp: Experiment = Experiment.objects.get(title=experiment_title)
         exp.delete()
-        os.remove(target_config_filepath)
+        storage.delete(experiment_title, is_test=is_test)
 
     @classmethod
     def add_session_to_experiment(cls,
@@ -877,6 +1026,30 @@ class ExperimentUtils(object):
             subj = Subject.create_by_username(subject_username)
         return ec.add_session(subj)
 
+    @classmethod
+    def add_sessions_to_experiment(cls,
+                                   experiment_title: str,
+                                   subject_usernames: List[str],
+                                   config: dict = None,
+                                   skip_path_check: bool = False) -> List[Session]:
+        """
+        Add a new session (Not started) to experiment with experiment_title for
+        each of subject_usernames, in order, creating the subjects that do not
+        exist. The sessions are the same as from add_session_to_experiment for
+        each username in turn, but are created in bulk. config default to None
+        and should be read from a config file, and is only supplied for testing
+        purpose. skip_path_check is True only for testing purpose.
+        """
+        ec = cls.get_experiment_controller(experiment_title, config, skip_path_check)
+
+        subjs = list()
+        for subject_username in subject_usernames:
+            subj = Subject.find_by_username(subject_username)
+            if subj is None:
+                subj = Subject.create_by_username(subject_username)
+            subjs.append(subj)
+        return ec.add_sessions(subjs)
+
     @classmethod
     def delete_session_by_id(cls,
                              session_id: int,
@@ -891,6 +1064,21 @@ class ExperimentUtils(object):
         ec = cls.get_experiment_controller(experiment_title, config, skip_path_check)
         ec.delete_session(session_id)
 
+    @classmethod
+    def check_exposures(cls,
+                        experiment_title: str,
+                        dry_run: bool = False,
+                        config: dict = None,
+                        skip_path_check: bool = False) -> bool:
+        """
+        Tell if the exposure counts of the experiment with experiment_title add
+        up to its number of rounds, rebuilding them if not, unless dry_run.
+        config dict not None is only for testing purpose. skip_path_check True
+        only for testing purpose.
+        """
+        ec = cls.get_experiment_controller(experiment_title, config, skip_path_check)
+        return ec.check_exposures(rebuild=not dry_run)
+
     @classmethod
     def update_subject_for_session(cls,
                                    experiment_title: str,
@@ -953,9 +1141,8 @@ class ESUtilities(object):
         dd_svg = dict(zip([s['stimulusvotegroup_id'] for s in stimuli_info['stimulusvotegroups']], stimuli_info['stimulusvotegroups']))
 
         rows = list()
-        session: Session
-        for session in ec.experiment.session_set.all():
-            sess_info: dict = ec.get_session_info(session)
+        sess_info: dict
+        for sess_info in ec.get_session_infos(ec.experiment.session_set.all()):
             assert 'subject' in sess_info
             assert 'rounds' in sess_info
             rd: dict
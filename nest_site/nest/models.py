@@ -1,10 +1,14 @@
 from __future__ import annotations
 
+import json
 from abc import ABCMeta, abstractmethod
-from typing import List
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from django.contrib.auth.models import User
-from django.db import models, transaction
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, models, transaction
+from django.db.models.signals import post_save, pre_delete
+from django.dispatch import receiver
 from django.utils import timezone
 from polymorphic.models import PolymorphicModel
 
@@ -158,6 +162,9 @@ class Experiment(GenericModel):
     experimenters = models.ManyToManyField(Experimenter,
                                            through='ExperimentRegister',
                                            blank=True)
+    # bumped first by every assignment of sessions, taking the row lock that
+    # serializes concurrent ones, see ExperimentController.add_sessions
+    assignment_version = models.PositiveIntegerField('assignment version', default=0)
 
     def __str__(self):
         return super().__str__() + f' ({self.title})'
@@ -178,6 +185,32 @@ class ExperimentRegister(GenericModel):
     experimenter = models.ForeignKey(Experimenter, on_delete=models.CASCADE)
 
 
+class ExperimentConfigVersion(GenericModel):
+    """
+    Version of the config of an Experiment, used when the
+    EXPERIMENT_CONFIG_STORAGE setting is 'database'. Every save adds a new
+    version, and the highest version is the current config.
+    """
+    experiment: Experiment = models.ForeignKey(Experiment,
+                                               on_delete=models.CASCADE)
+    version = models.PositiveIntegerField('version')
+    content = models.TextField('config json')
+    content_hash = models.CharField('sha256 of config json', max_length=64)
+    validator_version = models.IntegerField('validator version')
+    path_check_date = models.DateTimeField('date media paths checked',
+                                           null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['experiment', 'version'],
+                                    name='unique_experiment_config_version'),
+        ]
+
+    def __str__(self):
+        return super().__str__() + \
+               f' ({str(self.experiment)}, version {self.version})'
+
+
 class Session(GenericModel):
     """
     An continous interval within an Experiment, associated with one Subject.
@@ -190,12 +223,50 @@ class Session(GenericModel):
     subject: Subject = models.ForeignKey(Subject,
                                          on_delete=models.SET_NULL,
                                          null=True, blank=True)
+    # compiled sequence of rounds and additions of the Session, see
+    # ExperimentController.get_session_steps
+    step_plan = models.TextField('step plan', null=True, blank=True, default=None)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # to tell on save if the subject changed, see StimulusGroupExposure
+        instance._loaded_subject_id = instance.__dict__.get('subject_id')
+        return instance
 
     def __str__(self):
         return super().__str__() + \
                f' ({str(self.experiment)}, {str(self.subject)})'
 
 
+class SessionProgressRecord(GenericModel):
+    """
+    A step performed, or a round shown, by a user in the Session in
+    progress, used when the SESSION_PROGRESS_STORAGE setting is 'database'.
+    Rows are appended, and deleted together when the progress is cleared.
+    record is the compact json of the step (see
+    progress_storage.SessionProgress) or of the round_pk and start time.
+    """
+    STEP = 's'
+    ROUND_START = 'r'
+
+    user: User = models.ForeignKey(User, on_delete=models.CASCADE)
+    session: Session = models.ForeignKey(Session, on_delete=models.CASCADE)
+    kind = models.CharField('kind', max_length=1, choices=[(STEP, 'step'), (ROUND_START, 'round start')])
+    record = models.TextField('record json')
+
+    @staticmethod
+    def dumps(record: list) -> str:
+        return json.dumps(record, separators=(',', ':'))
+
+    @staticmethod
+    def loads(record: str) -> list:
+        return json.loads(record)
+
+    def __str__(self):
+        return super().__str__() + f' ({self.user_id}, {self.session_id}, {self.kind}: {self.record})'
+
+
 class Content(GenericModel):
     """
     A.k.a. source. The source material where a Stimulus can be created based on.
@@ -428,6 +499,13 @@ class Round(GenericModel):
                                                      null=True, blank=True)
     response_sec = models.FloatField('response sec', null=True, blank=True)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # to tell on save if the assignment changed, see StimulusGroupExposure
+        instance._loaded_assignment = (instance.__dict__.get('session_id'), instance.__dict__.get('stimulusgroup_id'))
+        return instance
+
     def __str__(self):
         return super().__str__() + " ({}, {}, {})".format(
             self.session,
@@ -437,6 +515,193 @@ class Round(GenericModel):
         )
 
 
+class StimulusGroupExposure(GenericModel):
+    """
+    Number of Rounds, across all Sessions of an Experiment, that have been
+    assigned a StimulusGroup. Together with SubjectStimulusGroupExposure, it
+    is the weight histogram used to assign StimulusGroups to a new Session,
+    so that the assignment does not need to read all the Rounds so far.
+
+    The counts are kept up to date when Rounds are saved or deleted, and when
+    the Subject of a Session changes, by the signal receivers below. Code
+    that bypasses signals, e.g. with bulk_create, must call add() itself.
+    """
+    experiment: Experiment = models.ForeignKey(Experiment, on_delete=models.CASCADE)
+    stimulusgroup: StimulusGroup = models.ForeignKey(StimulusGroup, on_delete=models.CASCADE)
+    count = models.IntegerField('number of rounds', default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['stimulusgroup'],
+                                    name='unique_stimulusgroup_exposure'),
+        ]
+
+    def __str__(self):
+        return super().__str__() + f' ({self.stimulusgroup_id}: {self.count})'
+
+    # Subjects per update of SubjectStimulusGroupExposure, to keep the
+    # expression depth and number of parameters within the DB backend limits
+    SUBJECT_BATCH_SIZE = 100
+
+    @staticmethod
+    def _whens(counts: dict, **kwargs) -> List[models.When]:
+        groups: Dict[int, list] = dict()
+        for sg_pk, n in counts.items():
+            if n != 0:
+                groups.setdefault(n, list()).append(sg_pk)
+        return [models.When(then=models.Value(n), stimulusgroup_id__in=sg_pks, **kwargs) for n, sg_pks in groups.items()]
+
+    @staticmethod
+    def _increment(whens: List[models.When]):
+        # one update for all the rows, whatever their increment, which is mostly 1
+        return models.F('count') + models.Case(*whens, default=models.Value(0), output_field=models.IntegerField())
+
+    @classmethod
+    def add(cls, assignments: Iterable[Tuple[Optional[int], Optional[int]]], increment: int = 1):
+        """
+        Add increment to the exposure counts of assignments, an iterable of
+        (StimulusGroup pk, Subject pk) pairs, one per Round. A None
+        StimulusGroup is not counted; a None Subject only counts towards
+        StimulusGroupExposure. Missing rows are only created on increment,
+        so the common case costs one update query per table, however many
+        Rounds and Subjects there are (up to SUBJECT_BATCH_SIZE Subjects).
+        """
+        counts: Dict[int, int] = dict()
+        subject_counts: Dict[int, Dict[int, int]] = dict()
+        for sg_pk, subject_pk in assignments:
+            if sg_pk is None:
+                continue
+            counts[sg_pk] = counts.get(sg_pk, 0) + increment
+            if subject_pk is not None:
+                d = subject_counts.setdefault(subject_pk, dict())
+                d[sg_pk] = d.get(sg_pk, 0) + increment
+        if len(counts) == 0:
+            return
+
+        updated = cls.objects.filter(stimulusgroup_id__in=list(counts.keys())) \
+            .update(count=cls._increment(cls._whens(counts)))
+        if updated < len(counts):
+            existing = set(cls.objects.filter(stimulusgroup_id__in=list(counts.keys()))
+                           .values_list('stimulusgroup_id', flat=True))
+            cls.objects.bulk_create([
+                cls(experiment_id=experiment_id, stimulusgroup_id=sg_pk, count=counts[sg_pk])
+                for sg_pk, experiment_id in StimulusGroup.objects
+                .filter(id__in=[sg_pk for sg_pk, n in counts.items() if n > 0 and sg_pk not in existing],
+                        experiment__isnull=False)
+                .values_list('id', 'experiment_id')])
+
+        subject_pks = list(subject_counts.keys())
+        for i in range(0, len(subject_pks), cls.SUBJECT_BATCH_SIZE):
+            batch = subject_pks[i:i + cls.SUBJECT_BATCH_SIZE]
+            q = models.Q()
+            whens = list()
+            for subject_pk in batch:
+                q |= models.Q(subject_id=subject_pk, stimulusgroup_id__in=list(subject_counts[subject_pk].keys()))
+                whens += cls._whens(subject_counts[subject_pk], subject_id=subject_pk)
+            qs = SubjectStimulusGroupExposure.objects.filter(q)
+            updated = qs.update(count=cls._increment(whens))
+            if updated < sum(len(subject_counts[subject_pk]) for subject_pk in batch):
+                existing = set(qs.values_list('subject_id', 'stimulusgroup_id'))
+                SubjectStimulusGroupExposure.objects.bulk_create([
+                    SubjectStimulusGroupExposure(subject_id=subject_pk, stimulusgroup_id=sg_pk, count=n)
+                    for subject_pk in batch for sg_pk, n in subject_counts[subject_pk].items()
+                    if n > 0 and (subject_pk, sg_pk) not in existing])
+
+    @classmethod
+    @transaction.atomic
+    def rebuild(cls, experiment: Experiment):
+        """
+        Recount the exposures of experiment from its Rounds, e.g. for an
+        Experiment created before the counts were kept.
+        """
+        cls.objects.filter(experiment=experiment).delete()
+        SubjectStimulusGroupExposure.objects.filter(stimulusgroup__experiment=experiment).delete()
+        cls.add(Round.objects
+                .filter(session__experiment=experiment)
+                .values_list('stimulusgroup_id', 'session__subject_id'))
+
+
+class SubjectStimulusGroupExposure(GenericModel):
+    """
+    Number of Rounds, across all Sessions of a Subject, that have been
+    assigned a StimulusGroup. See StimulusGroupExposure.
+    """
+    subject: Subject = models.ForeignKey(Subject, on_delete=models.CASCADE)
+    stimulusgroup: StimulusGroup = models.ForeignKey(StimulusGroup, on_delete=models.CASCADE)
+    count = models.IntegerField('number of rounds', default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['subject', 'stimulusgroup'],
+                                    name='unique_subject_stimulusgroup_exposure'),
+        ]
+
+    def __str__(self):
+        return super().__str__() + f' ({self.subject_id}, {self.stimulusgroup_id}: {self.count})'
+
+
+@receiver(post_save, sender=Round)
+def _count_saved_round(sender, instance: Round, created: bool, raw: bool, **kwargs):
+    if raw:
+        return
+    if created:
+        before = None
+    else:
+        before = getattr(instance, '_loaded_assignment', None)
+        if before is None:
+            # not loaded from the DB in full: cannot tell what changed
+            return
+        if before == (instance.session_id, instance.stimulusgroup_id):
+            return
+        before_subject_id = Session.objects.values_list('subject_id', flat=True).get(id=before[0]) \
+            if before[0] is not None else None
+        StimulusGroupExposure.add([(before[1], before_subject_id)], increment=-1)
+    subject_id = instance.session.subject_id if instance.session_id is not None else None
+    StimulusGroupExposure.add([(instance.stimulusgroup_id, subject_id)])
+    instance._loaded_assignment = (instance.session_id, instance.stimulusgroup_id)
+
+
+# lookups from Round of the objects whose deletion deletes Rounds
+_ROUND_DELETE_ORIGIN_LOOKUPS = {Round: 'pk', Session: 'session'}
+
+
+@receiver(pre_delete, sender=Round)
+def _count_deleted_rounds(sender, instance: Round, origin=None, **kwargs):
+    # pre_delete, since the Session may be deleted along with its Rounds.
+    # The Rounds of a delete are counted all at once, on the signal of the
+    # first one, with one aggregated update, rather than one per Round.
+    if isinstance(origin, Experiment) or \
+            (isinstance(origin, models.QuerySet) and issubclass(origin.model, Experiment)):
+        # the counts are deleted along with the experiment
+        return
+    model = origin.model if isinstance(origin, models.QuerySet) else type(origin)
+    lookup = next((v for k, v in _ROUND_DELETE_ORIGIN_LOOKUPS.items() if issubclass(model, k)), None)
+    if lookup is None:
+        subject_id = Session.objects.values_list('subject_id', flat=True).filter(id=instance.session_id).first()
+        StimulusGroupExposure.add([(instance.stimulusgroup_id, subject_id)], increment=-1)
+        return
+    if getattr(origin, '_deleted_rounds_counted', False):
+        return
+    if isinstance(origin, models.QuerySet):
+        rounds = Round.objects.filter(**{f'{lookup}__in': origin.values('pk')})
+    else:
+        rounds = Round.objects.filter(**{lookup: origin.pk})
+    StimulusGroupExposure.add(rounds.values_list('stimulusgroup_id', 'session__subject_id'), increment=-1)
+    origin._deleted_rounds_counted = True
+
+
+@receiver(post_save, sender=Session)
+def _count_session_subject_change(sender, instance: Session, created: bool, raw: bool, **kwargs):
+    if raw or created or not hasattr(instance, '_loaded_subject_id'):
+        return
+    if instance._loaded_subject_id == instance.subject_id:
+        return
+    sg_pks = list(Round.objects.filter(session=instance).values_list('stimulusgroup_id', flat=True))
+    StimulusGroupExposure.add([(sg_pk, instance._loaded_subject_id) for sg_pk in sg_pks], increment=-1)
+    StimulusGroupExposure.add([(sg_pk, instance.subject_id) for sg_pk in sg_pks])
+    instance._loaded_subject_id = instance.subject_id
+
+
 class Vote(GenericModel, TypeVersionEnabled):
     """
     Abtract class for a Vote.
@@ -465,9 +730,58 @@ class Vote(GenericModel, TypeVersionEnabled):
     TYPE = 'VOTE'
     VERSION = '1.0'
 
+    class Meta:
+        # also makes recording the votes of a round idempotent against a
+        # double submission, see ExperimentController.record_session_votes
+        constraints = [
+            models.UniqueConstraint(fields=['round', 'stimulusvotegroup'],
+                                    name='unique_round_stimulusvotegroup_vote'),
+        ]
+
     def __str__(self):
         return super().__str__() + f' ({self.score})'
 
+    @classmethod
+    def bulk_create_votes(cls, votes: Iterable[Vote]) -> List[Vote]:
+        """
+        Save new votes of any subclasses in bulk, setting their primary keys.
+        QuerySet.bulk_create does not support the multi-table inheritance of
+        the subclasses, so the Vote rows are created in bulk first, typed as
+        their subclasses, and then the rows of the subclass tables, which
+        only hold the pointers to them.
+        """
+        votes = list(votes)
+        ctypes = dict()
+        for vote in votes:
+            vote_class = type(vote)
+            assert vote.pk is None, f'{vote} is already saved'
+            assert vote_class is Vote or vote_class._meta.get_parent_list() == [Vote], \
+                f'expect a direct subclass of Vote, but got {vote_class.__name__}'
+            if vote_class not in ctypes:
+                ctypes[vote_class] = ContentType.objects.get_for_model(vote_class, for_concrete_model=False).pk
+        fields = [f for f in Vote._meta.concrete_fields if not f.primary_key and f.attname != 'polymorphic_ctype_id']
+        parents = Vote.objects.bulk_create([
+            Vote(**{f.attname: getattr(vote, f.attname) for f in fields}, polymorphic_ctype_id=ctypes[type(vote)])
+            for vote in votes])
+        qn = connection.ops.quote_name
+        for vote_class in ctypes:
+            if vote_class is Vote:
+                continue
+            ptr = vote_class._meta.pk
+            assert [f.column for f in vote_class._meta.local_concrete_fields] == [ptr.column], \
+                f'expect {vote_class.__name__} to have no fields of its own'
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    f'INSERT INTO {qn(vote_class._meta.db_table)} ({qn(ptr.column)}) VALUES (%s)',
+                    [(parent.pk,) for vote, parent in zip(votes, parents) if type(vote) is vote_class])
+        for vote, parent in zip(votes, parents):
+            assert parent.pk is not None, 'the DB backend must return the primary keys of bulk-created objects'
+            vote.pk = vote.id = parent.pk
+            vote.polymorphic_ctype_id = parent.polymorphic_ctype_id
+            vote._state.adding = False
+            vote._state.db = parent._state.db
+        return votes
+
 
 class VoteRegister(GenericModel):
     """
@@ -0,0 +1,432 @@
+import logging
+import os
+import uuid
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+
+logger = logging.getLogger(os.path.splitext(os.path.basename(__file__))[0])
+
+
+class SessionProgress(object):
+    """
+    Compact encoding of the steps of a Session performed so far. The steps
+    performed are always the first ones of the steps planned, so a step is
+    recorded as a list of its index in the steps planned, followed, for a
+    round step, by its response_sec and its scores as stimulusvotegroup_id,
+    score pairs:
+    [step_index] or [step_index, response_sec, svgid, score, svgid, score...]
+
+    The full step dicts are rebuilt from the steps planned, as stored by the
+    cookie before: additions without context, and rounds with the score
+    (keyed by str(stimulusvotegroup_id)) and response_sec added to the
+    context planned.
+    """
+
+    @staticmethod
+    def encode_step(step_index: int, step: dict) -> list:
+        if 'before_or_after' in step['position']:
+            return [step_index]
+        record = [step_index, step['context']['response_sec']]
+        for svgid, score in step['context']['score'].items():
+            record += [int(svgid), score]
+        return record
+
+    @staticmethod
+    def decode_steps(records: List[list], steps_planned: List[dict]) -> List[dict]:
+        """
+        Rebuild the steps performed from their records, in order. A step
+        recorded again, e.g. by a double submission racing the first, is
+        ignored.
+        """
+        steps = list()
+        for record in records:
+            step_index = len(steps)
+            if record[0] < step_index:
+                continue
+            assert record[0] == step_index, \
+                f'expect step {step_index} to be recorded, but got step {record[0]}'
+            splan = steps_planned[step_index]
+            step = {'position': dict(splan['position'])}
+            if len(record) > 1:
+                pairs = record[2:]
+                step['context'] = {
+                    **splan['context'],
+                    'score': {str(pairs[i]): pairs[i + 1] for i in range(0, len(pairs), 2)},
+                    'response_sec': record[1],
+                }
+            steps.append(step)
+        return steps
+
+
+class SessionProgressTooLarge(Exception):
+    """
+    Raised by add_step of a storage that cannot hold the step, before the
+    step is recorded.
+    """
+    pass
+
+
+class SessionProgressStorage(object):
+    """
+    Abstract storage of the progress of the logged-in subject through a
+    Session, kept between the requests of step_session: the session_id, the
+    steps performed so far, and the start time of the rounds shown. Only
+    one Session is in progress at a time; starting one clears the progress.
+
+    Recording a step adds to the progress, rather than rewriting it.
+    process_response is called on every response of NestSite, for storages
+    that write to the response.
+    """
+
+    def get_session_id(self, request) -> Optional[int]:
+        raise NotImplementedError
+
+    def get_num_steps(self, request) -> int:
+        raise NotImplementedError
+
+    def get_steps(self, request, steps_planned: List[dict]) -> List[dict]:
+        """
+        Return the steps performed so far, as dicts, given the steps planned
+        for the session in progress.
+        """
+        raise NotImplementedError
+
+    def add_step(self, request, session_id: int, step_index: int, step: dict):
+        """
+        Record step, the step_index-th step performed of session_id. Steps
+        are added in order, and a step of another session_id than the one in
+        progress starts over. Raise SessionProgressTooLarge if step cannot be
+        held, leaving the progress as it is.
+        """
+        raise NotImplementedError
+
+    def get_round_start_sec(self, request, round_pk: int) -> Optional[float]:
+        raise NotImplementedError
+
+    def set_round_start_sec(self, request, session_id: int, round_pk: int, start_sec: float):
+        """
+        Record the time round_pk, a Round of session_id, was shown at. A
+        round of another session_id than the one in progress starts over.
+        """
+        raise NotImplementedError
+
+    def clear(self, request):
+        raise NotImplementedError
+
+    def process_response(self, request, response):
+        pass
+
+
+class RequestSessionProgressStorage(SessionProgressStorage):
+    """
+    Store the progress in request.session, as the full list of step dicts,
+    with the default session engine rewritten as a whole on every step.
+    """
+
+    def get_session_id(self, request) -> Optional[int]:
+        return request.session.setdefault('session_id', None)
+
+    def get_num_steps(self, request) -> int:
+        return len(request.session.setdefault('steps', []))
+
+    def get_steps(self, request, steps_planned: List[dict]) -> List[dict]:
+        return request.session.setdefault('steps', [])
+
+    def add_step(self, request, session_id: int, step_index: int, step: dict):
+        steps = request.session.setdefault('steps', []) if self.get_session_id(request) == session_id else []
+        assert step_index == len(steps), f'expect step {len(steps)} to be added, but got step {step_index}'
+        request.session['steps'] = steps + [step]
+        request.session['session_id'] = session_id
+
+    def get_round_start_sec(self, request, round_pk: int) -> Optional[float]:
+        return request.session.setdefault('round_response_sec', dict()).setdefault(str(round_pk), None)
+
+    def set_round_start_sec(self, request, session_id: int, round_pk: int, start_sec: float):
+        request.session.setdefault('round_response_sec', dict())[str(round_pk)] = start_sec
+        # since modification is not directly on session, but on dict of dict,
+        # need to explicitly tell the session has been modified:
+        request.session.modified = True
+
+    def clear(self, request):
+        for key in ['session_id', 'steps', 'round_response_sec']:
+            if key in request.session:
+                del request.session[key]
+
+
+class DatabaseSessionProgressStorage(SessionProgressStorage):
+    """
+    Store the progress as SessionProgressRecord rows of the user, one per
+    step performed or round shown. Rows are only ever inserted, and deleted
+    when the progress is cleared, so recording a step writes one row of
+    constant size. The rows are read once per request.
+
+    The models are imported locally, since this module is loaded by
+    NestSite before the app registry is ready.
+    """
+
+    ATTR = '_nest_progress_records'
+
+    def _load(self, request) -> Optional[dict]:
+        if not hasattr(request, self.ATTR):
+            from .models import SessionProgressRecord
+            progress = None
+            for session_id, kind, record in SessionProgressRecord.objects \
+                    .filter(user_id=request.user.pk) \
+                    .order_by('id') \
+                    .values_list('session_id', 'kind', 'record'):
+                if progress is None:
+                    progress = {'session_id': session_id, 'steps': list(), 'round_start_secs': dict()}
+                assert progress['session_id'] == session_id
+                if kind == SessionProgressRecord.STEP:
+                    progress['steps'].append(SessionProgressRecord.loads(record))
+                else:
+                    round_pk, start_sec = SessionProgressRecord.loads(record)
+                    progress['round_start_secs'][round_pk] = start_sec
+            setattr(request, self.ATTR, progress)
+        return getattr(request, self.ATTR)
+
+    def _add(self, request, session_id: int, kind: str, record: list):
+        from .models import SessionProgressRecord
+        progress = self._load(request)
+        if progress is None or progress['session_id'] != session_id:
+            if progress is not None:
+                self.clear(request)
+            progress = {'session_id': session_id, 'steps': list(), 'round_start_secs': dict()}
+            setattr(request, self.ATTR, progress)
+        SessionProgressRecord.objects.create(user_id=request.user.pk, session_id=session_id, kind=kind,
+                                             record=SessionProgressRecord.dumps(record))
+        return progress
+
+    def get_session_id(self, request) -> Optional[int]:
+        progress = self._load(request)
+        return None if progress is None else progress['session_id']
+
+    def get_num_steps(self, request) -> int:
+        progress = self._load(request)
+        return 0 if progress is None else len(progress['steps'])
+
+    def get_steps(self, request, steps_planned: List[dict]) -> List[dict]:
+        progress = self._load(request)
+        return [] if progress is None else SessionProgress.decode_steps(progress['steps'], steps_planned)
+
+    def add_step(self, request, session_id: int, step_index: int, step: dict):
+        from .models import SessionProgressRecord
+        num_steps = self.get_num_steps(request) if self.get_session_id(request) == session_id else 0
+        assert step_index == num_steps, f'expect step {num_steps} to be added, but got step {step_index}'
+        record = SessionProgress.encode_step(step_index, step)
+        self._add(request, session_id, SessionProgressRecord.STEP, record)['steps'].append(record)
+
+    def get_round_start_sec(self, request, round_pk: int) -> Optional[float]:
+        progress = self._load(request)
+        return None if progress is None else progress['round_start_secs'].get(round_pk)
+
+    def set_round_start_sec(self, request, session_id: int, round_pk: int, start_sec: float):
+        from .models import SessionProgressRecord
+        self._add(request, session_id, SessionProgressRecord.ROUND_START, [round_pk, start_sec])[
+            'round_start_secs'][round_pk] = start_sec
+
+    def clear(self, request):
+        from .models import SessionProgressRecord
+        if request.user.pk is not None:
+            SessionProgressRecord.objects.filter(user_id=request.user.pk).delete()
+        setattr(request, self.ATTR, None)
+
+
+class CacheSessionProgressStorage(SessionProgressStorage):
+    """
+    Store the progress in the Django cache of cache_alias, with one key per
+    step performed or round shown, so recording a step sets two keys of
+    constant size. The keys of a progress carry a random token, so clearing
+    it only replaces the key of the user naming the session and the token.
+    The progress is lost if evicted, so the cache needs to be shared by the
+    web nodes and large enough to keep it for timeout seconds.
+    """
+
+    DEFAULT_TIMEOUT = 7 * 24 * 3600
+
+    def __init__(self, cache_alias: str = 'default', timeout: int = DEFAULT_TIMEOUT):
+        self.cache_alias = cache_alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @staticmethod
+    def _get_user_key(request) -> str:
+        return f'nest:progress:{request.user.pk}'
+
+    def _get_head(self, request) -> Optional[dict]:
+        if not hasattr(request, '_nest_progress_head'):
+            request._nest_progress_head = self.cache.get(self._get_user_key(request))
+        return request._nest_progress_head
+
+    def _get_head_for(self, request, session_id: int) -> dict:
+        head = self._get_head(request)
+        if head is None or head['session_id'] != session_id:
+            head = {'session_id': session_id, 'token': uuid.uuid4().hex}
+            self.cache.set(self._get_user_key(request), head, self.timeout)
+            request._nest_progress_head = head
+        return head
+
+    @staticmethod
+    def _get_key(head: dict, *components) -> str:
+        return ':'.join(['nest:progress', head['token']] + [str(c) for c in components])
+
+    def get_session_id(self, request) -> Optional[int]:
+        head = self._get_head(request)
+        return None if head is None else head['session_id']
+
+    def get_num_steps(self, request) -> int:
+        head = self._get_head(request)
+        return 0 if head is None else self.cache.get(self._get_key(head, 'num_steps'), 0)
+
+    def get_steps(self, request, steps_planned: List[dict]) -> List[dict]:
+        head = self._get_head(request)
+        if head is None:
+            return []
+        keys = [self._get_key(head, 'step', i) for i in range(self.get_num_steps(request))]
+        records = self.cache.get_many(keys)
+        assert len(records) == len(keys), 'steps of the session in progress were evicted from the cache'
+        return SessionProgress.decode_steps([records[key] for key in keys], steps_planned)
+
+    def add_step(self, request, session_id: int, step_index: int, step: dict):
+        num_steps = self.get_num_steps(request) if self.get_session_id(request) == session_id else 0
+        assert step_index == num_steps, f'expect step {num_steps} to be added, but got step {step_index}'
+        head = self._get_head_for(request, session_id)
+        self.cache.set_many({self._get_key(head, 'step', step_index): SessionProgress.encode_step(step_index, step),
+                             self._get_key(head, 'num_steps'): step_index + 1}, self.timeout)
+
+    def get_round_start_sec(self, request, round_pk: int) -> Optional[float]:
+        head = self._get_head(request)
+        return None if head is None else self.cache.get(self._get_key(head, 'round', round_pk))
+
+    def set_round_start_sec(self, request, session_id: int, round_pk: int, start_sec: float):
+        head = self._get_head_for(request, session_id)
+        self.cache.set(self._get_key(head, 'round', round_pk), start_sec, self.timeout)
+
+    def clear(self, request):
+        if request.user.pk is not None:
+            self.cache.delete(self._get_user_key(request))
+        request._nest_progress_head = None
+
+
+class CookieSessionProgressStorage(SessionProgressStorage):
+    """
+    Store the progress in a signed cookie, so the server keeps no state.
+    The cookie holds the compact records of all steps, and the start time of
+    the current round only, and is re-sent on every request, so it suits
+    sessions whose records stay under the 4KB a browser keeps per cookie; a
+    step that does not fit raises SessionProgressTooLarge, and is not
+    recorded. The cookie is bound to the user it was set for.
+    """
+
+    COOKIE_NAME = 'nest_progress'
+    SALT = 'nest.progress_storage.CookieSessionProgressStorage'
+    MAX_COOKIE_SIZE = 4000
+
+    def _load(self, request) -> dict:
+        if not hasattr(request, '_nest_progress'):
+            progress = None
+            if self.COOKIE_NAME in request.COOKIES:
+                try:
+                    progress = signing.loads(request.COOKIES[self.COOKIE_NAME], salt=self.SALT,
+                                             max_age=settings.SESSION_COOKIE_AGE)
+                except signing.BadSignature:
+                    progress = None
+            if progress is None or progress['u'] != request.user.pk:
+                progress = {'u': request.user.pk, 's': None, 'p': [], 't': {}}
+            request._nest_progress = progress
+            request._nest_progress_modified = False
+        return request._nest_progress
+
+    def _modify(self, request, session_id: int) -> dict:
+        progress = self._load(request)
+        if progress['s'] != session_id:
+            progress.update({'s': session_id, 'p': [], 't': {}})
+        request._nest_progress_modified = True
+        return progress
+
+    def get_session_id(self, request) -> Optional[int]:
+        return self._load(request)['s']
+
+    def get_num_steps(self, request) -> int:
+        return len(self._load(request)['p'])
+
+    def get_steps(self, request, steps_planned: List[dict]) -> List[dict]:
+        return SessionProgress.decode_steps(self._load(request)['p'], steps_planned)
+
+    def add_step(self, request, session_id: int, step_index: int, step: dict):
+        num_steps = self.get_num_steps(request) if self.get_session_id(request) == session_id else 0
+        assert step_index == num_steps, f'expect step {num_steps} to be added, but got step {step_index}'
+        record = SessionProgress.encode_step(step_index, step)
+        progress = self._load(request)
+        if progress['s'] != session_id:
+            progress = {**progress, 's': session_id, 'p': [], 't': {}}
+        # the start time of a round is done with once its step is recorded
+        progress = {**progress, 'p': progress['p'] + [record], 't': progress['t'] if len(record) == 1 else {}}
+        if len(self._dumps(progress)) > self.MAX_COOKIE_SIZE:
+            raise SessionProgressTooLarge(
+                f'the progress of session {session_id} does not fit in a cookie at step {step_index}')
+        request._nest_progress = progress
+        request._nest_progress_modified = True
+
+    def get_round_start_sec(self, request, round_pk: int) -> Optional[float]:
+        # json keys are strings
+        return self._load(request)['t'].get(str(round_pk))
+
+    def set_round_start_sec(self, request, session_id: int, round_pk: int, start_sec: float):
+        # only the round shown last is answered next
+        self._modify(request, session_id)['t'] = {str(round_pk): start_sec}
+
+    def _dumps(self, progress: dict) -> str:
+        return signing.dumps(progress, salt=self.SALT, compress=True)
+
+    def clear(self, request):
+        request._nest_progress = {'u': request.user.pk, 's': None, 'p': [], 't': {}}
+        request._nest_progress_modified = True
+
+    def process_response(self, request, response):
+        if not getattr(request, '_nest_progress_modified', False):
+            return
+        progress: Dict = request._nest_progress
+        if progress['s'] is None:
+            response.delete_cookie(self.COOKIE_NAME, samesite=settings.SESSION_COOKIE_SAMESITE)
+            return
+        value = self._dumps(progress)
+        if len(value) > self.MAX_COOKIE_SIZE:
+            # the cookie set before is left as it is
+            logger.error(f'the progress of session {progress["s"]} takes {len(value)} bytes, '
+                         f'more than a cookie can hold: not set')
+            return
+        response.set_cookie(self.COOKIE_NAME, value,
+                            max_age=settings.SESSION_COOKIE_AGE,
+                            secure=settings.SESSION_COOKIE_SECURE,
+                            httponly=True,
+                            samesite=settings.SESSION_COOKIE_SAMESITE)
+
+
+SESSION_PROGRESS_STORAGES = {
+    'session': RequestSessionProgressStorage,
+    'database': DatabaseSessionProgressStorage,
+    'cache': CacheSessionProgressStorage,
+    'cookie': CookieSessionProgressStorage,
+}
+
+_session_progress_storages = dict()
+
+
+def get_session_progress_storage() -> SessionProgressStorage:
+    """
+    Return the process-wide storage selected by the SESSION_PROGRESS_STORAGE
+    setting, 'session' by default.
+    """
+    name = getattr(settings, 'SESSION_PROGRESS_STORAGE', 'session')
+    assert name in SESSION_PROGRESS_STORAGES, \
+        f"SESSION_PROGRESS_STORAGE must be one of {list(SESSION_PROGRESS_STORAGES.keys())}, but is {name}"
+    if name not in _session_progress_storages:
+        _session_progress_storages[name] = SESSION_PROGRESS_STORAGES[name]()
+    return _session_progress_storages[name]
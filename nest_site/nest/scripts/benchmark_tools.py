@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import tracemalloc
+import types
+from time import time
+from unittest.mock import patch
+
+import django
+django.setup()
+
+from asgiref.sync import ThreadSensitiveContext  # noqa: E402, I100, I202
+from django.contrib.auth.models import User  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import AsyncClient, Client, override_settings  # noqa: E402
+from django.urls import path, re_path, reverse  # noqa: E402
+
+from nest.config import ExperimentConfig, ExperimentConfigCache, NestConfig, StimulusConfig, \
+    ValidationCertificate  # noqa: E402, I202
+from nest.control import ExperimentController  # noqa: E402
+from nest.helpers import my_argmin  # noqa: E402
+from nest.io import ExperimentUtils  # noqa: E402
+from nest.models import Experiment, StimulusGroupExposure, Subject  # noqa: E402
+from nest.sites import NestSite  # noqa: E402
+from nest.snapshot import ConfigSnapshot  # noqa: E402
+from nest_site.urls import async_mp4_byterange_view, favicon_view, mp4_byterange_view  # noqa: E402
+
+
+def make_synthetic_config(num_stimulusgroups: int,
+                          methodology: str = 'acr',
+                          rounds_per_session: int = 10) -> dict:
+    """
+    Make a synthetic experiment config of num_stimulusgroups stimulusgroups,
+    each with a single stimulusvotegroup. For acr, each svg has one stimulus;
+    for dcr, each svg pairs a distorted stimulus with its content's reference.
+    Paths are public urls, so that the path check is skipped.
+    """
+    assert methodology in ['acr', 'dcr']
+    contents = list()
+    stimuli = list()
+    stimulusvotegroups = list()
+    stimulusgroups = list()
+    num_contents = max(1, num_stimulusgroups // 10)
+    for cid in range(num_contents):
+        contents.append({'content_id': cid, 'name': f'content_{cid}'})
+        if methodology == 'dcr':
+            stimuli.append({'stimulus_id': num_stimulusgroups + cid,
+                            'path': f'https://example.com/media/{cid}/ref.mp4',
+                            'type': 'video/mp4',
+                            'content_id': cid})
+    for i in range(num_stimulusgroups):
+        cid = i % num_contents
+        stimuli.append({'stimulus_id': i,
+                        'path': f'https://example.com/media/{cid}/dis_{i}.mp4',
+                        'type': 'video/mp4',
+                        'content_id': cid})
+        if methodology == 'acr':
+            stimulus_ids = [i]
+        else:
+            stimulus_ids = [i, num_stimulusgroups + cid]
+        stimulusvotegroups.append({'stimulusvotegroup_id': i, 'stimulus_ids': stimulus_ids})
+        stimulusgroups.append({'stimulusgroup_id': i, 'stimulusvotegroup_ids': [i]})
+    return {
+        'stimulus_config': {
+            'contents': contents,
+            'stimuli': stimuli,
+            'stimulusvotegroups': stimulusvotegroups,
+            'stimulusgroups': stimulusgroups,
+        },
+        'experiment_config': {
+            'title': f'synthetic_{methodology}_{num_stimulusgroups}',
+            'description': 'synthetic experiment for benchmarking',
+            'vote_scale': 'FIVE_POINT',
+            'methodology': methodology,
+            'rounds_per_session': rounds_per_session,
+            'random_seed': 0,
+        },
+    }
+
+
+def benchmark_round_lookup(num_stimulusgroups_list, num_rounds):
+    """
+    Time the StimulusConfig lookups done by NestSite to render one ACR round.
+    """
+    print(f"{'stimulusgroups':>15} {'usec/round':>12}")
+    for num_stimulusgroups in num_stimulusgroups_list:
+        config = make_synthetic_config(num_stimulusgroups)
+        scfg = StimulusConfig(config['stimulus_config'], skip_path_check=True)
+        ecfg = ExperimentConfig(stimulus_config=scfg, config=config['experiment_config'])
+        ec = ExperimentController(experiment=None, experiment_config=ecfg)
+        randgen = random.Random(0)
+        steps = [{'context': {'stimulusgroup_id': randgen.randrange(num_stimulusgroups)}}
+                 for _ in range(num_rounds)]
+        start_time = time()
+        for step in steps:
+            sgid = step['context']['stimulusgroup_id']
+            scfg.get_video_display_percentage(sgid)
+            scfg.get_pre_message(sgid)
+            scfg.get_start_end_seconds(sgid)
+            scfg.get_text_color(sgid)
+            scfg.get_overlay_on_video_js(sgid)
+            scfg.get_super_stimulusgroup_id(sgid)
+            svgid = NestSite._get_matched_single_stimulusvotegroup_id(ec, step)
+            sid = NestSite._get_matched_single_stimulus_id(ec, svgid)
+            NestSite._get_matched_stimulus_dict(ec, sid)
+        elapsed = time() - start_time
+        print(f"{num_stimulusgroups:>15} {elapsed / num_rounds * 1e6:>12.2f}")
+
+
+def benchmark_validate(num_stimulusgroups_list):
+    """
+    Time the validation of StimulusConfig and ExperimentConfig.
+    """
+    print(f"{'stimulusgroups':>15} {'stimuli':>10} {'sec':>8}")
+    for num_stimulusgroups in num_stimulusgroups_list:
+        config = make_synthetic_config(num_stimulusgroups, methodology='dcr')
+        start_time = time()
+        scfg = StimulusConfig(config['stimulus_config'])
+        ExperimentConfig(stimulus_config=scfg, config=config['experiment_config'])
+        elapsed = time() - start_time
+        print(f"{num_stimulusgroups:>15} {len(scfg.stimuli):>10} {elapsed:>8.3f}")
+
+
+def benchmark_snapshot(num_stimulusgroups_list, num_rounds):
+    """
+    Compare the cold-start time and allocated memory of loading a config from
+    json against mapping its ConfigSnapshot, each followed by num_rounds
+    random stimulusgroup lookups.
+    """
+    print(f"{'stimulusgroups':>15} {'json MB':>8} {'json sec':>9} {'json MB alloc':>14} "
+          f"{'snap sec':>9} {'snap MB alloc':>14}")
+    for num_stimulusgroups in num_stimulusgroups_list:
+        config = make_synthetic_config(num_stimulusgroups, methodology='dcr')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config_filepath = os.path.join(tmpdir, 'config.json')
+            with open(config_filepath, 'wt') as fp:
+                json.dump(config, fp, indent=4)
+            with open(config_filepath, 'rb') as fp:
+                data = fp.read()
+            ConfigSnapshot.write(config_filepath, config,
+                                 source_signature=ExperimentConfigCache.get_signature(config_filepath),
+                                 content_hash=ValidationCertificate.hash_content(data),
+                                 validator_version=ValidationCertificate.VALIDATOR_VERSION,
+                                 path_check_timestamp=time())
+            del config, data
+            randgen = random.Random(0)
+            sgids = [randgen.randrange(num_stimulusgroups) for _ in range(num_rounds)]
+
+            def load_json():
+                with open(config_filepath, 'rt') as fp:
+                    c = json.load(fp)
+                return ExperimentConfigCache.compile(c)
+
+            def load_snapshot():
+                return ExperimentConfigCache.compile(ConfigSnapshot.load(config_filepath).config, trusted=True)
+
+            results = list()
+            for load in [load_json, load_snapshot]:
+                tracemalloc.start()
+                start_time = time()
+                ecfg = load()
+                for sgid in sgids:
+                    sg = ecfg.stimulus_config.stimulusgroup_dict[sgid]
+                    for svgid in sg['stimulusvotegroup_ids']:
+                        for sid in ecfg.stimulus_config.stimulusvotegroup_dict[svgid]['stimulus_ids']:
+                            ecfg.stimulus_config.stimulus_dict[sid]['path']
+                elapsed = time() - start_time
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                del ecfg
+                results += [elapsed, peak / 1024 / 1024]
+            json_mb = os.path.getsize(config_filepath) / 1024 / 1024
+        print(f"{num_stimulusgroups:>15} {json_mb:>8.1f} {results[0]:>9.3f} {results[1]:>14.1f} "
+              f"{results[2]:>9.3f} {results[3]:>14.1f}")
+
+
+def benchmark_order(num_stimulusgroups_list, rounds_per_session):
+    """
+    Time ExperimentController._order assigning rounds_per_session rounds out
+    of num_stimulusgroups stimulusgroups with random exposures so far, with
+    LeastWeightCandidates and, where it takes reasonable time, with the
+    former my_argmin/list.remove selection.
+    """
+
+    class ListCandidates(object):
+        def __init__(self, a, shortlist):
+            self.a = a
+            self.shortlist = list(shortlist)
+
+        def __len__(self):
+            return len(self.shortlist)
+
+        def least_candidates(self):
+            return my_argmin(self.a, self.shortlist)
+
+        def take(self, position):
+            sgidx = my_argmin(self.a, self.shortlist)[position]
+            self.shortlist.remove(sgidx)
+            return sgidx
+
+    print(f"{'stimulusgroups':>15} {'rounds':>8} {'heap sec':>9} {'list sec':>9}")
+    for num_stimulusgroups in num_stimulusgroups_list:
+        randgen = random.Random(0)
+        stimulusgroup_ids = list(range(num_stimulusgroups))
+        exposures = {sgid: (randgen.randint(0, 3), randgen.randint(0, 1)) for sgid in stimulusgroup_ids}
+        kwargs = dict(
+            rounds_per_session=rounds_per_session,
+            stimulusgroup_ids=stimulusgroup_ids,
+            subject_id=0,
+            ordering_so_far=None,
+            prioritized=list(),
+            random_seed=0,
+            blocklist_stimulusgroup_ids=stimulusgroup_ids[:num_stimulusgroups // 100],
+            exposures=exposures,
+            num_sessions_so_far=0,
+        )
+        start_time = time()
+        d = ExperimentController._order(**kwargs)
+        heap_elapsed = time() - start_time
+        list_elapsed = None
+        if num_stimulusgroups ** 2 * rounds_per_session <= 10 ** 9:
+            with patch('nest.control.LeastWeightCandidates', ListCandidates):
+                start_time = time()
+                d2 = ExperimentController._order(**kwargs)
+                list_elapsed = time() - start_time
+            assert d == d2
+        list_str = f'{list_elapsed:>9.3f}' if list_elapsed is not None else f"{'-':>9}"
+        print(f"{num_stimulusgroups:>15} {rounds_per_session:>8} {heap_elapsed:>9.3f} {list_str}")
+
+
+def benchmark_populate(num_stimulusgroups_list):
+    """
+    Time ExperimentController.populate_stimuli creating the Contents,
+    Stimuli, StimulusVoteGroups and StimulusGroups of a synthetic dcr config
+    in a scratch test database, and count the queries issued.
+    """
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        print(f"{'stimulusgroups':>15} {'stimuli':>10} {'queries':>10} {'sec':>8}")
+        for num_stimulusgroups in num_stimulusgroups_list:
+            config = make_synthetic_config(num_stimulusgroups, methodology='dcr')
+            scfg = StimulusConfig(config['stimulus_config'], skip_path_check=True)
+            ecfg = ExperimentConfig(stimulus_config=scfg, config=config['experiment_config'])
+            exp = Experiment.objects.create(title=ecfg.title)
+            ec = ExperimentController(experiment=exp, experiment_config=ecfg)
+            num_queries = [0]
+
+            def count_query(execute, *args):
+                num_queries[0] += 1
+                return execute(*args)
+
+            with connection.execute_wrapper(count_query):
+                start_time = time()
+                ec.populate_stimuli()
+                elapsed = time() - start_time
+            print(f"{num_stimulusgroups:>15} {len(scfg.stimuli):>10} {num_queries[0]:>10} {elapsed:>8.3f}")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def benchmark_provision(num_provisioners_list, num_sessions):
+    """
+    Time ExperimentController.add_session called concurrently from
+    num_provisioners threads, each with its own controller and database
+    connection, in a scratch test database. Report the throughput and the
+    spread of the resulting StimulusGroupExposure counts (at most 1 if the
+    assignment stayed balanced).
+    """
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        print(f"{'provisioners':>13} {'sessions':>9} {'sec':>8} {'sessions/sec':>13} {'spread':>7}")
+        config = make_synthetic_config(100, rounds_per_session=10)
+        scfg = StimulusConfig(config['stimulus_config'], skip_path_check=True)
+        ecfg = ExperimentConfig(stimulus_config=scfg, config=config['experiment_config'])
+        for num_provisioners in num_provisioners_list:
+            exp = Experiment.objects.create(title=f'{ecfg.title}_{num_provisioners}')
+            ExperimentController(experiment=exp, experiment_config=ecfg).populate_stimuli()
+            subjects = [Subject.objects.create() for _ in range(num_sessions)]
+            ecs = [ExperimentController(experiment=Experiment.objects.get(pk=exp.pk), experiment_config=ecfg)
+                   for _ in range(num_provisioners)]
+
+            def provision(i):
+                try:
+                    for subj in subjects[i::num_provisioners]:
+                        ecs[i].add_session(subj)
+                finally:
+                    connection.close()
+
+            threads = [threading.Thread(target=provision, args=(i,)) for i in range(num_provisioners)]
+            start_time = time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time() - start_time
+            counts = list(StimulusGroupExposure.objects
+                          .filter(stimulusgroup__experiment=exp).values_list('count', flat=True))
+            print(f"{num_provisioners:>13} {num_sessions:>9} {elapsed:>8.3f} {num_sessions / elapsed:>13.1f} "
+                  f"{max(counts) - min(counts):>7}")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def _make_urlconf(name, async_views):
+    """
+    Make the urlconf module name, as nest_site.urls, with the async views if
+    async_views, whatever the NEST_ASYNC_VIEWS setting.
+    """
+    urlconf = types.ModuleType(name)
+    urlconf.urlpatterns = [
+        path('', NestSite(async_views=async_views).urls),
+        re_path(r'^favicon\.ico$', favicon_view, name='favicon'),
+        re_path(r'^media/mp4/(?P<path>.*)$',
+                async_mp4_byterange_view if async_views else mp4_byterange_view, name='mp4'),
+    ]
+    sys.modules[name] = urlconf
+    return name
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# each subject requests the status page, the current round of step_session
+# and 1 MB of the video of the first stimulus of the config
+_SERVE_CONFIG = 'cvxhull_subjexp_toy_x.json'
+_SERVE_HEADERS = {'range': 'bytes=0-1048575'}
+
+
+def _serve_wsgi(users, sessions, mp4_url, num_iterations):
+    """
+    Serve each subject of users, on their session of sessions, from its own
+    thread and test Client, as with a threaded WSGI server. Return the
+    elapsed time and the latencies of the requests.
+    """
+    clients = [Client() for _ in users]
+    urls = list()
+    for client, user, sess in zip(clients, users, sessions):
+        client.force_login(user)
+        urls.append([reverse('nest:status'),
+                     reverse('nest:step_session', kwargs={'session_id': sess.id}),
+                     mp4_url])
+        # as far as the first round
+        client.get(reverse('nest:start_session', kwargs={'session_id': sess.id}))
+        client.get(urls[-1][1])
+
+    def serve(client, client_urls, client_latencies):
+        try:
+            for _ in range(num_iterations):
+                for url in client_urls:
+                    request_start_time = time()
+                    response = client.get(url, headers=_SERVE_HEADERS)
+                    if response.streaming:
+                        b''.join(response.streaming_content)
+                    client_latencies.append(time() - request_start_time)
+        finally:
+            connection.close()
+
+    latencies_list = [list() for _ in clients]
+    threads = [threading.Thread(target=serve, args=args) for args in zip(clients, urls, latencies_list)]
+    start_time = time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time() - start_time, [latency for latencies in latencies_list for latency in latencies]
+
+
+def _serve_asgi(users, sessions, mp4_url, num_iterations):
+    """
+    Serve each subject of users, on their session of sessions, from its own
+    AsyncClient, all on one event loop, each request in its own
+    ThreadSensitiveContext, as with the ASGI handler. Return the elapsed
+    time and the latencies of the requests.
+    """
+    clients = [AsyncClient() for _ in users]
+    urls = list()
+    for client, user, sess in zip(clients, users, sessions):
+        client.force_login(user)
+        urls.append([reverse('nest:status'),
+                     reverse('nest:step_session', kwargs={'session_id': sess.id}),
+                     mp4_url])
+
+    async def get(client, url):
+        async with ThreadSensitiveContext():
+            response = await client.get(url, headers=_SERVE_HEADERS)
+            if response.streaming:
+                [chunk async for chunk in response.streaming_content]
+
+    async def start(client, sess, client_urls):
+        # as far as the first round
+        await get(client, reverse('nest:start_session', kwargs={'session_id': sess.id}))
+        await get(client, client_urls[1])
+
+    async def serve(client, client_urls, client_latencies):
+        for _ in range(num_iterations):
+            for url in client_urls:
+                request_start_time = time()
+                await get(client, url)
+                client_latencies.append(time() - request_start_time)
+
+    async def serve_all():
+        await asyncio.gather(*[start(*args) for args in zip(clients, sessions, urls)])
+        start_time = time()
+        await asyncio.gather(*[serve(*args) for args in zip(clients, urls, latencies_list)])
+        return time() - start_time
+
+    latencies_list = [list() for _ in clients]
+    elapsed = asyncio.run(serve_all())
+    return elapsed, [latency for latencies in latencies_list for latency in latencies]
+
+
+def benchmark_serve(num_clients_list, num_requests):
+    """
+    Compare the WSGI and ASGI paths of the subject-facing views, in a scratch
+    test database: num_clients subjects, each with its own session, request
+    in a loop the status page, the current round of step_session and a 1 MB
+    range of a video, num_requests requests in total. The WSGI path
+    serves the sync views, the ASGI path the async ones (see _serve_wsgi and
+    _serve_asgi). The sessions and the progress are kept in signed cookies,
+    so that the requests only read the database. Report the requests/sec and
+    the p50 and p99 latencies.
+    """
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    logging.disable(logging.WARNING)
+    try:
+        with open(NestConfig.tests_resource_path(_SERVE_CONFIG), 'rt') as f:
+            mp4_url = json.load(f)['stimulus_config']['stimuli'][0]['path']
+        print(f"{'path':>5} {'clients':>8} {'requests':>9} {'sec':>8} {'requests/sec':>13} "
+              f"{'p50 ms':>8} {'p99 ms':>8}")
+        for num_clients in num_clients_list:
+            ec = ExperimentUtils._create_experiment_from_config(
+                source_config_filepath=NestConfig.tests_resource_path(_SERVE_CONFIG),
+                is_test=True,
+                random_seed=1,
+                experiment_title=f'benchmark_serve_{num_clients}')
+            for path_name, serve, async_views in [('wsgi', _serve_wsgi, False), ('asgi', _serve_asgi, True)]:
+                users = [User.objects.create_user(f'benchmark_serve_{path_name}_{num_clients}_{i}')
+                         for i in range(num_clients)]
+                sessions = [ec.add_session(Subject.create_by_username(user.username)) for user in users]
+                urlconf = _make_urlconf(f'benchmark_serve_{path_name}_urls', async_views=async_views)
+                with override_settings(ROOT_URLCONF=urlconf, ALLOWED_HOSTS=['testserver'],
+                                       SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies',
+                                       SESSION_PROGRESS_STORAGE='cookie'):
+                    elapsed, latencies = serve(users, sessions, mp4_url, max(1, num_requests // (3 * num_clients)))
+                print(f"{path_name:>5} {num_clients:>8} {len(latencies):>9} {elapsed:>8.3f} "
+                      f"{len(latencies) / elapsed:>13.1f} {_percentile(latencies, 0.5) * 1000:>8.1f} "
+                      f"{_percentile(latencies, 0.99) * 1000:>8.1f}")
+    finally:
+        logging.disable(logging.NOTSET)
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--action", dest="action", nargs=1, type=str,
+        help="benchmark to run, options: round_lookup, validate, snapshot, order, populate, provision, serve",
+        required=True)
+    parser.add_argument(
+        "--sizes", dest="sizes", nargs=1, type=str,
+        help="list of config sizes (for provision, numbers of threads; for serve, numbers of clients), "
+             "separated by comma (e.g. 100,1000,10000)",
+        required=False)
+    parser.add_argument(
+        "--repeats", dest="repeats", nargs=1, type=int,
+        help="number of repetitions timed per config size (for order, rounds per session; "
+             "for provision, sessions; for serve, requests)",
+        required=False)
+    args = parser.parse_args()
+    action = args.action[0]
+    sizes = [int(n) for n in args.sizes[0].split(',')] if args.sizes else None
+    repeats = args.repeats[0] if args.repeats else None
+
+    if action == 'round_lookup':
+        benchmark_round_lookup(
+            num_stimulusgroups_list=sizes or [100, 1000, 10000, 100000],
+            num_rounds=repeats or 10000)
+    elif action == 'validate':
+        benchmark_validate(
+            num_stimulusgroups_list=sizes or [1000, 10000, 100000, 1000000])
+    elif action == 'snapshot':
+        benchmark_snapshot(
+            num_stimulusgroups_list=sizes or [10000, 100000, 200000],
+            num_rounds=repeats or 1000)
+    elif action == 'order':
+        benchmark_order(
+            num_stimulusgroups_list=sizes or [100, 1000, 10000, 100000],
+            rounds_per_session=repeats or 1000)
+    elif action == 'populate':
+        benchmark_populate(
+            num_stimulusgroups_list=sizes or [1000, 10000, 50000])
+    elif action == 'provision':
+        benchmark_provision(
+            num_provisioners_list=sizes or [1, 4, 16],
+            num_sessions=repeats or 320)
+    elif action == 'serve':
+        benchmark_serve(
+            num_clients_list=sizes or [1, 15, 60],
+            num_requests=repeats or 1800)
+    else:
+        assert False, f"Unknown action: {action}"
+
+    exit(0)
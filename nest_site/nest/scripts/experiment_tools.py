@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 
 import argparse
+import glob
+import json
+import os
 
 import django
 django.setup()
@@ -11,13 +14,14 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--action", dest="action", nargs=1, type=str,
-        help="action to take, options: validate_config, create_experiment, "
-             "delete_experiment, add_session, delete_session, "
-             "update_first_session_subject, reset_unfinished_first_session",
+        help="action to take, options: validate_config, validate_configs, create_experiment, "
+             "update_experiment, delete_experiment, add_session, add_sessions, delete_session, "
+             "update_first_session_subject, reset_unfinished_first_session, rebuild_exposures",
         required=True)
     parser.add_argument(
         "--config", dest="config_filepath", nargs=1, type=str,
-        help="path to config file for creating experiment", required=False)
+        help="path to config file for creating experiment; for validate_configs, "
+             "a directory of config files, or a glob pattern", required=False)
     parser.add_argument(
         "--experiment", dest="experiment_title", nargs=1, type=str,
         help="experiment title to add session", required=False)
@@ -26,12 +30,22 @@ if __name__ == "__main__":
         help="specify the username of either subject or experimenter; if not "
              "exist, create one. In the case the action is create_experiment, "
              "the username is for the experimenter associated; for all other "
-             "action, the username is for the test subject",
+             "action, the username is for the test subject. In the case the "
+             "action is add_sessions, a list of usernames, separated by comma",
         required=False)
     parser.add_argument(
         "--session_id", dest="session_id", nargs=1, type=int,
         help="specify the session ID",
         required=False)
+    parser.add_argument(
+        "--dry_run", dest="dry_run", action='store_true',
+        help="for update_experiment, only print the changes to be made; for rebuild_exposures, "
+             "only check the exposure counts",
+        required=False)
+    parser.add_argument(
+        "--workers", dest="workers", nargs=1, type=int,
+        help="for validate_configs, number of worker processes (default: one per CPU)",
+        required=False)
     args = parser.parse_args()
     action = args.action[0]
     config_filepath = args.config_filepath[0] if args.config_filepath else None
@@ -47,6 +61,23 @@ if __name__ == "__main__":
         ExperimentUtils.validate_config(
             experiment_config_filepath=config_filepath)
         print(f"config file is valid: {config_filepath}")
+    elif action == 'validate_configs':
+        assert config_filepath is not None
+        assert experiment_title is None
+        assert username is None
+        assert session_id is None
+        if os.path.isdir(config_filepath):
+            config_filepaths = sorted(glob.glob(os.path.join(config_filepath, '*.json')))
+        else:
+            config_filepaths = sorted(glob.glob(config_filepath, recursive=True))
+        reports = ExperimentUtils.validate_configs(
+            experiment_config_filepaths=config_filepaths,
+            max_workers=args.workers[0] if args.workers else None)
+        # one json report per line
+        for report in reports:
+            print(json.dumps(report))
+        if not all(report['ok'] for report in reports):
+            exit(1)
     elif action == 'create_experiment':
         assert config_filepath is not None
         assert experiment_title is None, 'experiment_title is specified through config file'
@@ -55,6 +86,15 @@ if __name__ == "__main__":
         ExperimentUtils.create_experiment(
             experiment_config_filepath=config_filepath,
             experimenter_username=username)
+    elif action == 'update_experiment':
+        assert config_filepath is not None
+        assert username is None
+        assert session_id is None
+        diff = ExperimentUtils.update_experiment_config(
+            experiment_config_filepath=config_filepath,
+            experiment_title=experiment_title,
+            dry_run=args.dry_run)
+        print(diff)
     elif action == 'delete_experiment':
         assert config_filepath is None
         assert experiment_title is not None
@@ -71,6 +111,14 @@ if __name__ == "__main__":
         ExperimentUtils.add_session_to_experiment(
             experiment_title=experiment_title,
             subject_username=username)
+    elif action == 'add_sessions':
+        assert config_filepath is None
+        assert experiment_title is not None
+        assert username is not None
+        assert session_id is None
+        ExperimentUtils.add_sessions_to_experiment(
+            experiment_title=experiment_title,
+            subject_usernames=username.split(','))
     elif action == 'delete_session':
         assert config_filepath is None
         assert experiment_title is not None
@@ -100,6 +148,17 @@ if __name__ == "__main__":
         ExperimentUtils.reset_unfinished_session(
             experiment_title=experiment_title,
             session_id=first_session.id)
+    elif action == 'rebuild_exposures':
+        assert config_filepath is None
+        assert experiment_title is not None
+        assert username is None
+        assert session_id is None
+        ok = ExperimentUtils.check_exposures(
+            experiment_title=experiment_title,
+            dry_run=args.dry_run)
+        print(f"exposure counts are {'consistent' if ok else 'inconsistent'}: {experiment_title}")
+        if not ok and args.dry_run:
+            exit(1)
     else:
         assert False, f"Unknown action: {action}"
 
@@ -58,9 +58,9 @@ if __name__ == "__main__":
         for username in usernames:
             UserUtils.create_user(username, is_staff, is_superuser)
             UserUtils.set_password(username, password)
-            ExperimentUtils.add_session_to_experiment(
-                experiment_title=experiment_title,
-                subject_username=username)
+        ExperimentUtils.add_sessions_to_experiment(
+            experiment_title=experiment_title,
+            subject_usernames=usernames)
     else:
         assert False, f"Unknown action: {action}"
 
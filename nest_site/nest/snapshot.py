@@ -0,0 +1,362 @@
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping, Sequence
+from typing import Dict, List, Optional
+
+MAGIC = b'NESTSNAP'
+FORMAT_VERSION = 1
+ALIGNMENT = 8
+
+# kinds of column, by the type of the values of a key across the rows of a
+# section: int -> packed int64; int_list -> packed int64 values and offsets;
+# str -> index into the string table; json -> index into the string table of
+# the json-encoded value (for dicts, floats, mixed types, etc.)
+KIND_INT = 'int'
+KIND_INT_LIST = 'int_list'
+KIND_STR = 'str'
+KIND_JSON = 'json'
+
+SECTIONS = ['contents', 'stimuli', 'stimulusvotegroups', 'stimulusgroups']
+
+
+def _is_int(v) -> bool:
+    return isinstance(v, int) and not isinstance(v, bool)
+
+
+def _get_kind(values: list) -> str:
+    if all(_is_int(v) for v in values):
+        return KIND_INT
+    if all(isinstance(v, list) and all(_is_int(x) for x in v) for v in values):
+        return KIND_INT_LIST
+    if all(isinstance(v, str) for v in values):
+        return KIND_STR
+    return KIND_JSON
+
+
+class _SnapshotWriter(object):
+
+    def __init__(self):
+        self.buffers: List[bytes] = list()
+        self.nbytes = 0
+        self.strings: List[str] = list()
+        self.string_indices: Dict[str, int] = dict()
+
+    def add_buffer(self, arr: array) -> list:
+        data = arr.tobytes()
+        offset = self.nbytes
+        padding = -len(data) % ALIGNMENT
+        self.buffers.append(data + b'\0' * padding)
+        self.nbytes += len(data) + padding
+        return [offset, len(arr), arr.typecode]
+
+    def intern(self, s: str) -> int:
+        idx = self.string_indices.get(s)
+        if idx is None:
+            idx = len(self.strings)
+            self.strings.append(s)
+            self.string_indices[s] = idx
+        return idx
+
+    def add_section(self, rows: List[dict]) -> dict:
+        keys = list()
+        seen = set()
+        for row in rows:
+            for key in row:
+                if key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+        columns = dict()
+        for key in keys:
+            present = [key in row for row in rows]
+            values = [row[key] for row in rows if key in row]
+            kind = _get_kind(values)
+            column = {'kind': kind}
+            if not all(present):
+                column['present'] = self.add_buffer(array('b', present))
+            if kind == KIND_INT:
+                column['values'] = self.add_buffer(array('q', [row.get(key, 0) for row in rows]))
+                if 'present' not in column and len(set(values)) == len(values):
+                    # unique ids: store them sorted, with their row positions,
+                    # so that lookups by id bisect the mapped buffers
+                    positions = sorted(range(len(values)), key=values.__getitem__)
+                    column['sorted_values'] = self.add_buffer(array('q', [values[i] for i in positions]))
+                    column['sorted_positions'] = self.add_buffer(array('q', positions))
+            elif kind == KIND_INT_LIST:
+                offsets = array('q', [0])
+                flat = array('q')
+                for row in rows:
+                    flat.extend(row.get(key, []))
+                    offsets.append(len(flat))
+                column['offsets'] = self.add_buffer(offsets)
+                column['values'] = self.add_buffer(flat)
+            elif kind == KIND_STR:
+                column['values'] = self.add_buffer(array('i', [self.intern(row[key]) if key in row else -1 for row in rows]))
+            else:
+                column['values'] = self.add_buffer(array('i', [self.intern(json.dumps(row[key])) if key in row else -1 for row in rows]))
+            columns[key] = column
+        return {'length': len(rows), 'keys': keys, 'columns': columns}
+
+    def add_string_table(self) -> dict:
+        encoded = [s.encode('utf-8') for s in self.strings]
+        offsets = array('q', [0])
+        for e in encoded:
+            offsets.append(offsets[-1] + len(e))
+        return {'offsets': self.add_buffer(offsets),
+                'data': self.add_buffer(array('B', b''.join(encoded)))}
+
+
+class SnapshotSection(Sequence):
+    """
+    Read-only list of the row dicts of a config section, backed by the
+    columns of a ConfigSnapshot. A row dict is only built on first access,
+    and int columns can be read without building any row.
+    """
+
+    def __init__(self, snapshot: 'ConfigSnapshot', d: dict):
+        self._snapshot = snapshot
+        self._length: int = d['length']
+        self._keys: List[str] = d['keys']
+        self._columns: Dict[str, dict] = d['columns']
+        self._rows: Dict[int, dict] = dict()
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(self._length))]
+        if idx < 0:
+            idx += self._length
+        if not 0 <= idx < self._length:
+            raise IndexError('section index out of range')
+        row = self._rows.get(idx)
+        if row is None:
+            row = self._build_row(idx)
+            self._rows[idx] = row
+        return row
+
+    def _build_row(self, idx: int) -> dict:
+        row = dict()
+        for key in self._keys:
+            column = self._columns[key]
+            if 'present' in column and not self._snapshot.get_buffer(column['present'])[idx]:
+                continue
+            values = self._snapshot.get_buffer(column['values'])
+            kind = column['kind']
+            if kind == KIND_INT:
+                row[key] = values[idx]
+            elif kind == KIND_INT_LIST:
+                offsets = self._snapshot.get_buffer(column['offsets'])
+                row[key] = values[offsets[idx]:offsets[idx + 1]].tolist()
+            elif kind == KIND_STR:
+                row[key] = self._snapshot.get_string(values[idx])
+            else:
+                row[key] = json.loads(self._snapshot.get_string(values[idx]))
+        return row
+
+    def column(self, key: str) -> Optional[memoryview]:
+        """
+        Return the packed values of an int column present in every row, as a
+        zero-copy memoryview into the snapshot, or None otherwise.
+        """
+        column = self._columns.get(key)
+        if column is None or column['kind'] != KIND_INT or 'present' in column:
+            return None
+        return self._snapshot.get_buffer(column['values'])
+
+    def values(self, key: str) -> list:
+        """
+        Return the value of key of every row, None where absent.
+        """
+        values = self.column(key)
+        if values is not None:
+            return values.tolist()
+        return [row.get(key) for row in self]
+
+    def index_by(self, key: str) -> Mapping:
+        column = self._columns.get(key)
+        if column is not None and 'sorted_values' in column:
+            return SnapshotIndex(self, key,
+                                 self._snapshot.get_buffer(column['sorted_values']),
+                                 self._snapshot.get_buffer(column['sorted_positions']))
+        return {row[key]: row for row in self}
+
+
+class SnapshotIndex(Mapping):
+    """
+    Read-only dict of row id -> row dict over a SnapshotSection, which looks
+    up the id by bisecting the sorted ids stored in the snapshot, without
+    building any per-row structure.
+    """
+
+    def __init__(self, section: SnapshotSection, key: str,
+                 sorted_values: memoryview, sorted_positions: memoryview):
+        self._section = section
+        self._key = key
+        self._sorted_values = sorted_values
+        self._sorted_positions = sorted_positions
+
+    def _find(self, key) -> int:
+        if not _is_int(key):
+            return -1
+        idx = bisect_left(self._sorted_values, key)
+        if idx < len(self._sorted_values) and self._sorted_values[idx] == key:
+            return self._sorted_positions[idx]
+        return -1
+
+    def __getitem__(self, key):
+        position = self._find(key)
+        if position < 0:
+            raise KeyError(key)
+        return self._section[position]
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __iter__(self):
+        return iter(self._section.column(self._key).tolist())
+
+    def __len__(self):
+        return len(self._sorted_values)
+
+
+class ConfigSnapshot(object):
+    """
+    Compiled form of an experiment config file, written next to it at
+    experiment creation. Ids are stored as packed arrays, and strings (paths,
+    html contexts, etc.) are deduplicated into a string table. Loading maps
+    the file into memory, and builds the row dicts only on access.
+
+    The layout is MAGIC, the uint64 length of a json header, the header,
+    padding to ALIGNMENT, then the buffers referred to by the header as
+    [offset, length, typecode].
+    """
+
+    SUFFIX = '.snapshot'
+
+    def __init__(self, buf, header: dict, data_offset: int):
+        self._buf = buf
+        self.header = header
+        self._data_offset = data_offset
+        self._strings: Dict[int, str] = dict()
+        self.experiment_config: dict = header['experiment_config']
+        self.stimulus_config: dict = {
+            section: SnapshotSection(self, header['sections'][section]) for section in SECTIONS
+        }
+
+    @classmethod
+    def get_filepath(cls, config_filepath: str) -> str:
+        return config_filepath + cls.SUFFIX
+
+    @property
+    def config(self) -> dict:
+        return {'stimulus_config': self.stimulus_config,
+                'experiment_config': self.experiment_config}
+
+    def vouches_for(self, source_signature: tuple, content_hash: str, validator_version: int,
+                    skip_path_check: bool = False) -> bool:
+        """
+        Tell if the snapshot was compiled, after validation by
+        validator_version, from the config file whose signature is
+        source_signature and content hash is content_hash. The signature
+        alone would not tell a file rewritten within the mtime resolution,
+        with the same size.
+        """
+        if tuple(self.header['source_signature']) != tuple(source_signature):
+            return False
+        if self.header['content_hash'] != content_hash:
+            return False
+        if self.header['validator_version'] != validator_version:
+            return False
+        if not skip_path_check and self.header['path_check_timestamp'] is None:
+            return False
+        return True
+
+    def get_buffer(self, ref: list) -> memoryview:
+        offset, length, typecode = ref
+        start = self._data_offset + offset
+        itemsize = array(typecode).itemsize
+        return memoryview(self._buf)[start:start + length * itemsize].cast(typecode)
+
+    def get_string(self, idx: int) -> str:
+        s = self._strings.get(idx)
+        if s is None:
+            strings = self.header['strings']
+            offsets = self.get_buffer(strings['offsets'])
+            data = self.get_buffer(strings['data'])
+            s = str(data[offsets[idx]:offsets[idx + 1]], 'utf-8')
+            self._strings[idx] = s
+        return s
+
+    @classmethod
+    def write(cls,
+              config_filepath: str,
+              config: dict,
+              source_signature: tuple,
+              content_hash: str,
+              validator_version: int,
+              path_check_timestamp: Optional[float]) -> str:
+        """
+        Compile the already-validated config read from config_filepath into
+        the snapshot next to it. Return the snapshot filepath.
+        """
+        writer = _SnapshotWriter()
+        header = {
+            'format_version': FORMAT_VERSION,
+            'byteorder': sys.byteorder,
+            'source_signature': list(source_signature),
+            'content_hash': content_hash,
+            'validator_version': validator_version,
+            'path_check_timestamp': path_check_timestamp,
+            'experiment_config': config['experiment_config'],
+            'sections': {section: writer.add_section(config['stimulus_config'][section]) for section in SECTIONS},
+        }
+        header['strings'] = writer.add_string_table()
+        header_data = json.dumps(header).encode('utf-8')
+        preamble = MAGIC + struct.pack('<Q', len(header_data)) + header_data
+        preamble += b'\0' * (-len(preamble) % ALIGNMENT)
+
+        snapshot_filepath = cls.get_filepath(config_filepath)
+        tmp_filepath = f'{snapshot_filepath}.{os.getpid()}.tmp'
+        with open(tmp_filepath, 'wb') as fp:
+            fp.write(preamble)
+            for data in writer.buffers:
+                fp.write(data)
+        os.replace(tmp_filepath, snapshot_filepath)
+        return snapshot_filepath
+
+    @classmethod
+    def load(cls, config_filepath: str) -> Optional['ConfigSnapshot']:
+        """
+        Map the snapshot of config_filepath into memory. Return None if there
+        is none, or if it is not readable by this version on this machine.
+        """
+        try:
+            with open(cls.get_filepath(config_filepath), 'rb') as fp:
+                buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            if buf[:len(MAGIC)] != MAGIC:
+                return None
+            start = len(MAGIC) + 8
+            header_length, = struct.unpack('<Q', buf[len(MAGIC):start])
+            header = json.loads(buf[start:start + header_length])
+            if header['format_version'] != FORMAT_VERSION or header['byteorder'] != sys.byteorder:
+                return None
+        except (ValueError, KeyError, struct.error):
+            return None
+        data_offset = start + header_length
+        data_offset += -data_offset % ALIGNMENT
+        return cls(buf, header, data_offset)
+
+    @classmethod
+    def remove(cls, config_filepath: str):
+        snapshot_filepath = cls.get_filepath(config_filepath)
+        if os.path.exists(snapshot_filepath):
+            os.remove(snapshot_filepath)
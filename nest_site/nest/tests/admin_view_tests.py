@@ -66,3 +66,20 @@ class TestViews(TestCase):
         self.client.login(username='staff', password='pass')
         response = self.client.get(reverse('admin:download_sureal', args=(1,)))
         self.assertEqual(response.status_code, 200)
+
+    def test_add_sessions(self):
+        ec = ExperimentUtils._create_experiment_from_config(
+            source_config_filepath=NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'),
+            is_test=True,
+            random_seed=1,
+            experiment_title='admin_view_tests.TestViews.test_add_sessions')
+        self.client.login(username='user', password='pass')
+
+        response = self.client.get(reverse('admin:add_sessions', args=(ec.experiment.id,)))
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.post(reverse('admin:add_sessions', args=(ec.experiment.id,)),
+                                    {'usernames': 'user, subj1@catflix.com\nsubj2@catflix.com'})
+        self.assertRedirects(response, reverse('admin:nestexp'))
+        self.assertEqual([sess.subject.user.username for sess in ec.experiment.session_set.order_by('id')],
+                         ['user', 'subj1@catflix.com', 'subj2@catflix.com'])
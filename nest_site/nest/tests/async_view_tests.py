@@ -0,0 +1,122 @@
+import inspect
+import os
+import tempfile
+from unittest.mock import patch
+
+from asgiref.sync import sync_to_async
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.test import AsyncClient, override_settings, TestCase
+from django.urls import path, re_path, resolve, reverse
+from nest.config import NestConfig
+from nest.io import ExperimentUtils
+from nest.models import FivePointVote, Subject
+from nest.sites import NestSite
+from nest_site.urls import async_mp4_byterange_view, favicon_view
+
+# as nest_site.urls with NEST_ASYNC_VIEWS
+urlpatterns = [
+    path('admin/', admin.site.urls),
+    path('', NestSite(async_views=True).urls),
+    re_path(r'^favicon\.ico$', favicon_view, name='favicon'),
+    re_path(r'^media/mp4/(?P<path>.*)$', async_mp4_byterange_view, name='mp4'),
+]
+
+
+@override_settings(ROOT_URLCONF='nest.tests.async_view_tests')
+class TestAsyncViews(TestCase):
+
+    def setUp(self) -> None:
+        User.objects.create_user('user', password='pass', is_staff=False)
+        self.ec = ExperimentUtils._create_experiment_from_config(
+            source_config_filepath=NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'),
+            is_test=True,
+            random_seed=1,
+            experiment_title='async_view_tests.TestAsyncViews')
+        self.sess = self.ec.add_session(Subject.create_by_username('user'))
+        self.async_client.login(username='user', password='pass')
+        self.step_url = reverse('nest:step_session', kwargs={'session_id': self.sess.id})
+
+    def test_async_views_selected(self):
+        for url in [reverse('nest:status'), reverse('nest:start_session', kwargs={'session_id': self.sess.id}),
+                    self.step_url, reverse('mp4', kwargs={'path': 'a.mp4'})]:
+            self.assertTrue(inspect.iscoroutinefunction(resolve(url).func))
+        self.assertFalse(inspect.iscoroutinefunction(resolve(reverse('nest:cookie')).func))
+
+    async def test_step_session(self):
+        response = await self.async_client.get(reverse('nest:status'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('no-cache' in response['Cache-Control'])
+        self.assertEqual([test['action'] for test in response.context_data['tests']], ['Start'])
+
+        response = await self.async_client.get(reverse('nest:start_session', kwargs={'session_id': self.sess.id}))
+        self.assertRedirects(response, self.step_url, fetch_redirect_response=False)
+        response = await self.async_client.get(self.step_url)
+        self.assertEqual(response.status_code, 200)
+        await self.async_client.get(self.step_url)
+        response = await self.async_client.post(self.step_url, {'acr_1': '1'})
+        self.assertEqual(response.status_code, 302)
+
+        response = await self.async_client.get(reverse('nest:status'))
+        self.assertEqual([test['action'] for test in response.context_data['tests']], ['Continue'])
+
+        await self.async_client.get(self.step_url)
+        await self.async_client.post(self.step_url, {'acr_0': '4'})
+        response = await self.async_client.get(self.step_url)
+        self.assertEqual(response.context_data['title'], 'Test done')
+        self.assertEqual([v.score async for v in FivePointVote.objects.order_by('round__round_id')], [1, 4])
+
+        response = await self.async_client.get(reverse('nest:status'))
+        self.assertEqual([test['status'] for test in response.context_data['tests']], ['Done'])
+
+    async def test_login_required(self):
+        response = await AsyncClient().get(self.step_url)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].startswith(reverse('nest:login')))
+
+    async def test_verify_subject(self):
+        await sync_to_async(User.objects.create_user)('user2', password='pass')
+        client = AsyncClient()
+        await sync_to_async(client.login)(username='user2', password='pass')
+        with self.assertRaises(AssertionError):
+            await client.get(reverse('nest:start_session', kwargs={'session_id': self.sess.id}))
+
+
+class TestMp4ByteRangeViews(TestCase):
+
+    def setUp(self) -> None:
+        self.media_root = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.media_root.name, 'mp4'))
+        self.data = bytes(range(256)) * 1000
+        with open(os.path.join(self.media_root.name, 'mp4', 'a.mp4'), 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self.media_root.cleanup()
+
+    async def test_async_mp4_byterange_view(self):
+        url = reverse('mp4', kwargs={'path': 'a.mp4'})
+        with patch('nest_site.settings.MEDIA_ROOT', self.media_root.name):
+            for headers, status_code, content in [
+                ({}, 200, self.data),
+                ({'range': 'bytes=1000-70000'}, 206, self.data[1000:70001]),
+                ({'range': 'bytes=-100'}, 206, self.data[-100:]),
+                ({'range': 'bytes=300000-300100'}, 416, b''),
+            ]:
+                # as served by mp4_byterange_view
+                sync_response = await sync_to_async(self.client.get)(url, headers=headers)
+                with override_settings(ROOT_URLCONF='nest.tests.async_view_tests'):
+                    response = await self.async_client.get(url, headers=headers)
+                self.assertEqual(response.status_code, status_code)
+                self.assertEqual(sync_response.status_code, status_code)
+                if status_code == 416:
+                    continue
+                self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), content)
+                self.assertEqual(int(response['Content-Length']), len(content))
+                self.assertEqual(b''.join(sync_response.streaming_content), content)
+                for header in ['Content-Range', 'Accept-Ranges', 'Content-Disposition']:
+                    self.assertEqual(response.get(header), sync_response.get(header))
+
+            with override_settings(ROOT_URLCONF='nest.tests.async_view_tests'):
+                with self.assertRaises(FileNotFoundError):
+                    await self.async_client.get(reverse('mp4', kwargs={'path': '../a.mp4'}))
@@ -0,0 +1,60 @@
+import os
+
+from django.test import override_settings, TestCase
+from nest.config import NestConfig
+from nest.config_storage import DatabaseExperimentConfigStorage, FileExperimentConfigStorage, \
+    get_experiment_config_storage
+from nest.io import ExperimentUtils
+from nest.models import ExperimentConfigVersion
+
+
+@override_settings(EXPERIMENT_CONFIG_STORAGE='database')
+class TestDatabaseExperimentConfigStorage(TestCase):
+
+    EXPERIMENT_TITLE = 'config_storage_tests.TestDatabaseExperimentConfigStorage'
+
+    def setUp(self) -> None:
+        self.ec = ExperimentUtils.create_experiment(
+            experiment_config_filepath=NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'),
+            experimenter_username='lukas@catflix.com',
+            is_test=True,
+            random_seed=1,
+            experiment_title=self.EXPERIMENT_TITLE)
+
+    def test_storage_selected_by_setting(self):
+        self.assertTrue(isinstance(get_experiment_config_storage(), DatabaseExperimentConfigStorage))
+        with override_settings(EXPERIMENT_CONFIG_STORAGE='file'):
+            self.assertTrue(isinstance(get_experiment_config_storage(), FileExperimentConfigStorage))
+
+    def test_create_and_load(self):
+        self.assertFalse(os.path.exists(FileExperimentConfigStorage.get_filepath(self.EXPERIMENT_TITLE, is_test=True)))
+        cv = ExperimentConfigVersion.objects.get(experiment=self.ec.experiment)
+        self.assertEqual(cv.version, 1)
+        self.assertIsNone(cv.path_check_date)
+
+        ec = ExperimentUtils.get_experiment_controller(self.EXPERIMENT_TITLE, skip_path_check=True)
+        self.assertEqual(ec.experiment_config.title, self.EXPERIMENT_TITLE)
+        self.assertEqual(ec.experiment_config.random_seed, 1)
+        ec2 = ExperimentUtils.get_experiment_controller(self.EXPERIMENT_TITLE, skip_path_check=True)
+        self.assertTrue(ec2.experiment_config is ec.experiment_config)
+        self.assertEqual(
+            get_experiment_config_storage().load_dict(self.EXPERIMENT_TITLE)['experiment_config']['title'],
+            self.EXPERIMENT_TITLE)
+
+    def test_new_version(self):
+        storage = get_experiment_config_storage()
+        ecfg = storage.load(self.EXPERIMENT_TITLE, skip_path_check=True)
+        config = storage.load_dict(self.EXPERIMENT_TITLE)
+        config['experiment_config']['description'] = 'updated description'
+        storage.save(self.ec.experiment, config, path_checked=False)
+        self.assertEqual(ExperimentConfigVersion.objects.filter(experiment=self.ec.experiment).count(), 2)
+        ecfg2 = storage.load(self.EXPERIMENT_TITLE, skip_path_check=True)
+        self.assertFalse(ecfg2 is ecfg)
+        self.assertEqual(ecfg2.description, 'updated description')
+
+    def test_delete_experiment(self):
+        ExperimentUtils.delete_experiment_by_title(self.EXPERIMENT_TITLE, is_test=True)
+        self.assertFalse(get_experiment_config_storage().exists(self.EXPERIMENT_TITLE))
+        self.assertEqual(ExperimentConfigVersion.objects.count(), 0)
+        with self.assertRaises(ExperimentConfigVersion.DoesNotExist):
+            get_experiment_config_storage().load(self.EXPERIMENT_TITLE)
@@ -1,7 +1,10 @@
 import json
+import os
+import shutil
 
 from django.test import TestCase
-from nest.config import ExperimentConfig, NestConfig, StimulusConfig
+from nest.config import ConfigValidationError, ExperimentConfig, ExperimentConfigCache, MediaPathVerifier, \
+    NestConfig, StimulusConfig, ValidationCertificate
 
 
 class TestStimulusConfig(TestCase):
@@ -71,6 +74,11 @@ class TestStimulusConfig(TestCase):
         with self.assertRaises(AssertionError) as e:
             _ = scfg.super_stimulusgroup_ids
         self.assertTrue('super_stimulusgroup_id must be all-present or all-absent' in str(e.exception))
+        self.assertEqual(sorted(scfg.stimulusgroup_dict.keys()), [0, 2, 3, 4, 5])
+        self.assertTrue(scfg.stimulusgroup_dict[3] is scfg.stimulusgroups[3])
+        self.assertEqual(scfg.stimulusvotegroup_dict[1]['stimulus_ids'], [1])
+        self.assertEqual(scfg.stimulus_dict[1]['stimulus_id'], 1)
+        self.assertEqual(scfg.content_dict[0]['name'], 'CTS3E1_B__15_55_16_0')
 
     def test_stim_config_with_public_path(self):
         scfg = StimulusConfig({
@@ -122,6 +130,26 @@ class TestStimulusConfig(TestCase):
         self.assertEqual(scfg.get_video_display_percentage(5), 100)
         self.assertEqual(scfg.get_video_display_percentage(6), None)
         self.assertEqual(scfg.super_stimulusgroup_ids, [0, 0, 0, 1, 1])
+        self.assertTrue(scfg.get_super_stimulusgroup_ids() is scfg.get_super_stimulusgroup_ids())
+
+    def test_get_ids_memoized(self):
+        with open(NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'), 'rt') as fp:
+            config = json.load(fp)
+        scfg = StimulusConfig(config['stimulus_config'], skip_path_check=True)
+        ids = scfg.get_ids('stimulusgroups')
+        self.assertEqual(ids.typecode, 'q')
+        self.assertTrue(scfg.get_ids('stimulusgroups') is ids)
+        self.assertEqual(list(ids), [sg['stimulusgroup_id'] for sg in config['stimulus_config']['stimulusgroups']])
+        # the list views are copies, so callers cannot alter the memoized ids
+        scfg.stimulusgroup_ids.append(-1)
+        self.assertEqual(scfg.stimulusgroup_ids, list(ids))
+        self.assertEqual(set(scfg._ids.keys()), {'stimulusgroups'})
+        self.assertIsNone(scfg.get_super_stimulusgroup_ids())
+
+    def test_get_ids_non_int(self):
+        scfg = StimulusConfig({'contents': [{'content_id': 'a'}, {}],
+                               'stimuli': [], 'stimulusvotegroups': [], 'stimulusgroups': []}, trusted=True)
+        self.assertEqual(scfg.content_ids, ['a', None])
 
 
 class TestExperimentConfig(TestCase):
@@ -311,3 +339,262 @@ class TestExperimentConfig(TestCase):
         with self.assertRaises(AssertionError):
             ExperimentConfig(stimulus_config=scfg,
                              config=config['experiment_config'])
+
+
+class TestExperimentConfigCache(TestCase):
+
+    def setUp(self) -> None:
+        self.config_filedir = NestConfig.tests_workdir_path('config_cache')
+        os.makedirs(self.config_filedir, exist_ok=True)
+        with open(NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'), 'rt') as fp:
+            self.config = json.load(fp)
+
+    def tearDown(self):
+        shutil.rmtree(self.config_filedir)
+
+    def _write_config(self, filename, config):
+        filepath = os.path.join(self.config_filedir, filename)
+        with open(filepath, 'wt') as fp:
+            json.dump(config, fp, indent=4)
+        return filepath
+
+    def test_hit_and_miss(self):
+        cache = ExperimentConfigCache()
+        filepath = self._write_config('a.json', self.config)
+        ecfg = cache.get('a', filepath)
+        self.assertEqual(ecfg.title, self.config['experiment_config']['title'])
+        self.assertTrue(cache.get('a', filepath) is ecfg)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.stats()['entries'], 1)
+
+        # rewritten with the same content: no recompilation
+        st = os.stat(filepath)
+        self._write_config('a.json', self.config)
+        os.utime(filepath, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        self.assertTrue(cache.get('a', filepath) is ecfg)
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+        # content change: recompile
+        self.config['experiment_config']['rounds_per_session'] = 1
+        self._write_config('a.json', self.config)
+        os.utime(filepath, ns=(st.st_atime_ns, st.st_mtime_ns + 2 * 10 ** 9))
+        ecfg2 = cache.get('a', filepath)
+        self.assertFalse(ecfg2 is ecfg)
+        self.assertEqual(ecfg2.rounds_per_session, 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+        self.assertEqual(cache.stats()['entries'], 1)
+
+        cache.invalidate('a')
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_invalid_config_not_cached(self):
+        cache = ExperimentConfigCache()
+        self.config['experiment_config']['rounds_per_session'] = 0
+        filepath = self._write_config('a.json', self.config)
+        with self.assertRaises(AssertionError):
+            cache.get('a', filepath)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_lru_eviction(self):
+        filepath_a = self._write_config('a.json', self.config)
+        filepath_b = self._write_config('b.json', self.config)
+        filepath_c = self._write_config('c.json', self.config)
+        cache = ExperimentConfigCache(max_bytes=int(os.path.getsize(filepath_a) * 2.5))
+        cache.get('a', filepath_a)
+        cache.get('b', filepath_b)
+        cache.get('a', filepath_a)
+        cache.get('c', filepath_c)  # evicts b, the least recently used
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['entries'], 2)
+        cache.get('a', filepath_a)
+        self.assertEqual(cache.stats()['misses'], 3)
+        cache.get('b', filepath_b)
+        self.assertEqual(cache.stats()['misses'], 4)
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+
+class TestConfigValidationReport(TestCase):
+
+    def test_collect_all_violations(self):
+        stimulus_config = {
+            "contents": [
+                {"content_id": 0, "name": "c0"},
+                {"content_id": 0, "name": "c0 duplicated"},
+            ],
+            "stimuli": [
+                {"path": "https://example.com/0.mp4", "stimulus_id": 0, "type": "video/mp4", "content_id": 0},
+                {"path": "https://example.com/1.mp4", "stimulus_id": 1, "type": "video/mp4", "content_id": 9},
+            ],
+            "stimulusvotegroups": [
+                {"stimulus_ids": [0], "stimulusvotegroup_id": 0},
+                {"stimulus_ids": [7], "stimulusvotegroup_id": 1},
+            ],
+            "stimulusgroups": [
+                {"stimulusgroup_id": 0, "stimulusvotegroup_ids": [0], "video_display_percentage": 0},
+                {"stimulusgroup_id": 1, "stimulusvotegroup_ids": [1, 5]},
+            ],
+        }
+        with self.assertRaises(ConfigValidationError) as e:
+            StimulusConfig(stimulus_config)
+        report = e.exception.report
+        self.assertEqual(len(report.violations), 5)
+        self.assertEqual(report.violations[0], {'section': 'contents', 'index': 1,
+                                                'message': 'content_ids must be unique, but 0 is duplicated'})
+        self.assertEqual([(v['section'], v['index']) for v in report.violations],
+                         [('contents', 1), ('stimuli', 1), ('stimulusvotegroups', 1),
+                          ('stimulusgroups', 0), ('stimulusgroups', 1)])
+        self.assertTrue(isinstance(e.exception, AssertionError))
+        self.assertTrue('5 violation(s) found in config' in str(e.exception))
+
+    def test_collect_all_violations_experiment_config(self):
+        config_filepath = NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json')
+        with open(config_filepath, 'rt') as fp:
+            config = json.load(fp)
+        scfg = StimulusConfig(config['stimulus_config'])
+        config['experiment_config']['vote_scale'] = '2AFC'
+        config['experiment_config']['blocklist_stimulusgroup_ids'] = [0, 99]
+        config['experiment_config']['prioritized'] = [{'session_idx': None, 'round_id': 100, 'stimulusgroup_id': 98}]
+        with self.assertRaises(ConfigValidationError) as e:
+            ExperimentConfig(stimulus_config=scfg, config=config['experiment_config'])
+        report = e.exception.report
+        self.assertFalse(report.ok)
+        self.assertEqual([v['section'] for v in report.violations],
+                         ['experiment_config', 'blocklist_stimulusgroup_ids', 'prioritized', 'prioritized'])
+        self.assertEqual(report.to_dict()['ok'], False)
+
+
+class TestMediaPathVerifier(TestCase):
+
+    def setUp(self) -> None:
+        self.media_filedir = NestConfig.tests_workdir_path('media_path_verifier')
+        os.makedirs(self.media_filedir, exist_ok=True)
+        self.filepaths = list()
+        for i in range(5):
+            filepath = os.path.join(self.media_filedir, f'{i}.mp4')
+            with open(filepath, 'wb') as fp:
+                fp.write(b'0' * (i + 1))
+            self.filepaths.append(filepath)
+
+    def tearDown(self):
+        shutil.rmtree(self.media_filedir)
+
+    def test_check_all(self):
+        verifier = MediaPathVerifier(max_workers=4)
+        missing_filepath = os.path.join(self.media_filedir, 'missing.mp4')
+        results = verifier.check_all(self.filepaths + [missing_filepath])
+        self.assertEqual([r['status'] for r in results], ['ok'] * 5 + ['missing'])
+        self.assertEqual([r['size'] for r in results], [1, 2, 3, 4, 5, None])
+        self.assertEqual(results[-1]['local_path'], missing_filepath)
+        self.assertEqual(verifier.stats()['misses'], 5)
+        self.assertEqual(verifier.stats()['hits'], 0)
+
+    def test_cache_by_mtime(self):
+        verifier = MediaPathVerifier()
+        verifier.check_all(self.filepaths)
+        verifier.check_all(self.filepaths)
+        self.assertEqual(verifier.stats()['misses'], 5)
+        self.assertEqual(verifier.stats()['hits'], 5)
+        st = os.stat(self.filepaths[0])
+        os.utime(self.filepaths[0], ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        verifier.check_all(self.filepaths)
+        self.assertEqual(verifier.stats()['misses'], 6)
+        self.assertEqual(verifier.stats()['hits'], 9)
+
+    def test_cache_bounded(self):
+        verifier = MediaPathVerifier(maxsize=2)
+        verifier.check_all(self.filepaths)
+        self.assertEqual(verifier.stats()['entries'], 2)
+        self.assertEqual(verifier.stats()['evictions'], 3)
+        # the most recently checked are kept
+        verifier.check_all(self.filepaths[-2:])
+        self.assertEqual(verifier.stats()['hits'], 2)
+        verifier.check_all(self.filepaths[:1])
+        self.assertEqual(verifier.stats()['misses'], 6)
+        self.assertEqual(verifier.stats()['entries'], 2)
+
+    def test_directory(self):
+        verifier = MediaPathVerifier()
+        results = verifier.check_all([self.media_filedir])
+        self.assertEqual(results[0]['status'], 'ok')
+
+    def test_verify_skips_urls(self):
+        verifier = MediaPathVerifier()
+        failures = verifier.verify(['https://example.com/a.mp4', '/media/mp4/samples/does_not_exist.mp4'])
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0]['url_path'], '/media/mp4/samples/does_not_exist.mp4')
+        self.assertEqual(failures[0]['status'], 'missing')
+
+    def test_stimulus_config_path_check(self):
+        with self.assertRaises(ConfigValidationError) as e:
+            StimulusConfig({
+                'contents': [{'content_id': 0, 'name': 'c0'}],
+                'stimuli': [{'stimulus_id': 0, 'path': '/media/mp4/samples/does_not_exist.mp4',
+                             'type': 'video/mp4', 'content_id': 0},
+                            {'stimulus_id': 1, 'path': 'https://example.com/a.mp4',
+                             'type': 'video/mp4', 'content_id': 0}],
+                'stimulusvotegroups': [{'stimulusvotegroup_id': 0, 'stimulus_ids': [0]},
+                                       {'stimulusvotegroup_id': 1, 'stimulus_ids': [1]}],
+                'stimulusgroups': [{'stimulusgroup_id': 0, 'stimulusvotegroup_ids': [0, 1]}],
+            })
+        self.assertEqual(len(e.exception.report.violations), 1)
+        self.assertEqual(e.exception.report.violations[0]['section'], 'stimuli')
+        self.assertEqual(e.exception.report.violations[0]['index'], 0)
+
+
+class TestValidationCertificate(TestCase):
+
+    def setUp(self) -> None:
+        self.config_filedir = NestConfig.tests_workdir_path('validation_certificate')
+        os.makedirs(self.config_filedir, exist_ok=True)
+        with open(NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'), 'rt') as fp:
+            config = json.load(fp)
+        # media path that fails full validation, so that a successful load
+        # means the trusted fast path was taken
+        config['stimulus_config']['stimuli'][0]['path'] = '/media/mp4/samples/does_not_exist.mp4'
+        self.config_filepath = os.path.join(self.config_filedir, 'a.json')
+        with open(self.config_filepath, 'wt') as fp:
+            json.dump(config, fp, indent=4)
+        with open(self.config_filepath, 'rb') as fp:
+            self.data = fp.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.config_filedir)
+
+    def test_no_certificate(self):
+        self.assertIsNone(ValidationCertificate.load(self.config_filepath))
+        with self.assertRaises(ConfigValidationError):
+            ExperimentConfigCache().get('a', self.config_filepath)
+
+    def test_trusted_load(self):
+        cert = ValidationCertificate.issue(self.config_filepath, self.data, path_checked=True)
+        self.assertTrue(os.path.exists(self.config_filepath + '.cert'))
+        loaded = ValidationCertificate.load(self.config_filepath)
+        self.assertEqual(loaded.to_dict(), cert.to_dict())
+        self.assertEqual(loaded.validator_version, ValidationCertificate.VALIDATOR_VERSION)
+        ecfg = ExperimentConfigCache().get('a', self.config_filepath)
+        self.assertEqual(ecfg.stimulus_config.stimuli[0]['path'], '/media/mp4/samples/does_not_exist.mp4')
+
+    def test_hash_mismatch(self):
+        ValidationCertificate.issue(self.config_filepath, self.data, path_checked=True)
+        with open(self.config_filepath, 'ab') as fp:
+            fp.write(b'\n')
+        with self.assertRaises(ConfigValidationError):
+            ExperimentConfigCache().get('a', self.config_filepath)
+
+    def test_path_check_required(self):
+        ValidationCertificate.issue(self.config_filepath, self.data, path_checked=False)
+        self.assertIsNone(ValidationCertificate.load(self.config_filepath).path_check_timestamp)
+        with self.assertRaises(ConfigValidationError):
+            ExperimentConfigCache().get('a', self.config_filepath)
+        ExperimentConfigCache().get('a', self.config_filepath, skip_path_check=True)
+
+    def test_validator_version_mismatch(self):
+        cert = ValidationCertificate.issue(self.config_filepath, self.data, path_checked=True)
+        cert.validator_version = ValidationCertificate.VALIDATOR_VERSION - 1
+        with open(ValidationCertificate.get_filepath(self.config_filepath), 'wt') as fp:
+            json.dump(cert.to_dict(), fp)
+        with self.assertRaises(ConfigValidationError):
+            ExperimentConfigCache().get('a', self.config_filepath)
@@ -1,13 +1,21 @@
 import json
+import logging
 import random
+import sqlite3
+import threading
+import time
+from unittest.mock import patch
 
 import numpy as np
-from django.test import TestCase
+from django.db import connection, OperationalError
+from django.db.models import Count
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from nest.config import ExperimentConfig, NestConfig, StimulusConfig
 from nest.control import ExperimentController, SessionStatus
-from nest.helpers import indices
-from nest.models import Content, Experiment, Round, Session, Stimulus, \
-    StimulusGroup, StimulusVoteGroup, Subject
+from nest.helpers import CacheInfo, indices, instance_memoized, my_argmin
+from nest.models import Content, Experiment, FivePointVote, Round, Session, Stimulus, \
+    StimulusGroup, StimulusGroupExposure, StimulusVoteGroup, Subject, Vote, VoteRegister
 
 
 class TestOrder(TestCase):
@@ -667,6 +675,53 @@ class TestOrder(TestCase):
              1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0]
         )
 
+    def test_least_weight_candidates_equivalence(self):
+
+        class ListCandidates(object):
+            # the former my_argmin/list.remove selection
+            def __init__(self, a, shortlist):
+                self.a = a
+                self.shortlist = list(shortlist)
+
+            def __len__(self):
+                return len(self.shortlist)
+
+            def least_candidates(self):
+                return my_argmin(self.a, self.shortlist)
+
+            def take(self, position):
+                sgidx = my_argmin(self.a, self.shortlist)[position]
+                self.shortlist.remove(sgidx)
+                return sgidx
+
+        randgen = random.Random(0)
+        for _ in range(200):
+            num_sgs = randgen.randint(1, 20)
+            stimulusgroup_ids = randgen.sample(range(100), num_sgs)
+            blocklist = randgen.sample(stimulusgroup_ids, randgen.randint(0, num_sgs - 1))
+            ordering_so_far = [
+                {'subject': randgen.randint(0, 3),
+                 'stimulusgroups': {rid: randgen.choice(stimulusgroup_ids) for rid in range(randgen.randint(1, 10))}}
+                for _ in range(randgen.randint(0, 5))]
+            prioritized = [
+                {'session_idx': randgen.choice([None, len(ordering_so_far)]),
+                 'round_id': randgen.choice([None, 0]),
+                 'stimulusgroup_id': randgen.choice(stimulusgroup_ids)}
+                for _ in range(randgen.randint(0, 2))]
+            kwargs = dict(
+                rounds_per_session=randgen.randint(len(prioritized), 3 * num_sgs + len(prioritized)),
+                stimulusgroup_ids=stimulusgroup_ids,
+                subject_id=randgen.randint(0, 3),
+                ordering_so_far=ordering_so_far,
+                prioritized=prioritized,
+                random_seed=randgen.randint(0, 2**16),
+                blocklist_stimulusgroup_ids=blocklist,
+                super_stimulusgroup_ids=randgen.choice([None, [randgen.randint(0, 2) for _ in range(num_sgs)]]),
+            )
+            d = ExperimentController._order(**kwargs)
+            with patch('nest.control.LeastWeightCandidates', ListCandidates):
+                self.assertEqual(d, ExperimentController._order(**kwargs))
+
 
 class TestExperimentController(TestCase):
 
@@ -1250,3 +1305,445 @@ class TestExperimentControllerWithConfig(TestCase):
         self.assertEqual(Round.objects.count(), 2)
         ec.delete_session(sess.id)
         self.assertEqual(Round.objects.count(), 0)
+
+
+class TestSessionStepPlan(TestCase):
+
+    def setUp(self) -> None:
+        with open(NestConfig.tests_resource_path('cvxhull_subjexp_toy_dcr.json'), 'rt') as fp:
+            self.config = json.load(fp)
+        addition = self.config['experiment_config']['additions'][0]
+        self.config['experiment_config']['additions'] += [
+            {'position': {'round_id': 1, 'before_or_after': 'after'}, 'context': dict(addition['context'], title='a1')},
+            {'position': {'round_id': 1, 'before_or_after': 'before'}, 'context': dict(addition['context'], title='b1')},
+            {'position': {'round_id': 0, 'before_or_after': 'after'}, 'context': dict(addition['context'], title='a0')},
+        ]
+        self.ec = ExperimentController(experiment=Experiment.objects.create(title='step_plan'),
+                                       experiment_config=self._make_experiment_config(self.config))
+        self.ec.populate_stimuli()
+
+    @staticmethod
+    def _make_experiment_config(config):
+        scfg = StimulusConfig(config['stimulus_config'], skip_path_check=True)
+        return ExperimentConfig(stimulus_config=scfg, config=config['experiment_config'])
+
+    def _get_steps_by_insertion(self, session):
+        od = self.ec._get_ordering_for_session(session.id)
+        steps = [{'position': {'round_id': rid}, 'context': {'stimulusgroup_id': od['stimulusgroups'][rid]}}
+                 for rid in sorted(od['stimulusgroups'])]
+        for addition in self.ec.experiment_config.additions:
+            ExperimentController._insert_addition_into_steps(dict(addition), steps)
+        return steps
+
+    def test_step_plan(self):
+        sess = self.ec.add_session(Subject.objects.create())
+        self.assertEqual(Session.objects.get(id=sess.id).step_plan, sess.step_plan)
+        steps = self._get_steps_by_insertion(sess)
+        self.assertEqual([step['context']['title'] for step in steps if 'title' in step['context']],
+                         [self.config['experiment_config']['additions'][0]['context']['title'], 'a0', 'b1', 'a1'])
+
+        sess = Session.objects.get(id=sess.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.ec.get_session_steps(sess), steps)
+        self.assertEqual(sess.step_plan.split(':')[1].count(','), len(steps) - 1)
+
+        # the steps returned can be modified
+        self.ec.get_session_steps(sess)[0]['context'] = None
+        self.assertEqual(self.ec.get_session_steps(sess), steps)
+
+    def test_recompile(self):
+        sess = self.ec.add_session(Subject.objects.create())
+        sess2 = self.ec.add_session(Subject.objects.create())
+        Session.objects.filter(id=sess2.id).update(step_plan=None)
+        sess2 = Session.objects.get(id=sess2.id)
+        self.assertEqual(self.ec.get_session_steps(sess2), self._get_steps_by_insertion(sess2))
+        self.assertEqual(Session.objects.get(id=sess2.id).step_plan,
+                         self.ec._compile_step_plan(self.ec._get_ordering_for_session(sess2.id)['stimulusgroups']))
+
+        # a plan compiled for other additions is recompiled
+        del self.config['experiment_config']['additions'][1]
+        self.ec.experiment_config = self._make_experiment_config(self.config)
+        sess = Session.objects.get(id=sess.id)
+        self.assertEqual(self.ec.get_session_steps(sess), self._get_steps_by_insertion(sess))
+        self.assertEqual(len(self.ec.get_session_steps(sess)), 5)
+
+        self.assertEqual(self.ec.compile_session_step_plans(), 2)
+        sess2 = Session.objects.get(id=sess2.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.ec.get_session_steps(sess2), self._get_steps_by_insertion(sess2))
+
+    def test_rounds_changed(self):
+        sess, sess2 = self.ec.add_sessions([Subject.objects.create(), Subject.objects.create()])
+        steps = self.ec.get_session_steps(Session.objects.get(id=sess.id))
+        sgid = steps[1]['context']['stimulusgroup_id']
+        sg_other = StimulusGroup.objects.filter(experiment=self.ec.experiment).exclude(stimulusgroup_id=sgid).first()
+
+        r = Round.objects.get(session=sess, round_id=0)
+        r.stimulusgroup = sg_other
+        r.save()
+        sess = Session.objects.get(id=sess.id)
+        self.assertEqual(sess.step_plan, None)
+        self.assertEqual(self.ec.get_session_steps(sess)[1]['context']['stimulusgroup_id'], sg_other.stimulusgroup_id)
+        self.assertEqual(self.ec.get_session_steps(sess), self._get_steps_by_insertion(sess))
+
+        # saving the response_sec only leaves the plan as it is
+        r.response_sec = 1.5
+        r.save(update_fields=['response_sec'])
+        self.assertNotEqual(Session.objects.get(id=sess.id).step_plan, None)
+
+        # the rounds of a deleted stimulusgroup are SET_NULL
+        sess2_sgids = set(Round.objects.filter(session=sess2).values_list('stimulusgroup_id', flat=True))
+        StimulusGroup.objects.get(id=next(iter(sess2_sgids))).delete()
+        self.assertEqual(Session.objects.get(id=sess2.id).step_plan, None)
+        self.assertTrue(None in set(Round.objects.filter(session=sess2).values_list('stimulusgroup_id', flat=True)))
+
+
+class TestRecordSessionVotes(TestCase):
+
+    def setUp(self) -> None:
+        with open(NestConfig.tests_resource_path('cvxhull_subjexp_toy_dcr.json'), 'rt') as fp:
+            config = json.load(fp)
+        scfg = StimulusConfig(config['stimulus_config'], skip_path_check=True)
+        ecfg = ExperimentConfig(stimulus_config=scfg, config=config['experiment_config'])
+        self.ec = ExperimentController(experiment=Experiment.objects.create(title='record_votes'),
+                                       experiment_config=ecfg)
+        self.ec.populate_stimuli()
+
+    def _get_round_steps(self, session, scores):
+        steps = list()
+        for rnd in session.round_set.order_by('round_id'):
+            sgid = rnd.stimulusgroup.stimulusgroup_id
+            svgids = self.ec.experiment_config.stimulus_config.stimulusgroup_dict[sgid]['stimulusvotegroup_ids']
+            steps.append({'position': {'round_id': rnd.round_id},
+                          'context': {'stimulusgroup_id': sgid,
+                                      'score': {str(svgid): scores[rnd.round_id] for svgid in svgids},
+                                      'response_sec': 1.5 + rnd.round_id}})
+        return steps
+
+    def test_record_session_votes(self):
+        sess, sess2, sess3 = self.ec.add_sessions([Subject.objects.create() for _ in range(3)])
+        self.assertEqual(self.ec.get_session_status(sess), SessionStatus.INITIALIZED)
+
+        votes = self.ec.record_session_votes(sess, self._get_round_steps(sess, [4, 2]))
+        self.assertEqual(len(votes), 2)
+        self.assertEqual(self.ec.get_session_status(sess), SessionStatus.FINISHED)
+        self.assertEqual(sorted((v.round.round_id, v.score) for v in FivePointVote.objects.filter(round__session=sess)),
+                         [(0, 4), (1, 2)])
+        self.assertEqual(list(sess.round_set.order_by('round_id').values_list('response_sec', flat=True)), [1.5, 2.5])
+
+        # the number of queries does not depend on the number of steps
+        steps2 = self._get_round_steps(sess2, [1, 5])
+        steps3 = self._get_round_steps(sess3, [1, 5])[:1]
+        with CaptureQueriesContext(connection) as ctx:
+            self.ec.record_session_votes(sess2, steps2)
+        with self.assertNumQueries(len(ctx.captured_queries)):
+            self.ec.record_session_votes(sess3, steps3)
+        self.assertEqual(self.ec.get_session_status(sess2), SessionStatus.FINISHED)
+        self.assertEqual(self.ec.get_session_status(sess3), SessionStatus.PARTIALLY_FINISHED)
+
+    def test_record_session_votes_resubmitted(self):
+        sess = self.ec.add_session(Subject.objects.create())
+        steps = self._get_round_steps(sess, [4, 2])
+        self.ec.record_session_votes(sess, steps[:1])
+
+        # the same votes are skipped
+        with self.assertLogs('control', level='WARNING'):
+            votes = self.ec.record_session_votes(sess, steps)
+        self.assertEqual([(v.round.round_id, v.score) for v in votes], [(1, 2)])
+        with self.assertLogs('control', level='WARNING'):
+            self.assertEqual(self.ec.record_session_votes(sess, steps), [])
+        self.assertEqual(Vote.objects.filter(round__session=sess).count(), 2)
+
+        # a different vote records nothing
+        sess2 = self.ec.add_session(Subject.objects.create())
+        self.ec.record_session_votes(sess2, self._get_round_steps(sess2, [4, 2])[:1])
+        with self.assertLogs('control', level='ERROR'):
+            with self.assertRaises(AssertionError):
+                self.ec.record_session_votes(sess2, self._get_round_steps(sess2, [3, 2]))
+        self.assertEqual(Vote.objects.filter(round__session=sess2).count(), 1)
+        self.assertEqual(sess2.round_set.get(round_id=1).response_sec, None)
+
+
+class TestOrderingCache(TestCase):
+
+    def test_instance_memoized(self):
+        class A(object):
+            def __init__(self):
+                self.calls = 0
+
+            @instance_memoized(maxsize=2, ttl=10)
+            def f(self, x):
+                self.calls += 1
+                return x, self.calls
+
+        a, b = A(), A()
+        self.assertEqual([a.f(1), a.f(1), b.f(1)], [(1, 1), (1, 1), (1, 1)])
+        a.f(2)
+        a.f(3)
+        self.assertEqual(A.f.cache_info(), CacheInfo(hits=1, misses=4, evictions=1, invalidations=0, currsize=3))
+        with patch('nest.helpers.time.monotonic', return_value=time.monotonic() + 11):
+            self.assertEqual(a.f(3), (3, 4))
+        A.f.invalidate(1)
+        self.assertEqual(b.f(1), (1, 2))
+        self.assertEqual(A.f.cache_info().invalidations, 1)
+        self.assertEqual(a.f([1]), ([1], 5))  # not hashable, not cached
+        del a, b
+        self.assertEqual(A.f.cache_info().currsize, 0)
+
+    def test_invalidate_on_round_save(self):
+        with open(NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'), 'rt') as fp:
+            config = json.load(fp)
+        scfg = StimulusConfig(config['stimulus_config'])
+        ecfg = ExperimentConfig(stimulus_config=scfg, config=config['experiment_config'])
+        ec = ExperimentController(experiment=Experiment.objects.create(title='ordering_cache'), experiment_config=ecfg)
+        ec.populate_stimuli()
+        sess = ec.add_session(Subject.objects.create())
+
+        info = ExperimentController._get_ordering_for_session.cache_info()
+        od = ec._get_ordering_for_session(sess.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(ec._get_ordering_for_session(sess.id), od)
+        self.assertEqual(ExperimentController._get_ordering_for_session.cache_info().hits, info.hits + 1)
+
+        r = Round.objects.get(session=sess, round_id=0)
+        r.stimulusgroup = StimulusGroup.objects.get(experiment=ec.experiment, stimulusgroup_id=1 - od['stimulusgroups'][0])
+        r.save()
+        self.assertEqual(ec._get_ordering_for_session(sess.id)['stimulusgroups'][0], 1 - od['stimulusgroups'][0])
+
+        subj = Subject.objects.create()
+        sess.subject = subj
+        sess.save()
+        self.assertEqual(ec._get_ordering_for_session(sess.id)['subject'], subj.id)
+
+        currsize = ExperimentController._get_ordering_for_session.cache_info().currsize
+        del ec
+        self.assertEqual(ExperimentController._get_ordering_for_session.cache_info().currsize, currsize - 1)
+
+
+class TestConcurrentAssignment(TransactionTestCase):
+
+    NUM_STIMULUSGROUPS = 10
+    ROUNDS_PER_SESSION = 3
+    SESSIONS_PER_PROVISIONER = 4
+
+    def setUp(self) -> None:
+        n = self.NUM_STIMULUSGROUPS
+        scfg = StimulusConfig({
+            'contents': [{'content_id': 0, 'name': 'content_0'}],
+            'stimuli': [{'stimulus_id': i, 'path': f'https://example.com/{i}.mp4', 'type': 'video/mp4', 'content_id': 0}
+                        for i in range(n)],
+            'stimulusvotegroups': [{'stimulusvotegroup_id': i, 'stimulus_ids': [i]} for i in range(n)],
+            'stimulusgroups': [{'stimulusgroup_id': i, 'stimulusvotegroup_ids': [i]} for i in range(n)],
+        }, skip_path_check=True)
+        self.ecfg = ExperimentConfig(stimulus_config=scfg, config={
+            'title': 'concurrent', 'description': 'concurrent', 'vote_scale': 'FIVE_POINT',
+            'methodology': 'acr', 'rounds_per_session': self.ROUNDS_PER_SESSION, 'random_seed': 1})
+
+    def _provision(self, num_provisioners):
+        exp = Experiment.objects.create(title=f'concurrent_{num_provisioners}')
+        ExperimentController(experiment=exp, experiment_config=self.ecfg).populate_stimuli()
+        subjects = [Subject.objects.create() for _ in range(num_provisioners * self.SESSIONS_PER_PROVISIONER)]
+        # one controller per provisioner, each set up before any concurrent writes begin
+        ecs = [ExperimentController(experiment=Experiment.objects.get(pk=exp.pk), experiment_config=self.ecfg)
+               for _ in range(num_provisioners)]
+        errors = list()
+
+        def provision(i):
+            try:
+                for subj in subjects[i::num_provisioners]:
+                    ecs[i].add_session(subj)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=provision, args=(i,)) for i in range(num_provisioners)]
+        start_time = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start_time
+        self.assertEqual(errors, [])
+        return exp, len(subjects) / elapsed
+
+    def test_concurrent_add_session(self):
+        for num_provisioners in [1, 4, 16]:
+            exp, sessions_per_sec = self._provision(num_provisioners)
+            num_sessions = num_provisioners * self.SESSIONS_PER_PROVISIONER
+            self.assertEqual(exp.session_set.count(), num_sessions)
+            self.assertEqual(Experiment.objects.get(pk=exp.pk).assignment_version, num_sessions)
+            self.assertGreater(sessions_per_sec, 0)
+
+            # every subject has one session, with each of its rounds once
+            self.assertEqual(exp.session_set.values('subject_id').distinct().count(), num_sessions)
+            for sess in exp.session_set.all():
+                rounds = list(sess.round_set.values_list('round_id', 'stimulusgroup__stimulusgroup_id'))
+                self.assertEqual(sorted(rid for rid, _ in rounds), list(range(self.ROUNDS_PER_SESSION)))
+                sgids = [sgid for _, sgid in rounds]
+                self.assertTrue(None not in sgids)
+                self.assertEqual(len(set(sgids)), len(sgids))
+
+            # balanced as if assigned one after another
+            counts = [StimulusGroupExposure.objects.get(stimulusgroup=sg).count
+                      for sg in StimulusGroup.objects.filter(experiment=exp)]
+            self.assertEqual(sum(counts), num_sessions * self.ROUNDS_PER_SESSION)
+            self.assertLessEqual(max(counts) - min(counts), 1)
+            self.assertEqual(sorted(counts), sorted(Round.objects.filter(session__experiment=exp)
+                                                    .values('stimulusgroup').annotate(n=Count('id'))
+                                                    .values_list('n', flat=True)))
+            logging.getLogger(__name__).info(f'{num_provisioners} provisioner(s): {sessions_per_sec:.1f} sessions/sec')
+
+    def test_is_lock_conflict(self):
+        def wrap(e):
+            # as raised by django from the sqlite3 error
+            try:
+                try:
+                    raise e
+                except sqlite3.OperationalError as cause:
+                    raise OperationalError(*cause.args) from cause
+            except OperationalError as wrapped:
+                return wrapped
+
+        locked = sqlite3.OperationalError('database is locked')
+        locked.sqlite_errorcode = sqlite3.SQLITE_BUSY
+        self.assertTrue(ExperimentController._is_lock_conflict(wrap(locked)))
+        # e.g. a missing table, whose name has 'locked' in it
+        other = sqlite3.OperationalError('no such table: locked_rounds')
+        other.sqlite_errorcode = sqlite3.SQLITE_ERROR
+        self.assertFalse(ExperimentController._is_lock_conflict(wrap(other)))
+        with patch.object(connection, 'vendor', 'postgresql'):
+            self.assertFalse(ExperimentController._is_lock_conflict(wrap(locked)))
+
+
+class TestStimulusConfigDiff(TestCase):
+
+    @staticmethod
+    def _make_stimulus_config(num_stimulusgroups):
+        return {
+            'contents': [{'content_id': cid, 'name': f'content_{cid}'} for cid in range(2)],
+            'stimuli': [{'stimulus_id': i, 'path': f'https://example.com/{i}.mp4', 'type': 'video/mp4',
+                         'content_id': i % 2} for i in range(num_stimulusgroups)],
+            'stimulusvotegroups': [{'stimulusvotegroup_id': i, 'stimulus_ids': [i]} for i in range(num_stimulusgroups)],
+            'stimulusgroups': [{'stimulusgroup_id': i, 'stimulusvotegroup_ids': [i]} for i in range(num_stimulusgroups)],
+        }
+
+    def _make_experiment_config(self, stimulus_config, methodology='acr'):
+        scfg = StimulusConfig(stimulus_config, skip_path_check=True)
+        return ExperimentConfig(stimulus_config=scfg, config={
+            'title': 'diff', 'description': 'diff', 'vote_scale': 'FIVE_POINT',
+            'methodology': methodology, 'rounds_per_session': 2, 'random_seed': 1})
+
+    def setUp(self) -> None:
+        self.config = self._make_stimulus_config(4)
+        e = Experiment.objects.create(title='diff', description='diff')
+        self.ec = ExperimentController(experiment=e, experiment_config=self._make_experiment_config(self.config))
+        self.ec.populate_stimuli()
+
+    def _apply(self, config):
+        return self.ec.apply_stimulus_config(self._make_experiment_config(config).stimulus_config)
+
+    def test_no_change(self):
+        config = json.loads(json.dumps(self.config))
+        config['contents'][0]['name'] = 'renamed'
+        config['stimuli'][0]['path'] = 'https://example.com/moved.mp4'
+        diff = self._apply(config)
+        self.assertTrue(diff.is_empty)
+        self.assertEqual(diff.conflicts, [])
+
+    def test_populate_stimuli(self):
+        def populate(num_stimulusgroups):
+            config = self._make_stimulus_config(num_stimulusgroups)
+            config['stimuli'].append({'stimulus_id': 1000, 'path': 'https://example.com/ref.mp4',
+                                      'type': 'video/mp4', 'content_id': 0})
+            for svgd in config['stimulusvotegroups']:
+                svgd['stimulus_ids'].append(1000)
+            ec = ExperimentController(experiment=Experiment.objects.create(title=f'populate_{num_stimulusgroups}'),
+                                      experiment_config=self._make_experiment_config(config, methodology='dcr'))
+            with CaptureQueriesContext(connection) as ctx:
+                ec.populate_stimuli()
+            self.assertTrue(ec.diff_stimulus_config(ec.experiment_config.stimulus_config).is_empty)
+            return ec, len(ctx.captured_queries)
+
+        # the number of queries does not depend on the size of the config
+        _, num_queries = populate(4)
+        ec, num_queries2 = populate(40)
+        self.assertEqual(num_queries2, num_queries)
+        self.assertEqual(StimulusVoteGroup.objects.get(experiment=ec.experiment, stimulusvotegroup_id=7).stimulusgroup,
+                         StimulusGroup.objects.get(experiment=ec.experiment, stimulusgroup_id=7))
+        self.assertEqual(list(VoteRegister.objects
+                              .filter(stimulusvotegroup__experiment=ec.experiment, stimulusvotegroup__stimulusvotegroup_id=7)
+                              .order_by('stimulus_order').values_list('stimulus__stimulus_id', flat=True)), [7, 1000])
+
+        # existing objects are kept, the missing ones are created
+        sg0 = StimulusGroup.objects.get(experiment=self.ec.experiment, stimulusgroup_id=0)
+        self.ec.experiment_config = self._make_experiment_config(self._make_stimulus_config(6))
+        self.ec.populate_stimuli()
+        self.assertEqual(StimulusGroup.objects.get(experiment=self.ec.experiment, stimulusgroup_id=0), sg0)
+        self.assertEqual(StimulusGroup.objects.filter(experiment=self.ec.experiment).count(), 6)
+        self.assertEqual(StimulusVoteGroup.objects.get(experiment=self.ec.experiment, stimulusvotegroup_id=5).stimulusgroup,
+                         StimulusGroup.objects.get(experiment=self.ec.experiment, stimulusgroup_id=5))
+        self.assertTrue(self.ec.diff_stimulus_config(self.ec.experiment_config.stimulus_config).is_empty)
+
+    def test_insert(self):
+        diff = self._apply(self._make_stimulus_config(6))
+        self.assertEqual(diff.inserts['stimuli'], [4, 5])
+        self.assertEqual(diff.inserts['stimulusvotegroups'], [4, 5])
+        self.assertEqual(diff.inserts['stimulusgroups'], [4, 5])
+        self.assertEqual(diff.inserts['contents'], [])
+        svg = StimulusVoteGroup.objects.get(experiment=self.ec.experiment, stimulusvotegroup_id=5)
+        self.assertEqual(svg.stimulusgroup.stimulusgroup_id, 5)
+        s = Stimulus.objects.get(experiment=self.ec.experiment, stimulus_id=5)
+        self.assertEqual(s.content.content_id, 1)
+        self.assertEqual(StimulusVoteGroup.find_stimulusvotegroups_from_stimulus(s), [svg])
+        self.assertTrue(self._apply(self._make_stimulus_config(6)).is_empty)
+
+    def test_update(self):
+        config = json.loads(json.dumps(self.config))
+        config['stimuli'][3]['content_id'] = 0
+        config['stimulusvotegroups'][2]['stimulus_ids'] = [3]
+        diff = self._apply(config)
+        self.assertEqual(diff.updates['stimuli'], [3])
+        self.assertEqual(diff.updates['stimulusvotegroups'], [2])
+        self.assertEqual(Stimulus.objects.get(experiment=self.ec.experiment, stimulus_id=3).content.content_id, 0)
+        svg = StimulusVoteGroup.objects.get(experiment=self.ec.experiment, stimulusvotegroup_id=2)
+        self.assertEqual([vr.stimulus.stimulus_id for vr in VoteRegister.objects.filter(stimulusvotegroup=svg)], [3])
+
+    def test_deactivate_and_reactivate(self):
+        diff = self._apply(self._make_stimulus_config(3))
+        self.assertEqual(diff.deactivations['stimuli'], [3])
+        self.assertEqual(diff.deactivations['stimulusvotegroups'], [3])
+        self.assertEqual(diff.deactivations['stimulusgroups'], [3])
+        svg = StimulusVoteGroup.objects.get(experiment=self.ec.experiment, stimulusvotegroup_id=3)
+        self.assertFalse(svg.is_active)
+        self.assertIsNone(svg.stimulusgroup)
+        self.assertFalse(StimulusGroup.objects.get(experiment=self.ec.experiment, stimulusgroup_id=3).is_active)
+
+        diff = self._apply(self._make_stimulus_config(4))
+        self.assertEqual(diff.updates['stimulusgroups'], [3])
+        self.assertEqual(diff.inserts['stimulusgroups'], [])
+        svg = StimulusVoteGroup.objects.get(experiment=self.ec.experiment, stimulusvotegroup_id=3)
+        self.assertTrue(svg.is_active)
+        self.assertEqual(svg.stimulusgroup.stimulusgroup_id, 3)
+
+    def test_refuse_orphaning_votes(self):
+        sess = self.ec.add_session(Subject.objects.create())
+        r = sess.round_set.first()
+        svg = StimulusVoteGroup.objects.get(stimulusgroup=r.stimulusgroup)
+        FivePointVote.objects.create(round=r, stimulusvotegroup=svg, score=3)
+        config = json.loads(json.dumps(self.config))
+        config['stimulusvotegroups'][svg.stimulusvotegroup_id]['stimulus_ids'] = [(svg.stimulusvotegroup_id + 1) % 4]
+        with self.assertRaises(AssertionError):
+            self._apply(config)
+        self.assertEqual(
+            [vr.stimulus.stimulus_id for vr in VoteRegister.objects.filter(stimulusvotegroup=svg)],
+            [svg.stimulusvotegroup_id])
+
+        config = self._make_stimulus_config(4)
+        del config['stimulusgroups'][r.stimulusgroup.stimulusgroup_id]
+        del config['stimulusvotegroups'][svg.stimulusvotegroup_id]
+        diff = self.ec.diff_stimulus_config(self._make_experiment_config(config).stimulus_config)
+        self.assertEqual(diff.conflicts, [
+            f"stimulusvotegroup {svg.stimulusvotegroup_id} has votes, and cannot be removed",
+            f"stimulusgroup {r.stimulusgroup.stimulusgroup_id} is used by rounds of existing sessions, and cannot be removed",
+        ])
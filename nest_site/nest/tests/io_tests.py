@@ -1,12 +1,18 @@
 import glob
+import io
 import json
 import os
 import random
 import shutil
 
+import numpy as np
+import pandas as pd
 from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import F
 from django.test import TestCase
-from nest.config import ExperimentConfig, NestConfig, StimulusConfig
+from django.test.utils import CaptureQueriesContext
+from nest.config import ExperimentConfig, NestConfig, StimulusConfig, ValidationCertificate
 from nest.control import ExperimentController, SessionStatus
 from nest.helpers import import_python_file
 from nest.io import ESUtilities, ExperimentUtils, \
@@ -15,8 +21,8 @@ from nest.io import ESUtilities, ExperimentUtils, \
 from nest.io_utils import ExperimentConfigFileUtils
 from nest.models import Condition, Content, Experiment, Experimenter, \
     ExperimentRegister, FivePointVote, Round, Session, Stimulus, \
-    StimulusGroup, StimulusVoteGroup, Subject, TafcVote, Vote, VoteRegister, \
-    Zero2HundredVote
+    StimulusGroup, StimulusGroupExposure, StimulusVoteGroup, Subject, SubjectStimulusGroupExposure, TafcVote, Vote, \
+    VoteRegister, Zero2HundredVote
 from nest.sites import NestSite
 from nest_site.settings import map_media_local_to_url
 
@@ -219,6 +225,31 @@ class TestDatasetReader(TestCase):
 
 class TestExperimentController(TestCase):
 
+    @staticmethod
+    def _get_session_info_per_vote(s: Session) -> dict:
+        # reference for ExperimentController.get_session_infos, reading the
+        # vote of each round and stimulusvotegroup one by one
+        rounds = list()
+        for r in s.round_set.all():
+            svgs = list()
+            for svg in r.stimulusgroup.stimulusvotegroup_set.all():
+                svgd = {'stimulusvotegroup_id': svg.stimulusvotegroup_id}
+                try:
+                    svgd['vote'] = Vote.objects.get(round=r, stimulusvotegroup=svg).score
+                except Vote.DoesNotExist:
+                    pass
+                svgs.append(svgd)
+            rounds.append({'round_id': r.round_id, 'stimulusgroup_id': r.stimulusgroup.stimulusgroup_id,
+                           'stimulusvotegroups': svgs})
+        return {'session_id': s.id, 'subject': s.subject.get_subject_name(), 'rounds': rounds}
+
+    def _assert_denormalized_csv(self, ec: ExperimentController, df: pd.DataFrame):
+        self.assertEqual(list(ec.iter_denormalized_rows(chunk_size=100)), df.replace({np.nan: None}).to_dict('records'))
+        fp = io.StringIO(newline='')
+        ec.write_denormalized_csv(fp, chunk_size=100)
+        fp.seek(0)
+        pd.testing.assert_frame_equal(pd.read_csv(fp), df, check_dtype=False)
+
     @staticmethod
     def create_config_from_sureal_dataset(dataset, seed):
         try:
@@ -258,7 +289,9 @@ class TestExperimentController(TestCase):
         self.assertEqual(sinfo['rounds'][-1]['stimulusvotegroups'][0]['stimulusvotegroup_id'], 2)
         self.assertEqual(sinfo['rounds'][-1]['stimulusvotegroups'][0]['vote'], 5.0)
 
-        einfo: dict = ec.get_experiment_info()
+        with self.assertNumQueries(5):
+            einfo: dict = ec.get_experiment_info()
+        self.assertEqual(einfo['sessions'], [self._get_session_info_per_vote(s) for s in exp.session_set.all()])
         self.assertEqual(einfo['title'], 'NFLX_public')
         self.assertEqual(einfo['description'], None)
         self.assertEqual(len(einfo['sessions']), 30)
@@ -270,6 +303,7 @@ class TestExperimentController(TestCase):
 
         df = ExperimentController.denormalize_experiment_info(einfo)
         self.assertEqual(df.shape, (840, 8))
+        self._assert_denormalized_csv(ec, df)
         self.assertEqual(df.iloc[0].subject, 'NFLX_public-#0')
         self.assertEqual(df.iloc[0].session_id, 1)
         self.assertEqual(df.iloc[0].round_id, 0)
@@ -282,6 +316,12 @@ class TestExperimentController(TestCase):
         sess.round_set.first().vote_set.first().delete()
         self.assertEqual(ec.get_session_status(sess), SessionStatus.PARTIALLY_FINISHED)
 
+        sessions = list(exp.session_set.all())
+        with self.assertNumQueries(1):
+            statuses = ec.get_session_statuses(sessions)
+        self.assertEqual(statuses, [SessionStatus.PARTIALLY_FINISHED] + [SessionStatus.FINISHED] * 29)
+        self.assertEqual(statuses, [ec.get_session_status(s) for s in sessions])
+
         sess2 = ExperimentUtils.add_session_to_experiment(
             exp.title, 'zli', config=config, skip_path_check=True)
         self.assertEqual(sess2.round_set.count(), 28)
@@ -370,6 +410,7 @@ class TestExperimentController(TestCase):
 
         df = ExperimentController.denormalize_experiment_info(einfo)
         self.assertEqual(df.shape, (1312, 8))
+        self._assert_denormalized_csv(ec, df)
 
         sess2 = ExperimentUtils.add_session_to_experiment(
             exp.title, 'zli', config=config, skip_path_check=True)
@@ -431,6 +472,183 @@ class TestCreateExperiment(TestCase):
     def tearDown(self):
         shutil.rmtree(self.config_filedir)
 
+    def test_update_experiment_config(self):
+        title = 'io_tests.TestCreateExperiment.test_update_experiment_config'
+        ec: ExperimentController = ExperimentUtils.create_experiment(
+            experiment_config_filepath=NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'),
+            experimenter_username='lukas@catflix.com',
+            is_test=True,
+            random_seed=1,
+            experiment_title=title)
+        ec.add_session(Subject.objects.create(name='Netflix_Noise_1'))
+        config_filepath = NestSite.get_experiment_config_filepath(title, is_test=True)
+        with open(config_filepath, 'rt') as fp:
+            config = json.load(fp)
+        config['experiment_config']['description'] = 'fixed typo'
+        config['stimulus_config']['contents'][0]['name'] = 'fixed typo'
+        new_config_filepath = os.path.join(self.config_filedir, 'new_config.json')
+        with open(new_config_filepath, 'wt') as fp:
+            json.dump(config, fp)
+
+        diff = ExperimentUtils.update_experiment_config(new_config_filepath, experiment_title=title, is_test=True)
+        self.assertTrue(diff.is_empty)
+        self.assertEqual(Experiment.objects.get(title=title).description, 'fixed typo')
+        with open(config_filepath, 'rt') as fp:
+            self.assertEqual(json.load(fp)['stimulus_config']['contents'][0]['name'], 'fixed typo')
+
+        del config['stimulus_config']['stimulusgroups'][0]
+        with open(new_config_filepath, 'wt') as fp:
+            json.dump(config, fp)
+        diff = ExperimentUtils.update_experiment_config(new_config_filepath, experiment_title=title, is_test=True, dry_run=True)
+        self.assertEqual(diff.deactivations['stimulusgroups'], [0])
+        with self.assertRaises(AssertionError):
+            ExperimentUtils.update_experiment_config(new_config_filepath, experiment_title=title, is_test=True)
+        with open(config_filepath, 'rt') as fp:
+            self.assertEqual(len(json.load(fp)['stimulus_config']['stimulusgroups']), 2)
+
+    def test_exposure_counts(self):
+        ec: ExperimentController = ExperimentUtils.create_experiment(
+            experiment_config_filepath=NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'),
+            experimenter_username='lukas@catflix.com',
+            is_test=True,
+            random_seed=1,
+            experiment_title='io_tests.TestCreateExperiment.test_exposure_counts')
+
+        def count_rounds(subject):
+            counts = dict()
+            for r in Round.objects.filter(session__experiment=ec.experiment).select_related('session', 'stimulusgroup'):
+                count, subject_count = counts.get(r.stimulusgroup.stimulusgroup_id, (0, 0))
+                counts[r.stimulusgroup.stimulusgroup_id] = (count + 1, subject_count + (r.session.subject_id == subject.id))
+            return counts
+
+        def exposures(subject):
+            counts, subject_counts = ec._get_exposures([subject.id])
+            return {sgid: (count, subject_counts.get((subject.id, sgid), 0)) for sgid, count in counts.items()}
+
+        def stored_exposures(subject):
+            # as kept by the signal receivers, not rebuilt
+            subject_counts = dict(SubjectStimulusGroupExposure.objects
+                                  .filter(subject=subject, stimulusgroup__experiment=ec.experiment)
+                                  .values_list('stimulusgroup__stimulusgroup_id', 'count'))
+            return {sgid: (count, subject_counts.get(sgid, 0)) for sgid, count in StimulusGroupExposure.objects
+                    .filter(experiment=ec.experiment).values_list('stimulusgroup__stimulusgroup_id', 'count')
+                    if count != 0}
+
+        subj1 = Subject.objects.create(name='Netflix_Noise_1')
+        subj2 = Subject.objects.create(name='Netflix_Noise_2')
+        subj3 = Subject.objects.create(name='Netflix_Noise_3')
+        for subj in [subj1, subj2, subj1]:
+            ec.add_session(subj)
+        self.assertEqual(exposures(subj1), count_rounds(subj1))
+        self.assertEqual(exposures(subj3), count_rounds(subj3))
+
+        # same assignment as from the full ordering so far
+        kwargs = dict(rounds_per_session=ec.experiment_config.rounds_per_session,
+                      stimulusgroup_ids=ec.experiment_config.stimulus_config.stimulusgroup_ids,
+                      subject_id=subj1.id,
+                      prioritized=ec.experiment_config.prioritized,
+                      random_seed=7,
+                      blocklist_stimulusgroup_ids=ec.experiment_config.blocklist_stimulusgroup_ids)
+        ordering_so_far = [ec._get_ordering_for_session(s.id) for s in ec.experiment.session_set.all()]
+        self.assertEqual(ExperimentController._order(ordering_so_far=ordering_so_far, **kwargs),
+                         ExperimentController._order(ordering_so_far=None, exposures=exposures(subj1),
+                                                     num_sessions_so_far=len(ordering_so_far), **kwargs))
+
+        # the cost of assignment does not grow with the number of sessions
+        with CaptureQueriesContext(connection) as ctx:
+            ec.add_session(subj2)
+        num_queries = len(ctx.captured_queries)
+        for _ in range(10):
+            ec.add_session(subj3)
+        with CaptureQueriesContext(connection) as ctx:
+            ec.add_session(subj2)
+        self.assertEqual(len(ctx.captured_queries), num_queries)
+
+        sess = ec.experiment.session_set.filter(subject=subj2).first()
+        subj4 = Subject.objects.create(name='Netflix_Noise_4')
+        sess.subject = subj4
+        sess.save()
+        self.assertEqual(exposures(subj2), count_rounds(subj2))
+        self.assertEqual(exposures(subj4), count_rounds(subj4))
+
+        ec.delete_session(ec.experiment.session_set.filter(subject=subj3).first().id)
+        self.assertEqual(exposures(subj3), count_rounds(subj3))
+        self.assertEqual(stored_exposures(subj3), count_rounds(subj3))
+
+        Round.objects.filter(session__subject=subj1).first().delete()
+        self.assertEqual(stored_exposures(subj1), count_rounds(subj1))
+
+        # the rounds of a delete are counted at once, with as many queries
+        # for one session as for several
+        with CaptureQueriesContext(connection) as ctx:
+            ec.experiment.session_set.filter(subject=subj3).delete()
+        num_queries = len(ctx.captured_queries)
+        for _ in range(3):
+            ec.add_session(subj3)
+        with CaptureQueriesContext(connection) as ctx:
+            ec.experiment.session_set.filter(subject=subj3).delete()
+        self.assertEqual(len(ctx.captured_queries), num_queries)
+        self.assertEqual(stored_exposures(subj3), count_rounds(subj3))
+        self.assertEqual(stored_exposures(subj1), count_rounds(subj1))
+
+        StimulusGroupExposure.objects.all().delete()
+        self.assertEqual(exposures(subj1), count_rounds(subj1))
+
+        # counts that are partly off are left to the maintenance check
+        StimulusGroupExposure.objects.filter(experiment=ec.experiment).update(count=F('count') + 1)
+        self.assertNotEqual(stored_exposures(subj1), count_rounds(subj1))
+        with open(NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'), 'rt') as fp:
+            config = json.load(fp)
+        self.assertFalse(ExperimentUtils.check_exposures(ec.experiment.title, dry_run=True,
+                                                         config=config, skip_path_check=True))
+        self.assertNotEqual(stored_exposures(subj1), count_rounds(subj1))
+        self.assertFalse(ExperimentUtils.check_exposures(ec.experiment.title, config=config, skip_path_check=True))
+        self.assertEqual(stored_exposures(subj1), count_rounds(subj1))
+        self.assertTrue(ec.check_exposures())
+
+    def test_add_sessions(self):
+        def create(title):
+            return ExperimentUtils.create_experiment(
+                experiment_config_filepath=NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'),
+                experimenter_username='lukas@catflix.com',
+                is_test=True,
+                random_seed=1,
+                experiment_title=title)
+
+        def get_orderings(ec):
+            return [(sess.subject_id, ec._get_ordering_for_session(sess.id))
+                    for sess in ec.experiment.session_set.order_by('id')]
+
+        subjs = [Subject.objects.create(name=f'Netflix_Noise_{i}') for i in range(4)]
+        ec1 = create('io_tests.TestCreateExperiment.test_add_sessions_1')
+        ec2 = create('io_tests.TestCreateExperiment.test_add_sessions_2')
+        for subj in subjs + subjs[:2]:
+            ec1.add_session(subj)
+        sessions = ec2.add_sessions(subjs + subjs[:2])
+        self.assertEqual([sess.subject_id for sess in sessions], [subj.id for subj in subjs + subjs[:2]])
+        self.assertEqual(get_orderings(ec1), get_orderings(ec2))
+        self.assertEqual(
+            sorted(StimulusGroupExposure.objects.filter(experiment=ec1.experiment)
+                   .values_list('stimulusgroup__stimulusgroup_id', 'count')),
+            sorted(StimulusGroupExposure.objects.filter(experiment=ec2.experiment)
+                   .values_list('stimulusgroup__stimulusgroup_id', 'count')))
+        self.assertEqual(ec2.add_sessions([]), [])
+
+        # the number of queries does not depend on the number of subjects
+        with CaptureQueriesContext(connection) as ctx:
+            ec2.add_sessions(subjs[:1])
+        num_queries = len(ctx.captured_queries)
+        with CaptureQueriesContext(connection) as ctx:
+            ec2.add_sessions(subjs * 3)
+        self.assertEqual(len(ctx.captured_queries), num_queries)
+
+        with open(NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'), 'rt') as fp:
+            config = json.load(fp)
+        sessions = ExperimentUtils.add_sessions_to_experiment(
+            'io_tests.TestCreateExperiment.test_add_sessions_2', ['Netflix_Noise_0', 'new_subject@catflix.com'],
+            config=config, skip_path_check=True)
+        self.assertEqual(sessions[1].subject, Subject.find_by_username('new_subject@catflix.com'))
+
     def test_create_experiment(self):
         ec: ExperimentController = ExperimentUtils.create_experiment(
             experiment_config_filepath=NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'),
@@ -626,6 +844,56 @@ class TestCreateExperiment(TestCase):
 
 class TestValidateConfig(TestCase):
 
+    def test_validate_config_write_certificate(self):
+        config_filedir = NestConfig.tests_workdir_path('validate_config')
+        os.makedirs(config_filedir, exist_ok=True)
+        config_filepath = os.path.join(config_filedir, 'cvxhull_subjexp_toy_x.json')
+        shutil.copyfile(NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'), config_filepath)
+        try:
+            ExperimentUtils.validate_config(config_filepath)
+            self.assertIsNone(ValidationCertificate.load(config_filepath))
+            ExperimentUtils.validate_config(config_filepath, write_certificate=True)
+            cert = ValidationCertificate.load(config_filepath)
+            with open(config_filepath, 'rb') as fp:
+                self.assertTrue(cert.vouches_for(ValidationCertificate.hash_content(fp.read())))
+        finally:
+            shutil.rmtree(config_filedir)
+
+    def test_validate_configs(self):
+        config_filedir = NestConfig.tests_workdir_path('validate_configs')
+        os.makedirs(config_filedir, exist_ok=True)
+        try:
+            filenames = ['cvxhull_subjexp_toy_x.json', 'cvxhull_subjexp_toy_dcr.json', 'cvxhull_subjexp_toy_mlds.json']
+            for filename in filenames:
+                shutil.copyfile(NestConfig.tests_resource_path(filename), os.path.join(config_filedir, filename))
+            with open(NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'), 'rt') as fp:
+                config = json.load(fp)
+            config['experiment_config']['title'] = 'validate_configs_missing_media'
+            config['stimulus_config']['stimuli'][1]['path'] = '/media/mp4/samples/does_not_exist.mp4'
+            del config['stimulus_config']['contents'][0]['name']
+            with open(os.path.join(config_filedir, 'missing_media.json'), 'wt') as fp:
+                json.dump(config, fp)
+            with open(os.path.join(config_filedir, 'broken.json'), 'wt') as fp:
+                fp.write('{')
+            config_filepaths = [os.path.join(config_filedir, filename)
+                                for filename in filenames + ['missing_media.json', 'broken.json']]
+
+            reports = ExperimentUtils.validate_configs(config_filepaths, max_workers=2, write_certificate=True)
+            self.assertEqual([r['config_filepath'] for r in reports], config_filepaths)
+            self.assertEqual([r['ok'] for r in reports], [True, True, False, False, False])
+            self.assertTrue(all(r['seconds'] >= 0 for r in reports))
+            self.assertTrue(ValidationCertificate.load(config_filepaths[0]) is not None)
+            self.assertIsNone(ValidationCertificate.load(config_filepaths[2]))
+            self.assertEqual(sorted((v['section'], v['index']) for v in reports[3]['violations']),
+                             [('contents', 0), ('stimuli', 1)])
+            self.assertIsNone(reports[4]['title'])
+            self.assertEqual(len(reports[4]['violations']), 1)
+            # same report when run serially
+            reports2 = ExperimentUtils.validate_configs(config_filepaths, max_workers=1)
+            self.assertEqual([r['violations'] for r in reports2], [r['violations'] for r in reports])
+        finally:
+            shutil.rmtree(config_filedir)
+
     def test_validate_config(self):
         ExperimentUtils.validate_config(
             NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'))
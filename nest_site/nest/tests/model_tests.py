@@ -1,12 +1,13 @@
 import datetime
 
 from django.contrib.auth.models import User
+from django.db import transaction
 from django.db.utils import IntegrityError
 from django.test import TestCase
 from django.utils import timezone
 from nest.models import CcrFivePointVote, CcrThreePointVote, Condition, Content, ElevenPointVote, Experiment, \
     Experimenter, ExperimentRegister, FivePointVote, Round, Session, SevenPointVote, Stimulus, StimulusGroup, \
-    StimulusVoteGroup, Subject, TafcVote, VoteRegister, Zero2HundredVote
+    StimulusVoteGroup, Subject, TafcVote, Vote, VoteRegister, Zero2HundredVote
 
 
 class TestModels(TestCase):
@@ -297,6 +298,35 @@ class TestModels(TestCase):
             # delete cascade: experiment -> session -> round -> vote:
             FivePointVote.objects.get(id=v2.id)
 
+    def test_vote_unique_per_round_and_svg(self):
+        e = Experiment.objects.create(title='Zhi ACR')
+        sess = Session.objects.create(experiment=e, subject=Subject.objects.create())
+        r = Round.objects.create(session=sess, round_id=0)
+        svg = StimulusVoteGroup.objects.create(stimulusvotegroup_id=0)
+        FivePointVote.objects.create(score=3, round=r, stimulusvotegroup=svg)
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Zero2HundredVote.objects.create(score=30, round=r, stimulusvotegroup=svg)
+        # votes without a round or svg are not constrained
+        FivePointVote.objects.create(score=3)
+        FivePointVote.objects.create(score=3)
+
+    def test_bulk_create_votes(self):
+        e = Experiment.objects.create(title='Zhi ACR')
+        sess = Session.objects.create(experiment=e, subject=Subject.objects.create())
+        r = Round.objects.create(session=sess, round_id=0)
+        svg = StimulusVoteGroup.objects.create(stimulusvotegroup_id=0)
+        svg2 = StimulusVoteGroup.objects.create(stimulusvotegroup_id=1)
+        votes = Vote.bulk_create_votes([FivePointVote(score=4, round=r, stimulusvotegroup=svg),
+                                        Zero2HundredVote(score=40.5, round=r, stimulusvotegroup=svg2),
+                                        FivePointVote(score=2)])
+        self.assertTrue(all(v.saved for v in votes))
+        self.assertEqual([type(v) for v in Vote.objects.filter(id__in=[v.id for v in votes]).order_by('id')],
+                         [FivePointVote, Zero2HundredVote, FivePointVote])
+        self.assertEqual(FivePointVote.objects.get(id=votes[0].id).score, 4)
+        self.assertEqual(Zero2HundredVote.objects.get(round=r, stimulusvotegroup=svg2).score, 40.5)
+        self.assertEqual(Vote.bulk_create_votes([]), [])
+
     def test_11point_vote(self):
         v = ElevenPointVote(score=11)
         v.save()
@@ -1,7 +1,9 @@
+import io
 import logging
 import os
 import shutil
 
+import pandas as pd
 from django.contrib.auth.models import User
 from django.test import TestCase
 from django.urls import reverse
@@ -1094,6 +1096,10 @@ class TestViewsWithWriteDataset(TestCase):
         self.assertEqual(response.status_code, 200)
         response = self.client.get(reverse('admin:download_sureal_alt', args=(1,)))
         self.assertEqual(response.status_code, 200)
+        response = self.client.get(reverse('admin:download_nest_csv', args=(1,)))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        pd.testing.assert_frame_equal(pd.read_csv(io.BytesIO(b''.join(response.streaming_content))), df)
         dataset = export_sureal_dataset('nest_view_tests.TestViewsWithWriteDataset.test_step_session_samviq5d',
                                         ignore_against=True)
         self.assertEqual(dataset.dis_videos[0]['os'], {})
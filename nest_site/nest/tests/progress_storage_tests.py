@@ -0,0 +1,217 @@
+import json
+import os
+import shutil
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import override_settings, TestCase
+from django.urls import reverse
+from nest.config import NestConfig
+from nest.io import ExperimentUtils
+from nest.models import FivePointVote, Round, SessionProgressRecord, Subject, Vote
+from nest.progress_storage import CacheSessionProgressStorage, CookieSessionProgressStorage, \
+    DatabaseSessionProgressStorage, get_session_progress_storage, RequestSessionProgressStorage, SessionProgress
+
+
+class TestSessionProgress(TestCase):
+
+    def test_encode_decode_steps(self):
+        steps_planned = [
+            {'position': {'round_id': 0, 'before_or_after': 'before'}, 'context': {'title': 'Instruction'}},
+            {'position': {'round_id': 0}, 'context': {'stimulusgroup_id': 3}},
+            {'position': {'round_id': 1}, 'context': {'stimulusgroup_id': 1}},
+        ]
+        steps = [
+            {'position': {'round_id': 0, 'before_or_after': 'before'}},
+            {'position': {'round_id': 0},
+             'context': {'stimulusgroup_id': 3, 'score': {'3': 5, '7': 1}, 'response_sec': 2.5}},
+        ]
+        records = [SessionProgress.encode_step(i, step) for i, step in enumerate(steps)]
+        self.assertEqual(records, [[0], [1, 2.5, 3, 5, 7, 1]])
+        self.assertEqual(SessionProgress.decode_steps(records, steps_planned), steps)
+        self.assertEqual(SessionProgress.decode_steps(records[:1] + records, steps_planned), steps)
+        with self.assertRaises(AssertionError):
+            SessionProgress.decode_steps(records[1:], steps_planned)
+
+
+class SessionProgressStorageTestMixin(object):
+
+    STORAGE_CLASS = None
+
+    def setUp(self) -> None:
+        self.user = User.objects.create_user('user', password='pass', is_staff=False)
+        self.ec = ExperimentUtils._create_experiment_from_config(
+            source_config_filepath=NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'),
+            is_test=True,
+            random_seed=1,
+            experiment_title=f'progress_storage_tests.{self.__class__.__name__}')
+        self.sess = self.ec.add_session(Subject.create_by_username('user'))
+        self.client.login(username='user', password='pass')
+
+    def _step_url(self):
+        return reverse('nest:step_session', kwargs={'session_id': self.sess.id})
+
+    def _get_steps(self, response):
+        steps = get_session_progress_storage().get_steps(response.wsgi_request, self.ec.get_session_steps(self.sess))
+        # as read by the next request, from json
+        return json.loads(json.dumps(steps))
+
+    def test_storage_selected_by_setting(self):
+        self.assertTrue(isinstance(get_session_progress_storage(), self.STORAGE_CLASS))
+
+    def test_step_session(self):
+        self.client.get(reverse('nest:start_session', kwargs={'session_id': self.sess.id}))
+        response = self.client.get(self._step_url())
+        self.assertEqual(response.status_code, 200)
+        steps = self._get_steps(response)
+        self.assertEqual(len(steps), 1)
+        self.assertEqual(steps[0], {'position': {'round_id': 0, 'before_or_after': 'before'}})
+
+        self.client.get(self._step_url())
+        response = self.client.post(self._step_url(), {'acr_1': '1'})
+        self.assertEqual(response.status_code, 302)
+        steps = self._get_steps(response)
+        self.assertEqual(len(steps), 2)
+        self.assertEqual(steps[-1]['context']['score'], {'1': 1})
+        self.assertTrue(steps[-1]['context']['response_sec'] > 0)
+
+        response = self.client.get(reverse('nest:status'))
+        self.assertEqual([test['action'] for test in response.context_data['tests']], ['Continue'])
+
+        self.client.get(self._step_url())
+        self.client.post(self._step_url(), {'acr_0': '4'})
+        response = self.client.get(reverse('nest:cookie'))
+        self.assertTrue(""""score": {\n                    "0": 4""" in response.context_data['text_html'])
+
+        self.assertEqual(FivePointVote.objects.count(), 0)
+        response = self.client.get(self._step_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([v.score for v in FivePointVote.objects.order_by('round__round_id')], [1, 4])
+        self.assertTrue(all(rnd.response_sec > 0 for rnd in Round.objects.filter(session=self.sess)))
+        self.assertEqual(self._get_steps(self.client.get(reverse('nest:status'))), [])
+
+    def test_start_session_clears_progress(self):
+        self.client.get(reverse('nest:start_session', kwargs={'session_id': self.sess.id}))
+        self.client.get(self._step_url())
+        self.client.get(self._step_url())
+        response = self.client.post(self._step_url(), {'acr_1': '1'})
+        self.assertEqual(len(self._get_steps(response)), 2)
+
+        self.client.get(reverse('nest:start_session', kwargs={'session_id': self.sess.id}))
+        response = self.client.get(reverse('nest:status'))
+        self.assertEqual([test['action'] for test in response.context_data['tests']], ['Start'])
+        self.assertEqual(get_session_progress_storage().get_session_id(response.wsgi_request), None)
+
+        # the progress of the user is not seen by another
+        self.client.get(self._step_url())
+        User.objects.create_user('user2', password='pass')
+        self.client.login(username='user2', password='pass')
+        response = self.client.get(reverse('nest:status'))
+        self.assertEqual(get_session_progress_storage().get_session_id(response.wsgi_request), None)
+
+
+@override_settings(SESSION_PROGRESS_STORAGE='session')
+class TestRequestSessionProgressStorage(SessionProgressStorageTestMixin, TestCase):
+
+    STORAGE_CLASS = RequestSessionProgressStorage
+
+
+@override_settings(SESSION_PROGRESS_STORAGE='database')
+class TestDatabaseSessionProgressStorage(SessionProgressStorageTestMixin, TestCase):
+
+    STORAGE_CLASS = DatabaseSessionProgressStorage
+
+    def test_each_step_appends_a_row(self):
+        self.client.get(reverse('nest:start_session', kwargs={'session_id': self.sess.id}))
+        self.client.get(self._step_url())
+        self.assertEqual(list(SessionProgressRecord.objects.values_list('kind', 'record')), [('s', '[0]')])
+
+        self.client.get(self._step_url())
+        self.assertEqual(SessionProgressRecord.objects.filter(kind=SessionProgressRecord.ROUND_START).count(), 1)
+        records = list(SessionProgressRecord.objects.order_by('id'))
+        self.client.post(self._step_url(), {'acr_1': '1'})
+        # the records before are left as they are
+        self.assertEqual(list(SessionProgressRecord.objects.order_by('id'))[:len(records)], records)
+        self.assertEqual(SessionProgressRecord.objects.count(), len(records) + 1)
+        record = SessionProgressRecord.loads(SessionProgressRecord.objects.order_by('id').last().record)
+        self.assertEqual(record[0], 1)
+        self.assertEqual(record[2:], [1, 1])
+
+        self.client.get(self._step_url())
+        self.client.post(self._step_url(), {'acr_0': '4'})
+        self.client.get(self._step_url())
+        self.assertEqual(SessionProgressRecord.objects.count(), 0)
+
+
+@override_settings(SESSION_PROGRESS_STORAGE='cache')
+class TestCacheSessionProgressStorage(SessionProgressStorageTestMixin, TestCase):
+
+    STORAGE_CLASS = CacheSessionProgressStorage
+
+    def tearDown(self):
+        cache.clear()
+
+
+@override_settings(SESSION_PROGRESS_STORAGE='cookie')
+class TestCookieSessionProgressStorage(SessionProgressStorageTestMixin, TestCase):
+
+    STORAGE_CLASS = CookieSessionProgressStorage
+
+    def test_tampered_cookie_is_ignored(self):
+        self.client.get(reverse('nest:start_session', kwargs={'session_id': self.sess.id}))
+        self.client.get(self._step_url())
+        value = self.client.cookies[CookieSessionProgressStorage.COOKIE_NAME].value
+        self.client.cookies[CookieSessionProgressStorage.COOKIE_NAME] = value[:-1] + ('A' if value[-1] != 'A' else 'B')
+        response = self.client.get(reverse('nest:status'))
+        self.assertEqual(get_session_progress_storage().get_session_id(response.wsgi_request), None)
+
+    def test_long_session(self):
+        num_rounds = 200
+        config_filedir = NestConfig.tests_workdir_path('progress_storage_long_session')
+        os.makedirs(config_filedir, exist_ok=True)
+        self.addCleanup(shutil.rmtree, config_filedir)
+        with open(NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'), 'rt') as fp:
+            config = json.load(fp)
+        scfg = config['stimulus_config']
+        scfg['stimuli'] = [{**scfg['stimuli'][i % 2], 'stimulus_id': i} for i in range(num_rounds)]
+        scfg['stimulusvotegroups'] = [{'stimulus_ids': [i], 'stimulusvotegroup_id': i} for i in range(num_rounds)]
+        scfg['stimulusgroups'] = [{'stimulusvotegroup_ids': [i], 'stimulusgroup_id': i} for i in range(num_rounds)]
+        config['experiment_config']['rounds_per_session'] = num_rounds
+        config_filepath = os.path.join(config_filedir, 'config.json')
+        with open(config_filepath, 'wt') as fp:
+            json.dump(config, fp)
+        ec = ExperimentUtils._create_experiment_from_config(
+            source_config_filepath=config_filepath,
+            is_test=True,
+            random_seed=1,
+            experiment_title=f'progress_storage_tests.{self.__class__.__name__}.long_session')
+        sess = ec.add_session(Subject.find_by_username('user'))
+        step_url = reverse('nest:step_session', kwargs={'session_id': sess.id})
+
+        self.client.get(reverse('nest:start_session', kwargs={'session_id': sess.id}))
+        self.client.get(step_url)
+        for _ in range(num_rounds):
+            response = self.client.get(step_url)
+            self.assertEqual(response.status_code, 200)
+            response = self.client.post(step_url, {f"acr_{response.context_data['stimulusvotegroup_id']}": '3'})
+            self.assertEqual(response.status_code, 302)
+            self.assertTrue(len(self.client.cookies[CookieSessionProgressStorage.COOKIE_NAME].value)
+                            <= CookieSessionProgressStorage.MAX_COOKIE_SIZE)
+            # the start time of the round answered is dropped
+            self.assertEqual(response.wsgi_request._nest_progress['t'], {})
+        self.client.get(step_url)
+        self.assertEqual(Vote.objects.filter(round__session=sess).count(), num_rounds)
+
+    def test_progress_too_large(self):
+        self.client.get(reverse('nest:start_session', kwargs={'session_id': self.sess.id}))
+        self.client.get(self._step_url())
+        self.client.get(self._step_url())
+        value = self.client.cookies[CookieSessionProgressStorage.COOKIE_NAME].value
+        with patch.object(CookieSessionProgressStorage, 'MAX_COOKIE_SIZE', len(value)):
+            response = self.client.post(self._step_url(), {'acr_1': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context_data['title'], 'Session too long')
+        # the step is not recorded, and the cookie is left as it was
+        self.assertEqual(len(self._get_steps(response)), 1)
+        self.assertEqual(self.client.cookies[CookieSessionProgressStorage.COOKIE_NAME].value, value)
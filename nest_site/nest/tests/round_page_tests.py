@@ -0,0 +1,114 @@
+import gc
+import json
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.urls import reverse
+from nest.config import ExperimentConfigCache, NestConfig
+from nest.io import ExperimentUtils
+from nest.models import Subject
+from nest.sites import RoundPageRenderer, StimulusLookup
+
+
+class TestRoundPageRenderer(TestCase):
+
+    def _create_experiment(self, config_filename):
+        return ExperimentUtils._create_experiment_from_config(
+            source_config_filepath=NestConfig.tests_resource_path(config_filename),
+            is_test=True,
+            random_seed=1,
+            experiment_title=f'round_page_tests.TestRoundPageRenderer.{self._testMethodName}')
+
+    def test_get_page(self):
+        ecfg = self._create_experiment('cvxhull_subjexp_toy_x.json').experiment_config
+        renderer = RoundPageRenderer.get(ecfg)
+        self.assertTrue(RoundPageRenderer.get(ecfg) is renderer)
+        info = RoundPageRenderer._compile.cache_info()
+        template, context = renderer.get_page(1, 'Round 2 of 2', 5)
+        self.assertEqual(template, 'nest/acr.html')
+        self.assertEqual(context['title'], 'Round 2 of 2')
+        self.assertEqual(context['session_id'], 5)
+        self.assertEqual(context['stimulusvotegroup_id'], 1)
+        self.assertEqual(context['video_display_percentage'], 50)
+        self.assertTrue(context['video_show_controls'])
+        self.assertEqual(context['video'], ecfg.stimulus_config.stimulus_dict[1]['path'])
+
+        _, context2 = renderer.get_page(1, 'Round 1 of 2', 6)
+        self.assertEqual({**context, 'title': 'Round 1 of 2', 'session_id': 6}, context2)
+        self.assertEqual(context['title'], 'Round 2 of 2')
+        info2 = RoundPageRenderer._compile.cache_info()
+        self.assertEqual(info2.misses - info.misses, 1)
+        self.assertEqual(info2.hits - info.hits, 1)
+
+    def test_renderer_per_config(self):
+        ec = self._create_experiment('cvxhull_subjexp_toy_x.json')
+        with open(NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'), 'rt') as fp:
+            # as compiled once the config changes
+            ecfg = ExperimentConfigCache.compile(json.load(fp), skip_path_check=True)
+        self.assertFalse(RoundPageRenderer.get(ecfg) is RoundPageRenderer.get(ec.experiment_config))
+        RoundPageRenderer.get(ecfg).get_page(0, 'Round 1 of 2', 1)
+        currsize = RoundPageRenderer._compile.cache_info().currsize
+        del ecfg
+        gc.collect()
+        self.assertEqual(RoundPageRenderer._compile.cache_info().currsize, currsize - 1)
+
+    def test_get_page_tafc(self):
+        ecfg = self._create_experiment('cvxhull_subjexp_toy_x_tafc.json').experiment_config
+        renderer = RoundPageRenderer.get(ecfg)
+        with patch('nest.sites.random.random', return_value=0.1):
+            _, context = renderer.get_page(1, 'Round 1 of 2', 1)
+        with patch('nest.sites.random.random', return_value=0.9):
+            _, context2 = renderer.get_page(1, 'Round 1 of 2', 1)
+        self.assertEqual((context['video_a'], context['video_b']), (context2['video_b'], context2['video_a']))
+        self.assertEqual(context['video_a_to_b_values'], list(reversed(context2['video_a_to_b_values'])))
+        self.assertEqual(context['choices'], ['Video A is better', 'Video B is better'])
+
+    def test_get_page_samviq(self):
+        ecfg = self._create_experiment('cvxhull_subjexp_toy_samviq.json').experiment_config
+        renderer = RoundPageRenderer.get(ecfg)
+        with patch('nest.sites.random.shuffle', side_effect=lambda x: x.reverse()):
+            _, context = renderer.get_page(1, 'Round 1 of 2', 1)
+        self.assertEqual(context['stimulusvotegroup_ids'], [3, 2])
+        self.assertEqual(context['videos'], [ecfg.stimulus_config.stimulus_dict[5]['path'],
+                                             ecfg.stimulus_config.stimulus_dict[4]['path']])
+        self.assertEqual(context['buttons'], ['A', 'B'])
+        self.assertFalse('session_id' in context)
+        # the order of the config is left as it is
+        self.assertEqual(ecfg.stimulus_config.stimulusgroup_dict[1]['stimulusvotegroup_ids'], [2, 3])
+        _, context = renderer.get_page(1, 'Round 1 of 2', 1)
+        self.assertEqual(sorted(zip(context['stimulusvotegroup_ids'], context['videos'])),
+                         [(2, ecfg.stimulus_config.stimulus_dict[4]['path']),
+                          (3, ecfg.stimulus_config.stimulus_dict[5]['path'])])
+
+    def test_step_session(self):
+        User.objects.create_user('user', password='pass', is_staff=False)
+        ec = self._create_experiment('cvxhull_subjexp_toy_x.json')
+        sess = ec.add_session(Subject.create_by_username('user'))
+        self.client.login(username='user', password='pass')
+        step_url = reverse('nest:step_session', kwargs={'session_id': sess.id})
+        self.client.get(reverse('nest:start_session', kwargs={'session_id': sess.id}))
+        self.client.get(step_url)
+        info = RoundPageRenderer._compile.cache_info()
+        response = self.client.get(step_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context_data['title'], 'Round 1 of 2')
+        self.assertEqual(response.context_data['session_id'], sess.id)
+        self.assertEqual(response.context_data['site_title'], 'e2nest')
+        self.assertTrue('csrfmiddlewaretoken' in response.content.decode())
+        # as the same page is requested again, e.g. reloaded
+        response = self.client.get(step_url)
+        self.assertEqual(response.context_data['title'], 'Round 1 of 2')
+        self.assertEqual(RoundPageRenderer._compile.cache_info().hits - info.hits, 1)
+
+    def test_stimulus_lookup(self):
+        scfg = self._create_experiment('cvxhull_subjexp_toy_samviq.json').experiment_config.stimulus_config
+        self.assertEqual(StimulusLookup.stimulusgroup_dict(scfg, 1)['stimulusvotegroup_ids'], [2, 3])
+        self.assertEqual(StimulusLookup.double_stimulus_ids(scfg, 2),
+                         tuple(scfg.stimulusvotegroup_dict[2]['stimulus_ids']))
+        self.assertEqual(StimulusLookup.stimulus_dict(scfg, 4), scfg.stimulus_dict[4])
+        with self.assertRaises(AssertionError):
+            StimulusLookup.stimulus_dict(scfg, -1)
+        with self.assertRaises(AssertionError):
+            # two stimulusvotegroups in the stimulusgroup
+            StimulusLookup.single_stimulusvotegroup_id(scfg, 1)
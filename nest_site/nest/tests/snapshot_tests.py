@@ -0,0 +1,143 @@
+import json
+import os
+import shutil
+
+from django.test import TestCase
+from nest.config import ExperimentConfigCache, NestConfig, StimulusConfig, ValidationCertificate
+from nest.control import ExperimentController
+from nest.models import Experiment
+from nest.snapshot import ConfigSnapshot, SECTIONS, SnapshotSection
+
+
+class TestConfigSnapshot(TestCase):
+
+    def setUp(self) -> None:
+        self.config_filedir = NestConfig.tests_workdir_path('config_snapshot')
+        os.makedirs(self.config_filedir, exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.config_filedir)
+
+    def _write_config_and_snapshot(self, config, path_checked=True):
+        config_filepath = os.path.join(self.config_filedir, 'a.json')
+        with open(config_filepath, 'wt') as fp:
+            json.dump(config, fp, indent=4)
+        with open(config_filepath, 'rb') as fp:
+            data = fp.read()
+        cert = ValidationCertificate.issue(config_filepath, data, path_checked=path_checked)
+        ConfigSnapshot.write(config_filepath, config,
+                             source_signature=ExperimentConfigCache.get_signature(config_filepath),
+                             content_hash=cert.content_hash,
+                             validator_version=cert.validator_version,
+                             path_check_timestamp=cert.path_check_timestamp)
+        return config_filepath
+
+    def test_round_trip(self):
+        for filename in ['cvxhull_subjexp_toy_x.json',
+                         'cvxhull_subjexp_toy_x_acr_standard_2.json',
+                         'cvxhull_subjexp_toy_x_dcr_with_training_and_reliability.json',
+                         'es_noise_study_test1a1b_dcr_with_training_and_reliability.json']:
+            with open(NestConfig.tests_resource_path(filename), 'rt') as fp:
+                config = json.load(fp)
+            config_filepath = self._write_config_and_snapshot(config)
+            snapshot = ConfigSnapshot.load(config_filepath)
+            self.assertEqual(snapshot.experiment_config, config['experiment_config'])
+            for section in SECTIONS:
+                self.assertEqual(list(snapshot.stimulus_config[section]), config['stimulus_config'][section])
+
+    def test_stimulus_config_on_snapshot(self):
+        with open(NestConfig.tests_resource_path('cvxhull_subjexp_toy_x_acr_standard_2.json'), 'rt') as fp:
+            config = json.load(fp)
+        config_filepath = self._write_config_and_snapshot(config)
+        scfg = StimulusConfig(config['stimulus_config'], skip_path_check=True)
+        scfg2 = StimulusConfig(ConfigSnapshot.load(config_filepath).stimulus_config, trusted=True)
+        self.assertEqual(scfg2.stimulusgroup_ids, scfg.stimulusgroup_ids)
+        self.assertEqual(scfg2.stimulus_ids, scfg.stimulus_ids)
+        self.assertEqual(scfg2.super_stimulusgroup_ids, scfg.super_stimulusgroup_ids)
+        self.assertEqual(dict(scfg2.stimulus_dict), scfg.stimulus_dict)
+        self.assertEqual(dict(scfg2.stimulusgroup_dict), scfg.stimulusgroup_dict)
+        sgid = scfg.stimulusgroup_ids[-1]
+        self.assertEqual(scfg2.get_pre_message(sgid), scfg.get_pre_message(sgid))
+        self.assertIsNone(scfg2.get_pre_message(-1))
+        # repeated strings are decoded once
+        s0, s1 = scfg2.stimuli[0], scfg2.stimuli[1]
+        self.assertTrue(s0['type'] is s1['type'])
+
+    def test_stimulus_config_reads_only_touched_sections(self):
+        with open(NestConfig.tests_resource_path('cvxhull_subjexp_toy_x_acr_standard_2.json'), 'rt') as fp:
+            config = json.load(fp)
+        config_filepath = self._write_config_and_snapshot(config)
+        snapshot = ConfigSnapshot.load(config_filepath)
+        scfg = StimulusConfig(snapshot.stimulus_config, trusted=True)
+        ids = scfg.get_ids('stimulusgroups')
+        self.assertTrue(isinstance(ids, memoryview))
+        self.assertEqual(list(ids), [sg['stimulusgroup_id'] for sg in config['stimulus_config']['stimulusgroups']])
+        self.assertEqual(len(scfg.stimuli._rows), 0)
+        self.assertEqual(len(scfg.stimulusgroups._rows), 0)
+        self.assertEqual(len(snapshot._strings), 0)
+
+    def test_cache_loads_snapshot(self):
+        with open(NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'), 'rt') as fp:
+            config = json.load(fp)
+        # media path that fails full validation, so that a successful load
+        # means the snapshot was used
+        config['stimulus_config']['stimuli'][0]['path'] = '/media/mp4/samples/does_not_exist.mp4'
+        config_filepath = self._write_config_and_snapshot(config)
+        ValidationCertificate.remove(config_filepath)
+        cache = ExperimentConfigCache()
+        ecfg = cache.get('a', config_filepath)
+        self.assertEqual(ecfg.stimulus_config.stimuli[0]['path'], '/media/mp4/samples/does_not_exist.mp4')
+        # trusted is up to the snapshot, and not part of the cache key
+        self.assertTrue(cache.get('a', config_filepath, trusted=True) is ecfg)
+        ecfg = ExperimentConfigCache().get('a', config_filepath, trusted=True)
+        self.assertEqual(ecfg.stimulus_config.stimuli[0]['path'], '/media/mp4/samples/does_not_exist.mp4')
+
+    def test_cache_ignores_stale_snapshot(self):
+        with open(NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'), 'rt') as fp:
+            config = json.load(fp)
+        config_filepath = self._write_config_and_snapshot(config)
+        config['experiment_config']['description'] = 'changed'
+        with open(config_filepath, 'wt') as fp:
+            json.dump(config, fp)
+        with open(config_filepath, 'rb') as fp:
+            content_hash = ValidationCertificate.hash_content(fp.read())
+        self.assertFalse(ConfigSnapshot.load(config_filepath).vouches_for(
+            ExperimentConfigCache.get_signature(config_filepath), content_hash,
+            ValidationCertificate.VALIDATOR_VERSION))
+        ecfg = ExperimentConfigCache().get('a', config_filepath)
+        self.assertEqual(ecfg.description, 'changed')
+        ecfg = ExperimentConfigCache().get('a', config_filepath, trusted=True)
+        self.assertEqual(ecfg.description, 'changed')
+
+    def test_cache_ignores_snapshot_of_other_content(self):
+        with open(NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'), 'rt') as fp:
+            config = json.load(fp)
+        config['experiment_config']['description'] = 'aaaa'
+        config_filepath = self._write_config_and_snapshot(config)
+        signature = ExperimentConfigCache.get_signature(config_filepath)
+        # rewritten with the same size and mtime
+        config['experiment_config']['description'] = 'bbbb'
+        with open(config_filepath, 'wt') as fp:
+            json.dump(config, fp, indent=4)
+        os.utime(config_filepath, ns=(signature[0], signature[0]))
+        self.assertEqual(ExperimentConfigCache.get_signature(config_filepath), signature)
+        ecfg = ExperimentConfigCache().get('a', config_filepath, skip_path_check=True)
+        self.assertEqual(ecfg.description, 'bbbb')
+
+    def test_stimuli_info_of_snapshot_is_json_serializable(self):
+        with open(NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'), 'rt') as fp:
+            config = json.load(fp)
+        config_filepath = self._write_config_and_snapshot(config)
+        ecfg = ExperimentConfigCache().get('a', config_filepath)
+        self.assertTrue(isinstance(ecfg.stimulus_config.stimuli, SnapshotSection))
+        ec = ExperimentController(experiment=Experiment.objects.create(title='a'), experiment_config=ecfg)
+        stimuli_info = json.loads(json.dumps(ec.get_stimuli_info()))
+        for section in SECTIONS:
+            self.assertEqual(stimuli_info[section], config['stimulus_config'][section])
+
+    def test_load_missing_or_corrupt(self):
+        config_filepath = os.path.join(self.config_filedir, 'a.json')
+        self.assertIsNone(ConfigSnapshot.load(config_filepath))
+        with open(ConfigSnapshot.get_filepath(config_filepath), 'wb') as fp:
+            fp.write(b'not a snapshot')
+        self.assertIsNone(ConfigSnapshot.load(config_filepath))
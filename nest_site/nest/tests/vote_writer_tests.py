@@ -0,0 +1,174 @@
+import json
+import time
+
+from django.contrib.auth.models import User
+from django.test import override_settings, TestCase, TransactionTestCase
+from django.urls import reverse
+from nest import vote_writer
+from nest.config import NestConfig
+from nest.io import ExperimentUtils
+from nest.models import FivePointVote, Round, StimulusVoteGroup, Subject
+from nest.vote_writer import get_vote_writer, VoteWriteBehindQueue
+
+
+class VoteWriterTestMixin(object):
+
+    def setUp(self) -> None:
+        self.ec = ExperimentUtils._create_experiment_from_config(
+            source_config_filepath=NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'),
+            is_test=True,
+            random_seed=1,
+            experiment_title=f'vote_writer_tests.{self.__class__.__name__}')
+        self.sess = self.ec.add_session(Subject.create_by_username('user'))
+        self.rounds = list(Round.objects.filter(session=self.sess).order_by('round_id'))
+
+    def _scores(self, rnd, score):
+        return {svg.id: score for svg in StimulusVoteGroup.objects.filter(stimulusgroup=rnd.stimulusgroup)}
+
+
+class TestVoteWriteBehindQueue(VoteWriterTestMixin, TestCase):
+
+    def test_flush(self):
+        queue = VoteWriteBehindQueue(autostart=False)
+        queue.put(self.sess.id, self.rounds[0].id, FivePointVote, self._scores(self.rounds[0], 1), 2.5)
+        queue.put(self.sess.id, self.rounds[1].id, FivePointVote, self._scores(self.rounds[1], 4), None)
+        self.assertEqual(queue.stats()['queue_depth'], 2)
+        self.assertEqual(FivePointVote.objects.count(), 0)
+
+        self.assertEqual(queue.flush(session_id=self.sess.id + 1), 0)
+        self.assertEqual(queue.flush(session_id=self.sess.id), 2)
+        self.assertEqual([v.score for v in FivePointVote.objects.order_by('round__round_id')], [1, 4])
+        self.assertEqual([rnd.response_sec for rnd in Round.objects.filter(session=self.sess).order_by('round_id')],
+                         [2.5, None])
+        stats = queue.stats()
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['batches'], 1)
+        self.assertEqual(stats['rounds_written'], 2)
+        self.assertEqual(stats['votes_written'], 2)
+        self.assertEqual(stats['rounds_dropped'], 0)
+        self.assertTrue(stats['last_flush_latency_sec'] > 0)
+        self.assertEqual(stats['mean_flush_latency_sec'], stats['last_flush_latency_sec'])
+
+    def test_existing_votes(self):
+        queue = VoteWriteBehindQueue(autostart=False)
+        queue.put(self.sess.id, self.rounds[0].id, FivePointVote, self._scores(self.rounds[0], 1), 2.5)
+        queue.flush()
+        # a resubmission is skipped, a different score dropped
+        queue.put(self.sess.id, self.rounds[0].id, FivePointVote, self._scores(self.rounds[0], 1), 2.5)
+        queue.flush()
+        queue.put(self.sess.id, self.rounds[0].id, FivePointVote, self._scores(self.rounds[0], 3), 2.5)
+        with self.assertLogs('vote_writer', level='ERROR'):
+            queue.flush()
+        self.assertEqual([v.score for v in FivePointVote.objects.all()], [1])
+        self.assertEqual(queue.stats()['votes_written'], 1)
+
+    def test_failed_batch_retried_per_round(self):
+        queue = VoteWriteBehindQueue(autostart=False)
+        queue.put(self.sess.id, self.rounds[0].id, FivePointVote, self._scores(self.rounds[0], 1), 2.5)
+        # a round whose votes cannot be created
+        queue.put(self.sess.id, self.rounds[1].id, None, self._scores(self.rounds[1], 4), 2.5)
+        with self.assertLogs('vote_writer', level='ERROR'):
+            queue.flush()
+        self.assertEqual([v.score for v in FivePointVote.objects.all()], [1])
+        stats = queue.stats()
+        self.assertEqual(stats['rounds_written'], 1)
+        self.assertEqual(stats['rounds_dropped'], 1)
+
+
+class TestVoteWriteBehindThread(VoteWriterTestMixin, TransactionTestCase):
+
+    def tearDown(self):
+        self.queue.stop()
+
+    def _wait_for_batches(self, num_batches, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while self.queue.stats()['batches'] < num_batches and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_flush_by_batch_size(self):
+        self.queue = VoteWriteBehindQueue(batch_size=2, max_age_sec=60)
+        self.queue.put(self.sess.id, self.rounds[0].id, FivePointVote, self._scores(self.rounds[0], 1), 2.5)
+        time.sleep(0.1)
+        self.assertEqual(self.queue.stats()['queue_depth'], 1)
+        self.queue.put(self.sess.id, self.rounds[1].id, FivePointVote, self._scores(self.rounds[1], 4), 2.5)
+        self._wait_for_batches(1)
+        self.assertEqual(self.queue.stats()['queue_depth'], 0)
+        self.assertEqual([v.score for v in FivePointVote.objects.order_by('round__round_id')], [1, 4])
+
+    def test_flush_by_age(self):
+        self.queue = VoteWriteBehindQueue(batch_size=100, max_age_sec=0.05)
+        self.queue.put(self.sess.id, self.rounds[0].id, FivePointVote, self._scores(self.rounds[0], 1), 2.5)
+        self._wait_for_batches(1)
+        self.assertEqual([v.score for v in FivePointVote.objects.all()], [1])
+        self.assertTrue(self.queue.stats()['last_flush_latency_sec'] >= 0.05)
+
+
+# the thread only writes the rounds that have waited a minute, so that the
+# test flushes them itself
+@override_settings(INCREMENTAL_VOTE_PERSISTENCE=True, VOTE_WRITE_BEHIND_BATCH_SIZE=100,
+                   VOTE_WRITE_BEHIND_MAX_AGE_SEC=60)
+class TestIncrementalVotePersistence(TestCase):
+
+    def setUp(self) -> None:
+        User.objects.create_user('user', password='pass', is_staff=False)
+        self.ec = ExperimentUtils._create_experiment_from_config(
+            source_config_filepath=NestConfig.tests_resource_path('cvxhull_subjexp_toy_x.json'),
+            is_test=True,
+            random_seed=1,
+            experiment_title='vote_writer_tests.TestIncrementalVotePersistence')
+        self.sess = self.ec.add_session(Subject.create_by_username('user'))
+        self.client.login(username='user', password='pass')
+        self.step_url = reverse('nest:step_session', kwargs={'session_id': self.sess.id})
+
+    def tearDown(self):
+        get_vote_writer().stop()
+        vote_writer._vote_writer = None
+
+    def _score_rounds(self):
+        self.client.get(reverse('nest:start_session', kwargs={'session_id': self.sess.id}))
+        self.client.get(self.step_url)
+        self.client.get(self.step_url)
+        self.client.post(self.step_url, {'acr_1': '1'})
+        self.assertEqual(get_vote_writer().stats()['queue_depth'], 1)
+        self.assertEqual(get_vote_writer().flush(), 1)
+        self.assertEqual(FivePointVote.objects.count(), 1)
+
+        # the session with votes is still in progress
+        response = self.client.get(reverse('nest:status'))
+        self.assertEqual([test['action'] for test in response.context_data['tests']], ['Continue'])
+
+        response = self.client.get(self.step_url)
+        self.assertEqual(response.status_code, 200)
+        self.client.post(self.step_url, {'acr_0': '4'})
+        self.assertEqual(get_vote_writer().stats()['queue_depth'], 1)
+
+    def test_step_session(self):
+        self._score_rounds()
+        response = self.client.get(self.step_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context_data['title'], 'Test done')
+        self.assertEqual(get_vote_writer().stats()['queue_depth'], 0)
+        self.assertEqual([v.score for v in FivePointVote.objects.order_by('round__round_id')], [1, 4])
+        self.assertTrue(all(rnd.response_sec > 0 for rnd in Round.objects.filter(session=self.sess)))
+        response = self.client.get(reverse('nest:status'))
+        self.assertEqual([test['status'] for test in response.context_data['tests']], ['Done'])
+
+    def test_step_session_with_votes_lost(self):
+        self._score_rounds()
+        # as if the queue of another process were lost
+        get_vote_writer()._pending.clear()
+        with self.assertLogs('sites', level='WARNING'):
+            response = self.client.get(self.step_url)
+        self.assertEqual(response.context_data['title'], 'Test done')
+        self.assertEqual([v.score for v in FivePointVote.objects.order_by('round__round_id')], [1, 4])
+
+    def test_vote_writer_stats(self):
+        User.objects.create_user('staff', password='pass', is_staff=True)
+        self._score_rounds()
+        self.client.login(username='staff', password='pass')
+        response = self.client.get(reverse('admin:vote_writer_stats'))
+        self.assertEqual(response.status_code, 200)
+        stats = json.loads(response.content)
+        self.assertTrue(stats['incremental_vote_persistence'])
+        self.assertEqual(stats['queue_depth'], 1)
+        self.assertEqual(stats['rounds_written'], 1)
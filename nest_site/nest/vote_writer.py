@@ -0,0 +1,242 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.db import close_old_connections, connection, IntegrityError, transaction
+
+logging.basicConfig()
+logger = logging.getLogger(os.path.splitext(os.path.basename(__file__))[0])
+logger.setLevel('INFO')
+
+
+# the votes of a scored round, waiting to be written: vote_class is the Vote
+# subclass of the experiment, scores maps StimulusVoteGroup pks to scores,
+# and response_sec is None if unknown
+RoundVotes = namedtuple('RoundVotes', ['session_id', 'round_pk', 'vote_class', 'scores', 'response_sec',
+                                       'enqueue_time'])
+
+
+def write_round_votes(items: Iterable[RoundVotes]) -> int:
+    """
+    Write the votes and response_sec of the rounds of items, in bulk, in one
+    transaction, and return the number of Votes created. A vote that already
+    exists with the same score, e.g. from a resubmission, is skipped; with a
+    different score, it is kept and the new one dropped, and an error
+    logged, since there is no request left to fail.
+    """
+    items = list(items)
+    try:
+        with transaction.atomic():
+            return _write_round_votes(items)
+    except IntegrityError:
+        # a vote of the same round and svg was written concurrently, by
+        # another process; check the votes again
+        with transaction.atomic():
+            return _write_round_votes(items)
+
+
+def _write_round_votes(items: List[RoundVotes]) -> int:
+    from .models import Round, Vote
+    scores = {(round_pk, svg_pk): score for round_pk, svg_pk, score in Vote.objects
+              .non_polymorphic()
+              .filter(round_id__in={item.round_pk for item in items})
+              .values_list('round_id', 'stimulusvotegroup_id', 'score')}
+    votes = list()
+    response_secs = dict()
+    for item in items:
+        for svg_pk, score in item.scores.items():
+            if (item.round_pk, svg_pk) in scores:
+                if scores[(item.round_pk, svg_pk)] != score:
+                    logger.error(f'drop vote {score} of svg {svg_pk} in round {item.round_pk}, as a vote '
+                                 f'with score {scores[(item.round_pk, svg_pk)]} already exists.')
+                continue
+            scores[(item.round_pk, svg_pk)] = score
+            votes.append(item.vote_class(score=score, round_id=item.round_pk, stimulusvotegroup_id=svg_pk))
+        if item.response_sec is not None:
+            response_secs[item.round_pk] = item.response_sec
+    Vote.bulk_create_votes(votes)
+    # no signals needed, as only the response_sec of the rounds changes
+    Round.objects.bulk_update([Round(id=round_pk, response_sec=response_sec)
+                               for round_pk, response_sec in response_secs.items()], ['response_sec'])
+    return len(votes)
+
+
+class VoteWriteBehindQueue(object):
+    """
+    Write-behind queue of the votes of scored rounds, used when the
+    INCREMENTAL_VOTE_PERSISTENCE setting is on. step_session puts the votes
+    of a round on POST, and a background thread writes them in batches, as
+    soon as batch_size rounds are pending, or the oldest one has waited
+    max_age_sec. flush() writes the pending rounds in the calling thread,
+    e.g. those of a session about to be completed, once any of them being
+    written by the thread are. Pending rounds are also flushed when the process exits
+    normally; only those of a process that is killed are lost, while the
+    steps performed are still kept by the session progress storage.
+
+    A batch that fails to be written is retried one round at a time, and
+    the rounds still failing are dropped, with an error logged.
+    """
+
+    DEFAULT_BATCH_SIZE = 50
+    DEFAULT_MAX_AGE_SEC = 1.0
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE, max_age_sec: float = DEFAULT_MAX_AGE_SEC,
+                 autostart: bool = True):
+        assert batch_size > 0 and max_age_sec >= 0
+        self.batch_size = batch_size
+        self.max_age_sec = max_age_sec
+        self.autostart = autostart
+        self._pending: deque = deque()
+        self._cond = threading.Condition()
+        # the batch being written by the thread, that flush waits for
+        self._in_flight: List[RoundVotes] = list()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self.batches = 0
+        self.rounds_written = 0
+        self.votes_written = 0
+        self.rounds_dropped = 0
+        self.last_flush_latency_sec = None
+        self.max_flush_latency_sec = 0.0
+        self._total_flush_latency_sec = 0.0
+        if autostart:
+            atexit.register(self.stop)
+
+    def put(self, session_id: int, round_pk: int, vote_class, scores: Dict[int, float],
+            response_sec: Optional[float]):
+        item = RoundVotes(session_id, round_pk, vote_class, dict(scores), response_sec, time.monotonic())
+        with self._cond:
+            self._pending.append(item)
+            if self.autostart and self._thread is None:
+                self._start()
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+
+    def _start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='VoteWriteBehindQueue', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self._stopping and not self._is_due():
+                        if len(self._pending) == 0:
+                            self._cond.wait()
+                        else:
+                            self._cond.wait(max(0.0, self._pending[0].enqueue_time + self.max_age_sec
+                                                - time.monotonic()))
+                    if self._stopping:
+                        return
+                    batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                    self._in_flight = batch
+                try:
+                    close_old_connections()
+                    self._write(batch)
+                finally:
+                    with self._cond:
+                        self._in_flight = list()
+                        self._cond.notify_all()
+        finally:
+            connection.close()
+
+    def _is_due(self) -> bool:
+        return len(self._pending) >= self.batch_size or \
+            (len(self._pending) > 0 and time.monotonic() - self._pending[0].enqueue_time >= self.max_age_sec)
+
+    def _write(self, batch: List[RoundVotes]):
+        if len(batch) == 0:
+            return
+        try:
+            num_votes = write_round_votes(batch)
+            written = batch
+        except Exception:
+            logger.exception(f'error writing a batch of {len(batch)} rounds, retrying them one at a time')
+            num_votes = 0
+            written = list()
+            for item in batch:
+                try:
+                    num_votes += write_round_votes([item])
+                    written.append(item)
+                except Exception:
+                    logger.exception(f'drop the votes {item.scores} of round {item.round_pk} '
+                                     f'of session {item.session_id}')
+        latency = time.monotonic() - min(item.enqueue_time for item in batch)
+        with self._cond:
+            self.batches += 1
+            self.rounds_written += len(written)
+            self.votes_written += num_votes
+            self.rounds_dropped += len(batch) - len(written)
+            self.last_flush_latency_sec = latency
+            self.max_flush_latency_sec = max(self.max_flush_latency_sec, latency)
+            self._total_flush_latency_sec += latency
+
+    def flush(self, session_id: Optional[int] = None) -> int:
+        """
+        Write the pending rounds, or only those of session_id, in the
+        calling thread, after any batch being written, and return the number
+        of rounds written.
+        """
+        def matches(item):
+            return session_id is None or item.session_id == session_id
+        with self._cond:
+            self._cond.wait_for(lambda: not any(matches(item) for item in self._in_flight))
+            batch = [item for item in self._pending if matches(item)]
+            for item in batch:
+                self._pending.remove(item)
+        self._write(batch)
+        return len(batch)
+
+    def stop(self):
+        """
+        Stop the background thread, and write the rounds still pending.
+        """
+        with self._cond:
+            thread = self._thread
+            self._stopping = True
+            self._cond.notify_all()
+        if thread is not None:
+            thread.join()
+        with self._cond:
+            self._thread = None
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'queue_depth': len(self._pending),
+                'batch_size': self.batch_size,
+                'max_age_sec': self.max_age_sec,
+                'batches': self.batches,
+                'rounds_written': self.rounds_written,
+                'votes_written': self.votes_written,
+                'rounds_dropped': self.rounds_dropped,
+                'last_flush_latency_sec': self.last_flush_latency_sec,
+                'max_flush_latency_sec': self.max_flush_latency_sec,
+                'mean_flush_latency_sec': self._total_flush_latency_sec / self.batches if self.batches > 0 else None,
+            }
+
+
+_vote_writer: Optional[VoteWriteBehindQueue] = None
+_vote_writer_lock = threading.Lock()
+
+
+def get_vote_writer() -> VoteWriteBehindQueue:
+    """
+    Return the process-wide queue, with the batch size and age of the
+    VOTE_WRITE_BEHIND_BATCH_SIZE and VOTE_WRITE_BEHIND_MAX_AGE_SEC settings.
+    """
+    global _vote_writer
+    with _vote_writer_lock:
+        if _vote_writer is None:
+            _vote_writer = VoteWriteBehindQueue(
+                batch_size=getattr(settings, 'VOTE_WRITE_BEHIND_BATCH_SIZE', VoteWriteBehindQueue.DEFAULT_BATCH_SIZE),
+                max_age_sec=getattr(settings, 'VOTE_WRITE_BEHIND_MAX_AGE_SEC',
+                                    VoteWriteBehindQueue.DEFAULT_MAX_AGE_SEC))
+        return _vote_writer
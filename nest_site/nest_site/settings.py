@@ -147,6 +147,31 @@ def map_media_local_to_url(local):
     return os.path.join(MEDIA_URL, rel_path)
 
 
+# where experiment configs are stored: 'file' (under MEDIA_ROOT/experiment_config,
+# which all web nodes must share) or 'database'
+EXPERIMENT_CONFIG_STORAGE = 'file'
+
+# where the progress of a subject through a session is kept between steps:
+# 'session' (the full steps in request.session), or compactly, one record per
+# step, in 'database' rows, the 'cache' (shared by all web nodes) or a signed
+# 'cookie'
+SESSION_PROGRESS_STORAGE = 'session'
+
+# write the votes of each round as it is scored, through a write-behind queue
+# flushed by a background thread in batches of up to the batch size, or once
+# the oldest round has waited the max age, instead of all at the end of the
+# session
+INCREMENTAL_VOTE_PERSISTENCE = False
+VOTE_WRITE_BEHIND_BATCH_SIZE = 50
+VOTE_WRITE_BEHIND_MAX_AGE_SEC = 1.0
+
+# serve the subject-facing views (status, start_session, step_session) and the
+# mp4 media with their async variants, for a deployment served by asgi.py. The
+# subject-facing ones are thread-offload wrappers of the sync views, with a
+# lower throughput than the sync views (see NestSite.async_step_session)
+NEST_ASYNC_VIEWS = False
+
+
 # fixing warning of 'django.db.models.BigAutoField':
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
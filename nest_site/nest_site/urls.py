@@ -22,26 +22,40 @@ from django.urls import include, re_path
 from django.urls import path
 from django.views.generic import RedirectView
 from nest_site import settings
-from third_party.ranged_response import RangedFileResponse
+from third_party.ranged_response import AsyncRangedFileResponse, RangedFileResponse
 
 favicon_view = RedirectView.as_view(
     url=staticfiles_storage.url('nest/images/favicon.ico'), permanent=False)
 
 
-def mp4_byterange_view(request, path):
+def _get_mp4_path(path):
     mp4_root = os.path.join(settings.MEDIA_ROOT, 'mp4')
     full_path = os.path.realpath(os.path.join(mp4_root, path))
     if os.path.commonprefix([full_path, mp4_root]) != mp4_root:
         raise FileNotFoundError("File not found: %s" % path)
+    return full_path
+
+
+def mp4_byterange_view(request, path):
+    full_path = _get_mp4_path(path)
     response = RangedFileResponse(request, open(full_path, 'rb'), content_type='video/mp4')
     response['Content-Disposition'] = f'attachment; filename="{full_path}"'
     return response
 
 
+async def async_mp4_byterange_view(request, path):
+    full_path = _get_mp4_path(path)
+    response = AsyncRangedFileResponse(request, full_path, content_type='video/mp4')
+    response['Content-Disposition'] = f'attachment; filename="{full_path}"'
+    return response
+
+
 urlpatterns = [
     path('admin/', admin.site.urls, name='admin'),
     path('polls/', include('polls.urls'), name='polls'),
     path('', nest.site.urls, name='nest'),
     re_path(r'^favicon\.ico$', favicon_view, name='favicon'),
-    re_path(r'^media/mp4/(?P<path>.*)$', mp4_byterange_view, name='mp4'),
+    re_path(r'^media/mp4/(?P<path>.*)$',
+            async_mp4_byterange_view if getattr(settings, 'NEST_ASYNC_VIEWS', False) else mp4_byterange_view,
+            name='mp4'),
 ]
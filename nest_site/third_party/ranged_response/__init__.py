@@ -1,4 +1,7 @@
-from django.http.response import FileResponse
+import os
+
+from asgiref.sync import sync_to_async
+from django.http.response import FileResponse, StreamingHttpResponse
 
 
 class RangedFileReader(object):
@@ -143,3 +146,73 @@ class RangedFileResponse(FileResponse):
             self['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
             self['Content-Length'] = stop - start
             self.status_code = 206
+
+
+class AsyncRangedFileReader(object):
+    """
+    Async counterpart of RangedFileReader, for ASGI: the file at path is read
+    in blocks in a worker thread, so that the event loop is not blocked while
+    streaming, and its size is taken from the file system rather than by
+    reading it whole.
+    """
+    block_size = 65536
+
+    def __init__(self, path, start=0, stop=float('inf'), block_size=None):
+        """
+        Args:
+            path (str): The path of the file.
+            start (int): Where to start reading the file.
+            stop (Optional[int]:float): Where to end reading the file.
+                Defaults to infinity.
+            block_size (Optional[int]): The block_size to read with.
+        """
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.block_size = block_size or AsyncRangedFileReader.block_size
+        self.start = start
+        self.stop = stop
+
+    async def __aiter__(self):
+        """
+        Reads the data in chunks.
+        """
+        f = await sync_to_async(open, thread_sensitive=False)(self.path, 'rb')
+        try:
+            f.seek(self.start)
+            position = self.start
+            while position < self.stop:
+                data = await sync_to_async(f.read, thread_sensitive=False)(
+                    min(self.block_size, self.stop - position))
+                if not data:
+                    break
+
+                yield data
+                position += len(data)
+        finally:
+            f.close()
+
+    parse_range_header = RangedFileReader.parse_range_header
+
+
+class AsyncRangedFileResponse(StreamingHttpResponse):
+    """
+    Async counterpart of RangedFileResponse, streaming the file at path with
+    an AsyncRangedFileReader.
+    """
+
+    def __init__(self, request, path, *args, **kwargs):
+        """
+        Args:
+            request(ASGIRequest): The Django request object.
+            path (str): The path of the file.
+        """
+        self.ranged_file = AsyncRangedFileReader(path)
+        super(AsyncRangedFileResponse, self).__init__(
+            self.ranged_file, *args, **kwargs
+        )
+        self['Content-Length'] = self.ranged_file.size
+
+        if 'HTTP_RANGE' in request.META:
+            self.add_range_headers(request.META['HTTP_RANGE'])
+
+    add_range_headers = RangedFileResponse.add_range_headers